@@ -0,0 +1,51 @@
+"""How fast can we shape audio, compared to just reading it?
+
+Synthesizes a book's worth of sentences, each with silence at either end and
+its own loudness, then streams them with stream_wav_chunks and with
+shape_chunks, reporting samples per second for each.
+
+    python benchmarks/audio_shaping.py --minutes 30
+"""
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import soundfile as sf
+
+from glowtalk import convert
+
+SAMPLE_RATE = 24000
+
+def make_sentences(directory: Path, minutes: float, seconds_per_sentence: float = 4) -> list[Path]:
+    rng = np.random.default_rng(0)
+    sentences = []
+    for i in range(int(minutes * 60 / seconds_per_sentence)):
+        path = directory / f"{i}.wav"
+        silence = np.zeros(int(SAMPLE_RATE * 0.3), dtype=np.float32)
+        loudness = rng.uniform(0.05, 0.8)
+        speech = rng.uniform(-loudness, loudness, int(SAMPLE_RATE * (seconds_per_sentence - 0.6))).astype(np.float32)
+        sf.write(path, np.concatenate([silence, speech, silence]), SAMPLE_RATE, subtype="FLOAT")
+        sentences.append(path)
+    return sentences
+
+def measure(name: str, chunks) -> None:
+    start = time.perf_counter()
+    samples = sum(chunk.size for chunk in chunks)
+    elapsed = time.perf_counter() - start
+    print(f"{name}: {samples / elapsed / 1e6:.1f}M samples/s ({samples} samples in {elapsed:.2f}s)")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--minutes", type=float, default=10, help="How long the book should be")
+    parser.add_argument("--chunk_size", type=int, default=8192)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        sentences = make_sentences(Path(directory), args.minutes)
+        measure("read only", convert.stream_wav_chunks(iter(sentences), chunk_size=args.chunk_size))
+        measure("shaped", convert.shape_chunks(sentences, convert.DEFAULT_SHAPING, chunk_size=args.chunk_size))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""How much faster is encoding a book's MP3 in parallel segments?
+
+Synthesizes a book's worth of noise as sentence-length wav files, then
+encodes it as one MP3 with a single ffmpeg process, and as parallel joinable
+segments joined with concatenate_mp3s, the way Audiobook.generate_mp3 does,
+for each number of cores up to what we have. The joined book should be as
+long as its segments are together.
+
+    python benchmarks/mp3_encoding.py --minutes 30
+"""
+import argparse
+import os
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import soundfile as sf
+
+from glowtalk import convert
+from glowtalk.models import Audiobook
+
+SAMPLE_RATE = 24000
+
+def make_sentences(directory: Path, minutes: float, seconds_per_sentence: float = 4) -> list[Path]:
+    rng = np.random.default_rng(0)
+    sentences = []
+    for i in range(int(minutes * 60 / seconds_per_sentence)):
+        path = directory / f"{i}.wav"
+        audio = rng.uniform(-0.5, 0.5, int(SAMPLE_RATE * seconds_per_sentence)).astype(np.float32)
+        sf.write(path, audio, SAMPLE_RATE, subtype="FLOAT")
+        sentences.append(path)
+    return sentences
+
+def encode_in_segments(sentences: list[Path], output: Path, workers: int, sentences_per_segment: int) -> list[Path]:
+    """Encode the sentences as one part's segments, joined into output, and
+    return the segments."""
+    segments = [sentences[i:i + sentences_per_segment] for i in range(0, len(sentences), sentences_per_segment)]
+    jobs = [
+        (segment, output.parent / "segments" / f"{i}.mp3", Audiobook.mp3_segment_shaping(starts_part=i == 0))
+        for i, segment in enumerate(segments)
+    ]
+    convert.combine_wavs_to_mp3s(jobs, max_workers=workers, joinable=True)
+    convert.concatenate_mp3s([segment_output for _, segment_output, _ in jobs], output)
+    return [segment_output for _, segment_output, _ in jobs]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--minutes", type=float, default=10, help="How long the book should be")
+    parser.add_argument("--sentences_per_segment", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        directory = Path(directory)
+        sentences = make_sentences(directory, args.minutes)
+
+        start = time.perf_counter()
+        convert.combine_wav_to_mp3(iter(sentences), directory / "serial.mp3", Audiobook.mp3_segment_shaping(starts_part=True))
+        serial = time.perf_counter() - start
+        print(f"one ffmpeg process: {serial:.2f}s")
+
+        workers = 1
+        while workers <= (os.cpu_count() or 1):
+            output = directory / f"parallel-{workers}" / "book.mp3"
+            output.parent.mkdir()
+            start = time.perf_counter()
+            segments = encode_in_segments(sentences, output, workers, args.sentences_per_segment)
+            elapsed = time.perf_counter() - start
+            duration = convert.mp3_duration(output)
+            segments_duration = sum(convert.mp3_duration(segment) for segment in segments)
+            print(f"{workers:3d} cores: {elapsed:.2f}s, {serial / elapsed:.2f}x, {duration / 60:.1f} minutes of audio, "
+                  f"{duration - segments_duration:+.3f}s against its segments")
+            workers *= 2
+
+if __name__ == "__main__":
+    main()
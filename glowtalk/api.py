@@ -1,22 +1,28 @@
-from fastapi import FastAPI, HTTPException, Depends, BackgroundTasks, File, Form, UploadFile, Request, Response
+from fastapi import FastAPI, HTTPException, Depends, BackgroundTasks, File, Form, UploadFile, Header, Request, Response
 from sqlalchemy.orm import Session
-from typing import List, Optional, Union, Callable
+from typing import BinaryIO, Iterator, List, Optional, Union, Callable
 from pydantic import BaseModel, HttpUrl, ConfigDict, Field
-from datetime import datetime
+from datetime import datetime, timedelta
 from . import models
 from .database import init_db
 import os
+import base64
+import contextlib
 import json
+import math
 import re
+import uuid
 from pathlib import Path
-from glowtalk import glowfic_scraper, convert
+from glowtalk import glowfic_scraper, convert, export, progress
 from fastapi.responses import FileResponse
 import hashlib
+import itertools
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 import traceback
 from fastapi.responses import JSONResponse
 from starlette.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
 import asyncio
 from asyncio import Event
 from sse_starlette.sse import EventSourceResponse
@@ -26,6 +32,8 @@ from sqlalchemy.orm import sessionmaker
 
 app = FastAPI()
 SessionLocal = None
+export_manager = export.ExportManager()
+segment_encoder = export.SegmentEncoder()
 logger = logging.getLogger(__name__)
 
 # Then continue with your routes and other app configuration...
@@ -108,6 +116,15 @@ class AudiobookCreate(BaseModel):
 class TakeWorkRequest(BaseModel):
     worker_id: str
     version: int
+    # How long the worker may go without a heartbeat before the item is
+    # handed to someone else. Defaults to WorkQueue.DEFAULT_LEASE.
+    lease_seconds: Optional[int] = Field(default=None, ge=30, le=3600)
+
+class TakeWorkBatchRequest(BaseModel):
+    worker_id: str
+    version: int
+    max_items: int = Field(default=8, ge=1, le=64)
+    lease_seconds: Optional[int] = Field(default=None, ge=30, le=3600)
 
 class WorkQueueItemResponse(BaseModel):
     id: int
@@ -117,6 +134,24 @@ class WorkQueueItemResponse(BaseModel):
 
     model_config = ConfigDict(from_attributes=True)
 
+class WorkQueueBatchResponse(BaseModel):
+    items: List[WorkQueueItemResponse]
+    lease_expires_at: Optional[datetime] = None
+
+class CompleteWorkBatchResponse(BaseModel):
+    completed: List[int]
+    # Items someone else had already completed, so their performances weren't kept
+    duplicates: List[int]
+    not_found: List[int]
+
+class HeartbeatRequest(BaseModel):
+    item_ids: List[int]
+    lease_seconds: Optional[int] = Field(default=None, ge=30, le=3600)
+
+class HeartbeatResponse(BaseModel):
+    renewed: List[int]
+    lost: List[int]
+
 class WorkItemCompletionRequest(BaseModel):
     worker_id: str
     performance_path: str
@@ -173,6 +208,16 @@ class PartContentResponse(BaseModel):
     icon_title: Optional[str]
     author_name: Optional[str]
     content_pieces: List[ContentPieceContentResponse]
+    # Pass as ?cursor= to continue from after this part
+    cursor: str
+
+class TableOfContentsPartResponse(BaseModel):
+    id: int
+    character_name: Optional[str]
+    screenname: Optional[str]
+    author_name: Optional[str]
+    voiced: int
+    rendered: int
 
 # --- API Routes ---
 
@@ -387,36 +432,174 @@ def get_wav_files(audiobook_id: int, db: Session = Depends(get_db)):
     audiobook = db.get(models.Audiobook, audiobook_id)
     if not audiobook:
         raise HTTPException(status_code=404, detail="Audiobook not found")
-    performances = audiobook.get_performances(db)
-    if not performances:
-        return {"files": [], "complete": False}
-    hashes = [performance.audio_file_hash for performance in performances]
-    return {"files": hashes, "complete": True}
+    hashes = []
+    complete = True
+    for _, content_piece, _, performance in audiobook.resolve_content_pieces(db):
+        if not content_piece.should_voice:
+            continue
+        if performance is None:
+            complete = False
+            continue
+        hashes.append(performance.audio_file_hash)
+    return {"files": hashes, "complete": complete}
 
 def get_outputs_path():
     return Path(os.getcwd()) / 'outputs'
 
+# Workers upload performances as WAV, FLAC or Opus, and we keep them as they
+# were uploaded.
+GENERATED_AUDIO_SUFFIXES = [suffix for _, _, suffix, _ in convert.AUDIO_FORMATS.values()]
+
+def find_generated_audio(hash: str) -> Optional[Path]:
+    """The stored performance with this hash, in whatever encoding its
+    worker uploaded it in, or None if we don't have it."""
+    if not re.fullmatch(r"[0-9a-f]+", hash):
+        return None
+    for suffix in GENERATED_AUDIO_SUFFIXES:
+        file_path = get_outputs_path() / f"{hash}{suffix}"
+        if file_path.exists():
+            return file_path
+    return None
+
+def get_generated_wav_path(hash: str) -> Optional[Path]:
+    """The performance with this hash as a WAV file, decoding it the first
+    time it's asked for if it was uploaded compressed."""
+    stored_path = find_generated_audio(hash)
+    if stored_path is None or stored_path.suffix == ".wav":
+        return stored_path
+    wav_path = get_outputs_path() / "decoded" / f"{hash}.wav"
+    if not wav_path.exists():
+        convert.decode_to_wav(stored_path, wav_path)
+    return wav_path
+
+def get_generated_mp3_path(hash: str) -> Optional[Path]:
+    """The performance with this hash as an MP3, encoding it the first time
+    it's asked for."""
+    stored_path = find_generated_audio(hash)
+    if stored_path is None:
+        return None
+    mp3_path = get_outputs_path() / f"{hash}.mp3"
+    if not mp3_path.exists():
+        convert.combine_wavs_to_mp3s([([stored_path], mp3_path, None)], max_workers=1)
+    return mp3_path
+
+def parse_accept(accept: Optional[str]) -> tuple[list[str], set[str]]:
+    """The media types in an Accept header, most preferred first, and those
+    it explicitly refuses with q=0."""
+    if not accept:
+        return ["*/*"], set()
+    ranked = []
+    refused = set()
+    for position, entry in enumerate(accept.split(",")):
+        media_type, *params = [part.strip() for part in entry.split(";")]
+        media_type = media_type.lower()
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    pass
+        if not media_type:
+            continue
+        if quality > 0:
+            ranked.append((-quality, position, media_type))
+        else:
+            refused.add(media_type)
+    return [media_type for _, _, media_type in sorted(ranked)], refused
+
+def choose_audio_format(accept: Optional[str], stored_suffix: str) -> Optional[str]:
+    """The suffix of the format to serve a performance in, given the client's
+    Accept header, or None if there's nothing they'll take.
+
+    Among equally acceptable formats we prefer the one it's stored in, since
+    that needs no conversion, then MP3, which is smaller than WAV."""
+    accepted, refused = parse_accept(accept)
+    available = [stored_suffix] + [suffix for suffix in (".mp3", ".wav") if suffix != stored_suffix]
+    available = [suffix for suffix in available if convert.MEDIA_TYPES[suffix] not in refused]
+    for media_range in accepted:
+        for suffix in available:
+            if media_range in ("*/*", "audio/*", convert.MEDIA_TYPES[suffix]):
+                return suffix
+    return None
+
+# Files named by the hash of their contents never change, so clients can
+# keep them for as long as they like.
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Whether the request's If-None-Match header matches etag, meaning the
+    client already has this version of the file."""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is None:
+        return False
+    # If-None-Match uses the weak comparison, so W/"x" matches "x"
+    return any(tag.strip() == "*" or tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+def content_addressed_headers(name: str) -> dict[str, str]:
+    """Caching headers for a file that's named by its hash, so it's never
+    going to change. name identifies the representation, e.g. the hash with
+    the file's suffix, as the same performance is served in several formats."""
+    return {"ETag": f'"{name}"', "Cache-Control": IMMUTABLE_CACHE_CONTROL}
+
 @app.get("/api/generated_wav_files/{hash}", response_class=FileResponse)
-def get_generated_wav_file(hash: str, db: Session = Depends(get_db)):
-    """Get a specific generated WAV file by its hash"""
-    file_path = get_outputs_path() / f"{hash}.wav"
-    if not file_path.exists():
-        raise HTTPException(status_code=404, detail="WAV file not found")
-    # ensure the file is inside the outputs directory
-    if not file_path.is_relative_to(get_outputs_path()):
+def get_generated_wav_file(hash: str, request: Request):
+    """Get a specific generated performance as a WAV file, by its hash"""
+    if find_generated_audio(hash) is None:
         raise HTTPException(status_code=404, detail="WAV file not found")
-    return FileResponse(file_path)
+    headers = content_addressed_headers(f"{hash}.wav")
+    if etag_matches(request, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(get_generated_wav_path(hash), headers=headers)
 
 @app.get("/api/generated_mp3_files/{hash}", response_class=FileResponse)
-def get_generated_mp3_file(hash: str, db: Session = Depends(get_db)):
-    """Get a specific generated MP3 file by its hash"""
-    file_path = get_outputs_path() / f"{hash}.mp3"
-    if not file_path.exists():
-        raise HTTPException(status_code=404, detail="MP3 file not found")
-    # ensure the file is inside the outputs directory
-    if not file_path.is_relative_to(get_outputs_path()):
+def get_generated_mp3_file(hash: str, request: Request):
+    """Get a specific generated performance as an MP3, by its hash.
+
+    MP3s are only made of performances that someone asks for, the first time
+    they're asked for."""
+    if find_generated_audio(hash) is None:
         raise HTTPException(status_code=404, detail="MP3 file not found")
-    return FileResponse(file_path)
+    headers = content_addressed_headers(f"{hash}.mp3")
+    if etag_matches(request, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(get_generated_mp3_path(hash), headers=headers)
+
+@app.get("/api/generated_audio_files/{hash}", response_class=FileResponse)
+def get_generated_audio_file(hash: str, request: Request):
+    """Get a specific generated performance in the best format the client
+    accepts: the one it was uploaded in, MP3 or WAV."""
+    stored_path = find_generated_audio(hash)
+    if stored_path is None:
+        raise HTTPException(status_code=404, detail="Audio file not found")
+    suffix = choose_audio_format(request.headers.get("accept"), stored_path.suffix)
+    if suffix is None:
+        raise HTTPException(status_code=406, detail="No acceptable audio format")
+    headers = {**content_addressed_headers(f"{hash}{suffix}"), "Vary": "Accept"}
+    if etag_matches(request, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    if suffix == stored_path.suffix:
+        file_path = stored_path
+    elif suffix == ".mp3":
+        file_path = get_generated_mp3_path(hash)
+    else:
+        file_path = get_generated_wav_path(hash)
+    return FileResponse(file_path, media_type=convert.MEDIA_TYPES[suffix], headers=headers)
+
+def lease_duration(lease_seconds: Optional[int]) -> timedelta:
+    if lease_seconds is None:
+        return models.WorkQueue.DEFAULT_LEASE
+    return timedelta(seconds=lease_seconds)
+
+def work_queue_item_response(item: models.WorkQueue) -> WorkQueueItemResponse:
+    speaker = item.speaker
+    return WorkQueueItemResponse(
+        id = item.id,
+        text = item.content_piece.text,
+        speaker_model = speaker.model,
+        reference_audio_hash = speaker.reference_voice.audio_hash
+    )
 
 @app.post("/api/queue/take", response_model=Optional[WorkQueueItemResponse])
 def assign_work_item(request: TakeWorkRequest, db: Session = Depends(get_db)):
@@ -426,33 +609,279 @@ def assign_work_item(request: TakeWorkRequest, db: Session = Depends(get_db)):
         # to being forward compatible yet.
         return None
 
-    item = models.WorkQueue.assign_work_item(db, request.worker_id)
+    item = models.WorkQueue.assign_work_item(db, request.worker_id, lease_duration(request.lease_seconds))
     if item is None:
         return None
-    speaker = item.content_piece.get_speaker_for_audiobook(db, item.audiobook)
+    return work_queue_item_response(item)
 
-    return WorkQueueItemResponse(
-        id = item.id,
-        text = item.content_piece.text,
-        speaker_model = speaker.model,
-        reference_audio_hash = speaker.reference_voice.audio_hash
+@app.post("/api/queue/take_batch", response_model=Optional[WorkQueueBatchResponse])
+def assign_work_items(request: TakeWorkBatchRequest, db: Session = Depends(get_db)):
+    """Lease up to max_items work items to a worker in one round trip.
+
+    This is version 2 of the worker protocol. Version 1 workers keep using
+    /api/queue/take."""
+    if request.version != 2:
+        return None
+
+    items = models.WorkQueue.assign_work_items(
+        db,
+        request.worker_id,
+        request.max_items,
+        lease_duration(request.lease_seconds),
+    )
+    return WorkQueueBatchResponse(
+        items=[work_queue_item_response(item) for item in items],
+        lease_expires_at=min((item.lease_expires_at for item in items), default=None),
+    )
+
+def export_job_response(job: export.ExportJob) -> JSONResponse:
+    """Tell the client that their MP3 is on its way, and where to watch for it."""
+    return JSONResponse(
+        status_code=202,
+        content=job.to_dict(),
+        headers={"Location": f"/api/audiobooks/{job.audiobook_id}/mp3/progress"},
     )
 
-@app.get("/api/audiobooks/{audiobook_id}/mp3", response_class=FileResponse)
-def get_mp3_file(audiobook_id: int, db: Session = Depends(get_db)):
-    """Get an MP3 file for an audiobook"""
+@app.get("/api/audiobooks/{audiobook_id}/mp3", response_model=None)
+def get_mp3_file(audiobook_id: int, request: Request, db: Session = Depends(get_db),
+                 sessionmaker: sessionmaker = Depends(get_sessionmaker)) -> Union[FileResponse, JSONResponse]:
+    """Get an MP3 file for an audiobook.
+
+    If we don't have an up to date MP3 yet, this starts exporting one in the
+    background and responds with 202 and the export's progress. So does an
+    export that's already underway, even a forced one of an MP3 that's
+    current, since it's about to be replaced. Ask again once /mp3/progress
+    says it's done."""
     audiobook = db.get(models.Audiobook, audiobook_id)
     if not audiobook:
         raise HTTPException(status_code=404, detail="Audiobook not found")
-    return FileResponse(audiobook.get_or_generate_mp3(db))
-
-@app.post("/api/audiobooks/{audiobook_id}/mp3", response_class=FileResponse)
-def generate_mp3_file(audiobook_id: int, db: Session = Depends(get_db)):
-    """Generate an MP3 file for an audiobook"""
+    job = export_manager.get(audiobook_id)
+    if job is not None and not job.finished:
+        return export_job_response(job)
+    try:
+        mp3_path = audiobook.get_current_mp3(db)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    if mp3_path is not None:
+        # The file is named by the hash of what's in it, but this URL serves
+        # whichever file is current, so clients have to check back.
+        headers = {"ETag": f'"{mp3_path.stem}"', "Cache-Control": "no-cache"}
+        if etag_matches(request, headers["ETag"]):
+            return Response(status_code=304, headers=headers)
+        return FileResponse(mp3_path, headers=headers)
+    return export_job_response(export_manager.start(audiobook_id, sessionmaker))
+
+@app.post("/api/audiobooks/{audiobook_id}/mp3", response_model=None)
+def generate_mp3_file(audiobook_id: int, db: Session = Depends(get_db),
+                      sessionmaker: sessionmaker = Depends(get_sessionmaker)) -> JSONResponse:
+    """Start exporting an MP3 file for an audiobook, re-encoding all of it.
+
+    Responds with 202, like GET does when it has to export. If an export of
+    this audiobook is already underway, that's the one we report on."""
+    audiobook = db.get(models.Audiobook, audiobook_id)
+    if not audiobook:
+        raise HTTPException(status_code=404, detail="Audiobook not found")
+    try:
+        audiobook.get_mp3_segments(db)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return export_job_response(export_manager.start(audiobook_id, sessionmaker, force=True))
+
+@app.get("/api/audiobooks/{audiobook_id}/mp3/progress")
+async def get_mp3_export_progress(audiobook_id: int):
+    """SSE endpoint for following the latest MP3 export of an audiobook"""
+    job = export_manager.get(audiobook_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="No export found for this audiobook")
+
+    async def progress_events():
+        previous = None
+        try:
+            while True:
+                data = job.to_dict()
+                if data != previous:
+                    yield {"data": json.dumps(data)}
+                    previous = data
+                if data["status"] in ("done", "failed"):
+                    break
+                # Jobs live in memory, so checking on them is cheap
+                await asyncio.sleep(0.5)
+        except asyncio.CancelledError:
+            pass
+    return EventSourceResponse(progress_events())
+
+@app.get("/api/audiobooks/{audiobook_id}/stream", response_model=None)
+def stream_audiobook(audiobook_id: int, format: str = "mp3", from_part: int = 0, offset: int = 0,
+                     db: Session = Depends(get_db),
+                     sessionmaker: sessionmaker = Depends(get_sessionmaker)) -> StreamingResponse:
+    """Stream an audiobook as one continuous MP3 or Ogg Opus stream, encoded
+    as it's sent, so listening can start right away.
+
+    The stream starts at the part numbered from_part (counting from 0),
+    skipping its first offset sentences, and ends at the end of the book, or
+    at the first sentence that hasn't been performed yet."""
+    if format not in convert.STREAM_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Can't stream as {format}, only as {', '.join(convert.STREAM_FORMATS)}")
+    if from_part < 0 or offset < 0:
+        raise HTTPException(status_code=400, detail="from_part and offset can't be negative")
     audiobook = db.get(models.Audiobook, audiobook_id)
     if not audiobook:
         raise HTTPException(status_code=404, detail="Audiobook not found")
-    return FileResponse(audiobook.generate_mp3(db))
+    if next(audiobook.get_performances_from(db, from_part, offset), None) is None:
+        raise HTTPException(status_code=409, detail="Nothing has been performed from there yet")
+    _, media_type = convert.STREAM_FORMATS[format]
+    parts = stream_part_files(sessionmaker, audiobook_id, from_part, offset)
+    return StreamingResponse(convert.stream_audio(parts, format, shaping=convert.DEFAULT_SHAPING),
+                             media_type=media_type)
+
+def stream_part_files(sessionmaker: sessionmaker, audiobook_id: int, from_part: int, offset: int) -> Iterator[list[Path]]:
+    """The audio files of each part that stream_audiobook streams, fetched
+    as the stream gets to them, with a session of its own that lasts as
+    long as the stream does."""
+    with sessionmaker() as db:
+        audiobook = db.get(models.Audiobook, audiobook_id)
+        performances = audiobook.get_performances_from(db, from_part, offset)
+        for _, part_performances in itertools.groupby(performances, key=lambda row: row[0].id):
+            yield [Path(performance.audio_file_path) for _, performance in part_performances]
+
+# What we declare as the bandwidth of our HLS playlists: the most an MP3 can take
+HLS_BANDWIDTH = 320_000
+
+@app.get("/api/audiobooks/{audiobook_id}/hls.m3u8", response_model=None)
+def get_hls_playlist(audiobook_id: int, db: Session = Depends(get_db)) -> Response:
+    """An HLS multivariant playlist of the audiobook, pointing at the media
+    playlist to listen to it with. See Audiobook.current_hls_playlist."""
+    audiobook = db.get(models.Audiobook, audiobook_id)
+    if not audiobook:
+        raise HTTPException(status_code=404, detail="Audiobook not found")
+    playlist, to_encode = audiobook.current_hls_playlist(db)
+    segment_encoder.encode(to_encode)
+    lines = [
+        "#EXTM3U",
+        f'#EXT-X-STREAM-INF:BANDWIDTH={HLS_BANDWIDTH},CODECS="mp4a.40.34"',
+        f"hls/{playlist}.m3u8",
+    ]
+    return Response("\n".join(lines) + "\n", media_type="application/vnd.apple.mpegurl",
+                    headers={"Cache-Control": "no-cache"})
+
+@app.get("/api/audiobooks/{audiobook_id}/hls/{playlist:int}.m3u8", response_model=None)
+def get_hls_media_playlist(audiobook_id: int, playlist: int, db: Session = Depends(get_db)) -> Response:
+    """One of the audiobook's HLS playlists, made of the same MP3 segments
+    as its MP3 export.
+
+    It's an EVENT playlist of the segments that are performed and encoded,
+    which grows as the rest are rendered and encoded in the background, so
+    listening can start before they are, and ends once it has the whole
+    book. See Audiobook.extend_hls_playlist."""
+    audiobook = db.get(models.Audiobook, audiobook_id)
+    if not audiobook:
+        raise HTTPException(status_code=404, detail="Audiobook not found")
+    if playlist > audiobook.latest_hls_playlist(db) and playlist != audiobook.current_hls_playlist(db)[0]:
+        raise HTTPException(status_code=404, detail="Playlist not found")
+    segments, to_encode, finished = audiobook.extend_hls_playlist(db, playlist)
+    segment_encoder.encode(to_encode)
+    lines = [
+        "#EXTM3U",
+        "#EXT-X-VERSION:3",
+        f"#EXT-X-TARGETDURATION:{max((math.ceil(segment.duration) for segment in segments), default=1)}",
+        "#EXT-X-MEDIA-SEQUENCE:0",
+        "#EXT-X-PLAYLIST-TYPE:EVENT",
+    ]
+    for segment in segments:
+        lines.append(f"#EXTINF:{segment.duration:.3f},")
+        lines.append(segment.segment_name)
+    if finished:
+        lines.append("#EXT-X-ENDLIST")
+    return Response("\n".join(lines) + "\n", media_type="application/vnd.apple.mpegurl",
+                    headers={"Cache-Control": "no-cache"})
+
+@app.get("/api/audiobooks/{audiobook_id}/hls/{segment_name}", response_class=FileResponse)
+def get_hls_segment(audiobook_id: int, segment_name: str, request: Request,
+                    sessionmaker: sessionmaker = Depends(get_sessionmaker)):
+    """One of the MP3 segments in an audiobook's HLS playlist.
+
+    Segments are kept, named by a hash of the performances in them, so serving
+    one doesn't need the database. One that's missing, say because it was
+    deleted, is encoded again if it's still what's performed for its place
+    in the playlist. See Audiobook.find_hls_segment."""
+    if not re.fullmatch(r"[0-9a-f]{64}\.mp3", segment_name):
+        raise HTTPException(status_code=404, detail="Segment not found")
+    headers = content_addressed_headers(segment_name)
+    if etag_matches(request, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    segment_path = get_outputs_path() / "segments" / segment_name
+    if not segment_path.exists():
+        with sessionmaker() as db:
+            audiobook = db.get(models.Audiobook, audiobook_id)
+            if not audiobook:
+                raise HTTPException(status_code=404, detail="Audiobook not found")
+            job = audiobook.find_hls_segment(db, segment_name)
+        if job is None:
+            raise HTTPException(status_code=404, detail="Segment not found")
+        convert.combine_wavs_to_mp3s([job], max_workers=1, joinable=True)
+    return FileResponse(segment_path, media_type="audio/mpeg", headers=headers)
+
+# How much of an upload we read at a time
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+def store_content_addressed(source: BinaryIO, output_dir: Path, suffix: str) -> tuple[Path, str]:
+    """Copy source into output_dir, named by the sha256 of its contents.
+
+    The contents are hashed as they're copied, a chunk at a time, into a
+    temporary file that's renamed into place once we know its name. So we
+    never hold the whole file in memory, and a file with a hash for a name is
+    always complete."""
+    output_dir.mkdir(exist_ok=True)
+    hasher = hashlib.sha256()
+    partial_path = output_dir / f".{uuid.uuid4()}.partial"
+    try:
+        with partial_path.open("wb") as partial:
+            while chunk := source.read(UPLOAD_CHUNK_SIZE):
+                hasher.update(chunk)
+                partial.write(chunk)
+        file_hash = hasher.hexdigest()
+        output_path = (output_dir / f"{file_hash}{suffix}").resolve()
+        if not output_path.exists():
+            os.replace(partial_path, output_path)
+    finally:
+        partial_path.unlink(missing_ok=True)
+    return output_path, file_hash
+
+def store_generated_audio(source: BinaryIO) -> tuple[Path, str]:
+    """Store an uploaded performance, with a suffix for its encoding.
+
+    We go by the file's contents rather than the name or type it was
+    uploaded with, since those are only as right as the worker makes them.
+    Raises ValueError if it isn't audio we can take, see
+    convert.uploaded_audio_suffix."""
+    suffix = convert.uploaded_audio_suffix(source)
+    return store_content_addressed(source, get_outputs_path(), suffix)
+
+async def save_generated_audio(generated_audio: UploadFile) -> tuple[Path, str]:
+    """Save an uploaded performance to the outputs directory, named by its
+    hash. Returns the path and the hash, or responds with 400 if it isn't
+    audio we can take.
+
+    The copying happens on a worker thread, so a big upload doesn't hold up
+    the event loop, and everything else being served from it."""
+    try:
+        return await run_in_threadpool(store_generated_audio, generated_audio.file)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"{generated_audio.filename}: {e}")
+
+def complete_with_audio(db: Session, item: models.WorkQueue, worker_id: str, output_path: Path, file_hash: str) -> bool:
+    """Create the performance record and complete the work item. The
+    performance is only saved if nobody else completed the item first.
+    Returns whether it was."""
+    performance = models.VoicePerformance(
+        content_piece_id=item.content_piece_id,
+        audiobook_id=item.audiobook_id,
+        speaker_id=item.speaker_id,
+        audio_file_path=str(output_path),
+        audio_file_hash=file_hash,
+        worker_id=worker_id
+    )
+    return item.complete_work_item(db, worker_id, performance)
 
 @app.post("/api/queue/{item_id}/complete/{worker_id}", response_model=None)
 async def complete_work_item(
@@ -462,36 +891,59 @@ async def complete_work_item(
     db: Session = Depends(get_db)
 ):
     """Create a voice performance and use it to complete a work item."""
-    item = db.get(models.WorkQueue, item_id)
+    item = await run_in_threadpool(db.get, models.WorkQueue, item_id)
     if not item:
         raise HTTPException(status_code=404, detail="Work item not found")
 
-    # Save the uploaded file to the outputs directory using the item's hash as the filename
-    file_content = await generated_audio.read()
-    file_hash = hashlib.sha256(file_content).hexdigest()
-    output_dir = Path(os.getcwd()) / 'outputs'
-    output_dir.mkdir(exist_ok=True)
-    output_path = output_dir / f"{file_hash}.wav"
-    # Normalize the path
-    output_path = output_path.resolve()
-    if not output_path.exists():
-        output_path.write_bytes(file_content)
-    convert.combine_wav_to_mp3([output_path], output_path.with_suffix(".mp3"))
-
-    # Create the performance record and complete the work item
-    performance = models.VoicePerformance(
-        content_piece_id=item.content_piece_id,
-        audiobook_id=item.audiobook_id,
-        speaker_id=item.speaker_id,
-        audio_file_path=str(output_path),
-        audio_file_hash=file_hash,
-        worker_id=worker_id
-    )
-    db.add(performance)
-    item.complete_work_item(db, worker_id, performance)
+    output_path, file_hash = await save_generated_audio(generated_audio)
 
-    db.commit()
-    db.refresh(item)
+    def complete():
+        complete_with_audio(db, item, worker_id, output_path, file_hash)
+        db.commit()
+    # Database work blocks too, so it also stays off the event loop.
+    await run_in_threadpool(complete)
+
+@app.post("/api/queue/complete_batch/{worker_id}", response_model=CompleteWorkBatchResponse)
+async def complete_work_items(
+    worker_id: str,
+    item_ids: List[int] = Form(...),
+    generated_audio: List[UploadFile] = File(...),
+    db: Session = Depends(get_db)
+):
+    """Complete several work items at once. The nth generated_audio file is
+    the performance for the nth item id."""
+    if len(item_ids) != len(generated_audio):
+        raise HTTPException(status_code=400, detail=f"Got {len(item_ids)} item ids but {len(generated_audio)} audio files")
+
+    saved = [await save_generated_audio(audio) for audio in generated_audio]
+
+    def complete() -> CompleteWorkBatchResponse:
+        completed = []
+        duplicates = []
+        not_found = []
+        for item_id, (output_path, file_hash) in zip(item_ids, saved):
+            item = db.get(models.WorkQueue, item_id)
+            if not item:
+                not_found.append(item_id)
+            elif complete_with_audio(db, item, worker_id, output_path, file_hash):
+                completed.append(item_id)
+            else:
+                duplicates.append(item_id)
+        db.commit()
+        return CompleteWorkBatchResponse(completed=completed, duplicates=duplicates, not_found=not_found)
+    # Database work blocks too, so it also stays off the event loop.
+    return await run_in_threadpool(complete)
+
+@app.post("/api/queue/heartbeat/{worker_id}", response_model=HeartbeatResponse)
+def renew_work_item_leases(worker_id: str, request: HeartbeatRequest, db: Session = Depends(get_db)):
+    """Tell the server a worker is still rendering its items, so they aren't
+    handed to anyone else."""
+    renewed = models.WorkQueue.renew_leases(db, worker_id, request.item_ids, lease_duration(request.lease_seconds))
+    still_held = set(renewed)
+    return HeartbeatResponse(
+        renewed=renewed,
+        lost=[item_id for item_id in request.item_ids if item_id not in still_held],
+    )
 
 @app.post("/api/queue/{item_id}/fail/{worker_id}", response_model=None)
 def fail_work_item(item_id: int, worker_id: str, request: WorkItemFailureRequest, db: Session = Depends(get_db)):
@@ -504,21 +956,7 @@ def fail_work_item(item_id: int, worker_id: str, request: WorkItemFailureRequest
 @app.get("/api/queue/status")
 def get_queue_status(db: Session = Depends(get_db)):
     """Get the current status of the work queue"""
-    pending = db.query(models.WorkQueue)\
-        .filter(models.WorkQueue.status == 'pending').count()
-    in_progress = db.query(models.WorkQueue)\
-        .filter(models.WorkQueue.status == 'in_progress').count()
-    completed = db.query(models.WorkQueue)\
-        .filter(models.WorkQueue.status == 'completed').count()
-    failed = db.query(models.WorkQueue)\
-        .filter(models.WorkQueue.status == 'failed').count()
-
-    return {
-        "pending": pending,
-        "in_progress": in_progress,
-        "completed": completed,
-        "failed": failed
-    }
+    return models.WorkQueueCounter.totals(db)
 
 @app.post("/api/content_pieces/{content_piece_id}/voice")
 def voice_content_piece(content_piece_id: int, request: RegenerateContentPieceRequest, db: Session = Depends(get_db)):
@@ -538,7 +976,9 @@ def voice_content_piece(content_piece_id: int, request: RegenerateContentPieceRe
         priority=100
     )
     db.add(queue_item)
+    models.WorkQueueCounter.add(db, audiobook.id, {"pending": 1})
     db.commit()
+    progress.hub.publish(audiobook.id, {"pending": 1})
     return {"work_item_id": queue_item.id}
 
 @app.get("/api/audiobooks/{audiobook_id}/details", response_model=AudiobookDetailResponse)
@@ -610,42 +1050,82 @@ def get_audiobook_details(audiobook_id: int, db: Session = Depends(get_db)):
         characters=character_voices
     )
 
+def encode_part_cursor(part: models.Part) -> str:
+    """An opaque cursor for continuing after part"""
+    return base64.urlsafe_b64encode(f"{part.position}:{part.id}".encode()).decode().rstrip("=")
+
+def decode_part_cursor(cursor: str) -> tuple[int, int]:
+    """The (position, id) of the part a cursor continues after"""
+    try:
+        decoded = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        position, part_id = decoded.split(":")
+        return int(position), int(part_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+@app.get("/api/audiobooks/{audiobook_id}/toc", response_model=List[TableOfContentsPartResponse])
+def get_audiobook_table_of_contents(audiobook_id: int, db: Session = Depends(get_db)):
+    """List the parts of an audiobook, without their content, with how many
+    of their sentences are voiced and how many of those are rendered.
+
+    A part's index in this list is its from_part for the content endpoint."""
+    audiobook = db.get(models.Audiobook, audiobook_id)
+    if not audiobook:
+        raise HTTPException(status_code=404, detail="Audiobook not found")
+    return [
+        TableOfContentsPartResponse(
+            id=row.id,
+            character_name=row.character,
+            screenname=row.screenname,
+            author_name=row.author,
+            voiced=row.voiced,
+            rendered=row.rendered,
+        )
+        for row in audiobook.get_table_of_contents(db)
+    ]
+
 @app.get("/api/audiobooks/{audiobook_id}/content")
-def get_audiobook_content(audiobook_id: int, sessionmaker: sessionmaker = Depends(get_sessionmaker)):
-    """Get the content of an audiobook"""
+def get_audiobook_content(audiobook_id: int, from_part: int = 0, limit: Optional[int] = None,
+                          cursor: Optional[str] = None, sessionmaker: sessionmaker = Depends(get_sessionmaker)):
+    """Get the content of an audiobook, as a line of JSON per part.
+
+    By default that's every part. from_part starts at the part with that
+    index (counting from 0), and cursor continues after the part it came
+    with. limit is the most parts to send."""
+    if from_part < 0 or (limit is not None and limit < 0):
+        raise HTTPException(status_code=400, detail="from_part and limit can't be negative")
+    if cursor is not None and from_part:
+        raise HTTPException(status_code=400, detail="Pass either from_part or cursor, not both")
+    after = decode_part_cursor(cursor) if cursor is not None else None
     session = sessionmaker()
     audiobook: models.Audiobook = session.get(models.Audiobook, audiobook_id)
     if not audiobook:
         session.close()
         raise HTTPException(status_code=404, detail="Audiobook not found")
 
-    parts: list[models.Part] = audiobook.original_work.parts
     def stream_parts():
-        print(f"Streaming {len(parts)} parts")
         try:
-            for part in parts:
-                current_part: models.Part = part
+            for part, pieces in audiobook.resolve_parts(session, after=after, skip=from_part, limit=limit):
                 part_content = PartContentResponse(
-                    id=current_part.id,
-                    character_name=current_part.character,
-                    screenname=current_part.screenname,
-                    icon_url=current_part.icon_url,
-                    icon_title=current_part.icon_title,
-                    author_name=current_part.author,
-                    content_pieces=[]
+                    id=part.id,
+                    character_name=part.character,
+                    screenname=part.screenname,
+                    icon_url=part.icon_url,
+                    icon_title=part.icon_title,
+                    author_name=part.author,
+                    content_pieces=[
+                        ContentPieceContentResponse(
+                            id=content_piece.id,
+                            text=content_piece.text,
+                            voiced=content_piece.should_voice,
+                            audio_file_hash=performance.audio_file_hash if performance else None
+                        )
+                        for content_piece, performance in pieces
+                    ],
+                    cursor=encode_part_cursor(part),
                 )
-                for content_piece in current_part.content_pieces:
-                    piece = content_piece
-                    performance = piece.get_performance_for_audiobook(session, audiobook)
-                    audio_file_hash = None
-                    if performance:
-                        audio_file_hash = performance.audio_file_hash
-                    part_content.content_pieces.append(ContentPieceContentResponse(
-                        id=piece.id,
-                        text=piece.text,
-                        voiced=piece.should_voice,
-                        audio_file_hash=audio_file_hash
-                    ))
+                # Don't hold on to everything we've sent
+                session.expunge_all()
                 yield f"{part_content.model_dump_json()}\n".encode('utf-8')
         except Exception as e:
             print(f"Streaming error: {e}")
@@ -660,38 +1140,75 @@ def get_audiobook_content(audiobook_id: int, sessionmaker: sessionmaker = Depend
         }
     )
 
-async def generate_progress_events(audiobook_id: int, db: Session):
-    """Generate SSE events for audiobook generation progress"""
-    previous = None
-    try:
-        while True:
-            # Query work queue status for this audiobook
-            pending = db.query(models.WorkQueue)\
-                .filter_by(audiobook_id=audiobook_id, status='pending').count()
-            in_progress = db.query(models.WorkQueue)\
-                .filter_by(audiobook_id=audiobook_id, status='in_progress').count()
-            completed = db.query(models.WorkQueue)\
-                .filter_by(audiobook_id=audiobook_id, status='completed').count()
-            failed = db.query(models.WorkQueue)\
-                .filter_by(audiobook_id=audiobook_id, status='failed').count()
-
-            # Prepare event data
-            data = {
-                "audiobook_id": audiobook_id,
-                "pending": pending,
-                "in_progress": in_progress,
-                "completed": completed,
-                "failed": failed
+async def generate_progress_events(audiobook_id: int, sessionmaker: sessionmaker,
+                                   pieces: bool = False, last_event_id: Optional[int] = None):
+    """Generate SSE events for audiobook generation progress.
+
+    The counts come from the shared progress hub, which the work queue
+    updates as items change state, so this doesn't hold a database session
+    or poll.
+
+    With pieces, each newly performed content piece also gets a "piece"
+    event, whose id is its voice performance's id. Given the last of those
+    ids that a client saw, we start by catching it up on what it missed.
+    Otherwise we start from the newest performance there is, so that if we
+    fall behind the hub's backlog, there's somewhere to catch up from."""
+    def load_counts():
+        with sessionmaker() as session:
+            return models.WorkQueueCounter.totals(session, audiobook_id)
+
+    def load_newest_performance_id() -> int:
+        with sessionmaker() as session:
+            audiobook = session.get(models.Audiobook, audiobook_id)
+            return audiobook.get_newest_performance_id(session) if audiobook else 0
+
+    def load_rendered_since(voice_performance_id: int) -> list[progress.RenderedPiece]:
+        with sessionmaker() as session:
+            audiobook = session.get(models.Audiobook, audiobook_id)
+            return audiobook.get_rendered_since(session, voice_performance_id) if audiobook else []
+
+    if pieces and last_event_id is None:
+        # Anything rendered between this and the hub's first update is
+        # caught up on along with that update
+        last_event_id = await run_in_threadpool(load_newest_performance_id)
+
+    # The ids of the pieces we've sent, so that catching up doesn't repeat any
+    sent = set()
+    def piece_events(rendered: list[progress.RenderedPiece]):
+        for piece in rendered:
+            if piece.voice_performance_id in sent:
+                continue
+            sent.add(piece.voice_performance_id)
+            yield {
+                "event": "piece",
+                "id": str(piece.voice_performance_id),
+                "data": json.dumps({
+                    "audiobook_id": audiobook_id,
+                    "content_piece_id": piece.content_piece_id,
+                    "audio_file_hash": piece.audio_file_hash,
+                }),
             }
-            if data != previous:
-                yield {"data": json.dumps(data)}
-                previous = data
-
-            # If no more work to do, stop streaming
-            if pending == 0 and in_progress == 0:
-                break
 
-            await asyncio.sleep(5)  # Wait before next update
+    previous = None
+    try:
+        async with contextlib.aclosing(progress.hub.watch(audiobook_id, load_counts)) as updates:
+            async for update in updates:
+                if pieces:
+                    # We're watching by now, so nothing falls between the
+                    # catch up and the hub's updates
+                    resume_after = max(sent, default=last_event_id)
+                    if previous is None or update.missed_rendered:
+                        for event in piece_events(await run_in_threadpool(load_rendered_since, resume_after)):
+                            yield event
+                    for event in piece_events(update.rendered):
+                        yield event
+                counts = update.counts
+                if counts != previous:
+                    yield {"data": json.dumps({"audiobook_id": audiobook_id, **counts})}
+                    previous = counts
+                # If no more work to do, stop streaming
+                if counts["pending"] == 0 and counts["in_progress"] == 0:
+                    break
     except asyncio.CancelledError:
         # Handle client disconnection gracefully
         pass
@@ -699,16 +1216,25 @@ async def generate_progress_events(audiobook_id: int, db: Session):
 @app.get("/api/audiobooks/{audiobook_id}/generation_progress")
 async def get_generation_progress(
     audiobook_id: int,
-    db: Session = Depends(get_db)
+    pieces: bool = False,
+    last_event_id: Optional[str] = Header(None),
+    sessionmaker: sessionmaker = Depends(get_sessionmaker)
 ):
-    """SSE endpoint for monitoring audiobook generation progress"""
+    """SSE endpoint for monitoring audiobook generation progress.
+
+    Pass pieces=true to also get an event for each content piece as it's
+    performed. Reconnecting with Last-Event-ID resumes those after the last
+    one the client saw. One that isn't a number is ignored, as if the
+    client were connecting for the first time."""
     # Verify audiobook exists
-    audiobook = db.query(models.Audiobook).filter_by(id=audiobook_id).first()
+    with sessionmaker() as session:
+        audiobook = session.get(models.Audiobook, audiobook_id)
     if not audiobook:
         raise HTTPException(status_code=404, detail="Audiobook not found")
 
     return EventSourceResponse(
-        generate_progress_events(audiobook_id, db),
+        generate_progress_events(audiobook_id, sessionmaker, pieces=pieces,
+                                 last_event_id=int(last_event_id) if re.fullmatch(r"[0-9]+", last_event_id or "") else None),
     )
 
 ok_event = Event()
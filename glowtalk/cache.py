@@ -0,0 +1,104 @@
+import hashlib
+import os
+import re
+import threading
+from pathlib import Path
+
+_KEY_PATTERN = re.compile(r"[0-9A-Za-z_-]+")
+
+class ContentCache:
+    """A size-bounded cache of files on disk, which survives restarts.
+
+    Entries live in namespaces (e.g. reference voices, voice conditioning),
+    and are named by a key. Each file's name includes the sha256 of its
+    contents, which is checked whenever it's read, so a truncated or corrupt
+    entry is dropped rather than used. When the key *is* the sha256 of the
+    contents, as it is for reference voices, the file is just named by it.
+
+    When the cache grows past max_bytes, the least recently used entries are
+    deleted.
+    """
+
+    def __init__(self, directory: Path, max_bytes: int = 2 * 1024 ** 3):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+    def get(self, namespace: str, key: str) -> Path | None:
+        """The path to a verified copy of the entry, or None if we don't have one."""
+        if not _KEY_PATTERN.fullmatch(key):
+            return None
+        namespace_dir = self.directory / namespace
+        candidates = [namespace_dir / key, *namespace_dir.glob(f"{key}.*")]
+        for path in candidates:
+            digest = key if path.name == key else path.name[len(key) + 1:]
+            try:
+                data = path.read_bytes()
+            except OSError:
+                continue
+            if hashlib.sha256(data).hexdigest() != digest:
+                self._remove(path)
+                continue
+            try:
+                # Mark it as recently used
+                os.utime(path)
+            except OSError:
+                pass
+            return path
+        return None
+
+    def read(self, namespace: str, key: str) -> bytes | None:
+        path = self.get(namespace, key)
+        if path is None:
+            return None
+        try:
+            return path.read_bytes()
+        except OSError:
+            return None
+
+    def put(self, namespace: str, key: str, data: bytes) -> Path:
+        """Store data under key, replacing any older entry, and return its path.
+
+        Raises OSError if the cache directory isn't writable."""
+        if not _KEY_PATTERN.fullmatch(key):
+            raise ValueError(f"Invalid cache key: {key!r}")
+        digest = hashlib.sha256(data).hexdigest()
+        namespace_dir = self.directory / namespace
+        namespace_dir.mkdir(parents=True, exist_ok=True)
+        path = namespace_dir / (key if key == digest else f"{key}.{digest}")
+        for stale in namespace_dir.glob(f"{key}.*"):
+            if stale != path:
+                self._remove(stale)
+
+        partial_path = namespace_dir / f".{path.name}.{os.getpid()}.{threading.get_ident()}.partial"
+        partial_path.write_bytes(data)
+        os.replace(partial_path, path)
+        self.evict(keep=path)
+        return path
+
+    def evict(self, keep: Path | None = None):
+        """Delete least recently used entries until we're within max_bytes."""
+        with self.lock:
+            entries = []
+            for path in self.directory.glob("*/*"):
+                if path.name.startswith("."):
+                    continue
+                try:
+                    stat = path.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries, key=lambda entry: entry[0]):
+                if total <= self.max_bytes:
+                    break
+                if path == keep:
+                    continue
+                self._remove(path)
+                total -= size
+
+    def _remove(self, path: Path):
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
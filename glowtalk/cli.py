@@ -1,15 +1,21 @@
 from glowtalk.api import app
 import httpx
 import argparse
+from pathlib import Path
 
 def server_mode(host: str, port: int):
     from glowtalk.server import start_server
     start_server(host=host, port=port)
 
-def worker_mode(url: str, verbose: bool, idle_threshold_seconds: int):
+def worker_mode(url: str, verbose: bool, idle_threshold_seconds: int, batch_size: int, lease_seconds: int,
+                cache_dir: Path | None, cache_max_mb: int, processes: int, threads_per_process: int | None,
+                upload_format: str):
     from glowtalk.worker import Worker
     client = httpx.Client(base_url=url)
-    my_worker = Worker(client, verbose=verbose, idle_threshold_seconds=idle_threshold_seconds)
+    my_worker = Worker(client, verbose=verbose, idle_threshold_seconds=idle_threshold_seconds, batch_size=batch_size,
+                       lease_seconds=lease_seconds, cache_dir=cache_dir,
+                       cache_max_bytes=cache_max_mb * 1024 * 1024, processes=processes,
+                       threads_per_process=threads_per_process, upload_format=upload_format)
     my_worker.work()
 
 def main():
@@ -19,11 +25,20 @@ def main():
     parser.add_argument('--work_for', help='URL of GlowTalk server to work for')
     parser.add_argument('--quiet', action='store_true', help='Disable verbose output')
     parser.add_argument('--idle_threshold', type=int, default=30, help='How long to wait for the system to be unused by any person before doing intensive work.')
+    parser.add_argument('--batch_size', type=int, default=8, help='How many sentences a worker takes from the server at a time.')
+    parser.add_argument('--lease_seconds', type=int, default=120, help='How long the server should wait to hear from a worker before giving its sentences to another worker.')
+    parser.add_argument('--cache_dir', type=Path, help='Where a worker keeps things worth reusing between runs, like reference voices and their conditioning. Defaults to ~/.cache/glowtalk')
+    parser.add_argument('--cache_max_mb', type=int, default=2048, help='How large the worker cache may grow before old entries are deleted.')
+    parser.add_argument('--processes', type=int, default=1, help='How many sentences a worker synthesizes at once, each in its own process with its own copy of the model. Useful on CPU-only machines with many cores.')
+    parser.add_argument('--threads_per_process', type=int, help='How many threads each synthesis process may use. Defaults to an equal share of the cores.')
+    parser.add_argument('--upload_format', choices=['flac', 'opus', 'wav'], default='flac', help='How a worker encodes the performances it uploads. FLAC is lossless, Opus is much smaller but lossy.')
 
     args = parser.parse_args()
 
     if args.work_for:
-        worker_mode(args.work_for, not args.quiet, args.idle_threshold)
+        worker_mode(args.work_for, not args.quiet, args.idle_threshold, args.batch_size, args.lease_seconds,
+                    args.cache_dir, args.cache_max_mb, args.processes, args.threads_per_process,
+                    args.upload_format)
     else:
         server_mode(args.host, args.port)
 
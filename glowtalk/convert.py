@@ -1,7 +1,13 @@
+import io
+import os
+import tempfile
+import uuid
 import soundfile as sf
 import subprocess
+import threading
 from pathlib import Path
-from typing import List, Iterator
+from typing import BinaryIO, Callable, Iterable, List, Iterator, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import numpy as np
 import itertools
 
@@ -15,12 +21,350 @@ def stream_wav_chunks(wav_files: Iterator[Path], chunk_size: int = 8192) -> Iter
                     break
                 yield chunk
 
-def combine_wav_to_mp3(wav_files: Iterator[Path], output_mp3_path: Path) -> None:
-    """Combine multiple WAV files into a single MP3 file using streaming."""
-    if not wav_files:
-        raise ValueError("No input files provided")
+def _decibels_to_amplitude(decibels: float) -> float:
+    return 10 ** (decibels / 20)
+
+class AudioShaping:
+    """How sentences are evened out as they're joined into a book.
+
+    Each sentence has its leading and trailing silence trimmed, and is
+    scaled so that it's about as loud as every other sentence, whichever
+    voice it's in. Then sentence_pause seconds of silence are put after it.
+    A stretch of audio that starts a part gets leading_pause seconds of
+    silence first; see for_part_start.
+    """
+
+    def __init__(self, target_dbfs: float = -20.0, max_gain_db: float = 20.0, silence_dbfs: float = -50.0,
+                 sentence_pause: float = 0.3, part_pause: float = 1.0, leading_pause: float = 0.0):
+        # How loud each sentence should be, as RMS relative to full scale
+        self.target_dbfs = target_dbfs
+        # The most we'll amplify a quiet sentence, so we don't turn noise up
+        self.max_gain_db = max_gain_db
+        # Anything quieter than this, at either end of a sentence, is trimmed
+        self.silence_dbfs = silence_dbfs
+        self.sentence_pause = sentence_pause
+        self.part_pause = part_pause
+        self.leading_pause = leading_pause
+
+    def for_part_start(self) -> "AudioShaping":
+        """This shaping, for audio that starts a part, and so is preceded by
+        the pause between parts."""
+        return AudioShaping(self.target_dbfs, self.max_gain_db, self.silence_dbfs,
+                            self.sentence_pause, self.part_pause, leading_pause=self.part_pause)
+
+    def key(self) -> str:
+        """Identifies the shaping, for naming files made with it."""
+        return "shaped:" + ",".join(str(setting) for setting in [
+            self.target_dbfs, self.max_gain_db, self.silence_dbfs,
+            self.sentence_pause, self.part_pause, self.leading_pause,
+        ])
+
+DEFAULT_SHAPING = AudioShaping()
+
+def _measure_sentence(f: sf.SoundFile, silence_threshold: float, chunk_size: int) -> Tuple[int, int, float, float]:
+    """Find the (start, end) frames of the audible part of a sentence, the
+    sum of the squares of its samples, and its peak."""
+    start = None
+    end = 0
+    sum_of_squares = 0.0
+    peak = 0.0
+    position = 0
+    for chunk in f.blocks(blocksize=chunk_size, dtype='float32', always_2d=True):
+        magnitudes = np.abs(chunk).max(axis=1)
+        audible = np.flatnonzero(magnitudes > silence_threshold)
+        if len(audible):
+            if start is None:
+                start = position + audible[0]
+            end = position + audible[-1] + 1
+        peak = max(peak, float(magnitudes.max(initial=0.0)))
+        # Silence adds next to nothing to this, so we needn't leave it out
+        sum_of_squares += float(np.dot(chunk.ravel(), chunk.ravel()))
+        position += len(chunk)
+    if start is None:
+        return 0, 0, 0.0, 0.0
+    return int(start), int(end), sum_of_squares, peak
+
+def shape_chunks(wav_files: Iterable[Path], shaping: AudioShaping, chunk_size: int = 8192) -> Iterator[np.ndarray]:
+    """Stream audio from audio files in chunks, like stream_wav_chunks, but
+    shaped as described by shaping.
+
+    Each file is read twice, a chunk at a time: once to measure it, and
+    again to scale the part worth keeping. So memory use doesn't depend on
+    how long the files are. Chunks are (frames, channels) arrays."""
+    silence_threshold = _decibels_to_amplitude(shaping.silence_dbfs)
+    target_rms = _decibels_to_amplitude(shaping.target_dbfs)
+    max_gain = _decibels_to_amplitude(shaping.max_gain_db)
+    first = True
+    for wav_file in wav_files:
+        with sf.SoundFile(wav_file) as f:
+            sample_rate = f.samplerate
+            channels = f.channels
+            if first and shaping.leading_pause:
+                yield np.zeros((round(shaping.leading_pause * sample_rate), channels), dtype=np.float32)
+            first = False
+
+            start, end, sum_of_squares, peak = _measure_sentence(f, silence_threshold, chunk_size)
+            if end > start:
+                rms = np.sqrt(sum_of_squares / ((end - start) * channels))
+                # Never so much that it clips
+                gain = np.float32(min(target_rms / rms, max_gain, 0.999 / peak))
+                f.seek(start)
+                remaining = end - start
+                while remaining > 0:
+                    chunk = f.read(min(chunk_size, remaining), dtype='float32', always_2d=True)
+                    if not len(chunk):
+                        break
+                    remaining -= len(chunk)
+                    chunk *= gain
+                    yield chunk
+        if shaping.sentence_pause:
+            yield np.zeros((round(shaping.sentence_pause * sample_rate), channels), dtype=np.float32)
+
+def audio_chunks(wav_files: Iterable[Path], shaping: Optional[AudioShaping] = None) -> Iterator[np.ndarray]:
+    """Stream audio from audio files in chunks, shaped if shaping is given."""
+    if shaping is None:
+        return stream_wav_chunks(wav_files)
+    return shape_chunks(wav_files, shaping)
+
+# The encodings a performance can be uploaded and stored in:
+# name -> (soundfile format, soundfile subtype, file suffix, media type)
+AUDIO_FORMATS = {
+    "wav": ("WAV", "FLOAT", ".wav", "audio/wav"),
+    # Lossless, and about a third the size of a float WAV
+    "flac": ("FLAC", "PCM_24", ".flac", "audio/flac"),
+    # Lossy, but a tenth the size again, for workers on slow connections
+    "opus": ("OGG", "OPUS", ".opus", "audio/ogg"),
+}
+
+MEDIA_TYPES = {suffix: media_type for _, _, suffix, media_type in AUDIO_FORMATS.values()}
+MEDIA_TYPES[".mp3"] = "audio/mpeg"
+
+def encode_audio(audio: np.ndarray, sample_rate: int, audio_format: str = "wav") -> bytes:
+    """Encode an in-memory performance as a file in one of AUDIO_FORMATS."""
+    format, subtype, _, _ = AUDIO_FORMATS[audio_format]
+    buffer = io.BytesIO()
+    sf.write(buffer, audio, sample_rate, format=format, subtype=subtype)
+    return buffer.getvalue()
+
+def encode_wav(audio: np.ndarray, sample_rate: int) -> bytes:
+    """Encode an in-memory performance as a 32-bit float WAV file."""
+    return encode_audio(audio, sample_rate, "wav")
+
+def audio_suffix(header: bytes) -> str:
+    """The file suffix for an encoded performance, from its first few bytes."""
+    if header.startswith(b"fLaC"):
+        return ".flac"
+    if header.startswith(b"OggS"):
+        return ".opus"
+    return ".wav"
+
+# Subtypes we take in uploads besides the ones in AUDIO_FORMATS: older
+# workers upload the 16-bit WAVs their models wrote
+LEGACY_UPLOAD_SUBTYPES = {("WAV", "PCM_16")}
+
+def uploaded_audio_suffix(source: BinaryIO) -> str:
+    """The file suffix for an uploaded performance, once libsndfile has
+    checked that it's in one of AUDIO_FORMATS, and not just something with
+    the right first few bytes. Leaves source where it was.
+
+    Raises ValueError if it isn't, or can't be read at all."""
+    position = source.tell()
+    try:
+        info = sf.info(source)
+    except RuntimeError as e:
+        raise ValueError(f"Can't read the audio: {e}")
+    finally:
+        source.seek(position)
+    for format, subtype, suffix, _ in AUDIO_FORMATS.values():
+        if info.format == format and (info.subtype == subtype or (info.format, info.subtype) in LEGACY_UPLOAD_SUBTYPES):
+            return suffix
+    raise ValueError(f"Can't take {info.format} audio in {info.subtype}, only "
+                     + ", ".join(f"{format} in {subtype}" for format, subtype, _, _ in AUDIO_FORMATS.values()))
+
+def audio_duration(path: Path) -> float:
+    """How many seconds long an audio file is, from its header."""
+    return sf.info(path).duration
+
+# MPEG audio versions, as in a frame header:
+# version bits -> (sample rates, layer III bitrates in kbps, samples per frame)
+_MPEG_VERSIONS = {
+    0b11: ((44100, 48000, 32000), (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320), 1152),
+    0b10: ((22050, 24000, 16000), (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160), 576),
+    0b00: ((11025, 12000, 8000), (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160), 576),
+}
+
+def mp3_frame_size(sample_rate: int) -> int:
+    """How many samples there are in each frame of an MP3 at sample_rate."""
+    for sample_rates, _, frame_size in _MPEG_VERSIONS.values():
+        if sample_rate in sample_rates:
+            return frame_size
+    raise ValueError(f"MP3 doesn't support a sample rate of {sample_rate}")
+
+def mp3_duration(path: Path) -> float:
+    """How many seconds of audio the frames of an MP3 file hold.
+
+    Unlike audio_duration, this counts every frame, so it includes the
+    encoder's delay and padding, which a Xing header would tell decoders to
+    leave out. Those stay in the audio when MP3s are joined by copying their
+    frames, so this is how long a joinable MP3 is in the file it's joined
+    into. It reads the frame headers, without decoding any audio."""
+    samples = 0
+    sample_rate = None
+    with open(path, "rb") as f:
+        header = f.read(10)
+        if header[:3] == b"ID3":
+            # An ID3v2 tag, whose size is in 7-bit bytes
+            size = (header[6] & 0x7f) << 21 | (header[7] & 0x7f) << 14 | (header[8] & 0x7f) << 7 | header[9] & 0x7f
+            f.seek(10 + size + (10 if header[5] & 0x10 else 0))
+        else:
+            f.seek(0)
+        first = True
+        while len(header := f.read(4)) == 4:
+            fields = int.from_bytes(header, "big")
+            version = fields >> 19 & 0b11
+            layer = fields >> 17 & 0b11
+            bitrate_index = fields >> 12 & 0b1111
+            sample_rate_index = fields >> 10 & 0b11
+            if (fields >> 21 != 0x7ff or version not in _MPEG_VERSIONS or layer != 0b01
+                    or bitrate_index in (0, 0b1111) or sample_rate_index == 0b11):
+                # Not a layer III frame, so the end of the audio
+                break
+            sample_rates, bitrates, frame_size = _MPEG_VERSIONS[version]
+            sample_rate = sample_rates[sample_rate_index]
+            frame_length = frame_size // 8 * bitrates[bitrate_index] * 1000 // sample_rate + (fields >> 9 & 1)
+            body = f.read(frame_length - 4)
+            # A Xing header is in a frame of its own at the start, which
+            # isn't audio
+            if not (first and (b"Xing" in body[:40] or b"Info" in body[:40])):
+                samples += frame_size
+            first = False
+    return samples / sample_rate if sample_rate else 0.0
+
+def decode_to_wav(source: Path, output_wav_path: Path) -> None:
+    """Decode a FLAC or Opus performance into a 32-bit float WAV file."""
+    audio, sample_rate = sf.read(source, dtype="float32")
+    output_wav_path.parent.mkdir(parents=True, exist_ok=True)
+    partial_path = output_wav_path.with_name(f".{uuid.uuid4()}.partial")
+    try:
+        sf.write(partial_path, audio, sample_rate, format='WAV', subtype='FLOAT')
+        os.replace(partial_path, output_wav_path)
+    finally:
+        partial_path.unlink(missing_ok=True)
+
+# The formats we can stream a book in:
+# name -> (ffmpeg output arguments, media type)
+STREAM_FORMATS = {
+    "mp3": (['-c:a', 'libmp3lame', '-q:a', '2', '-f', 'mp3'], "audio/mpeg"),
+    "opus": (['-c:a', 'libopus', '-b:a', '64k', '-f', 'ogg'], "audio/ogg"),
+}
+
+def stream_audio(parts: Iterable[Iterable[Path]], stream_format: str = "mp3", chunk_size: int = 64 * 1024,
+                 shaping: Optional[AudioShaping] = None) -> Iterator[bytes]:
+    """Encode the audio files of each part, one after another, into a single
+    continuous stream, yielding it as it's encoded.
+
+    The parts are taken from parts as they're needed, and their files read
+    lazily, a chunk at a time, and fed to one ffmpeg process, so there are
+    no gaps between them and memory use doesn't grow with the length of the
+    book. With shaping, each part starts with the pause between parts.
+    Closing the generator stops ffmpeg, and closes parts if it's a
+    generator."""
+    output_args, _ = STREAM_FORMATS[stream_format]
+    parts = iter(parts)
+    # The first file tells ffmpeg what its input is
+    for first_part in parts:
+        first_part = list(first_part)
+        if first_part:
+            break
+    else:
+        return
+    with sf.SoundFile(first_part[0]) as f:
+        sample_rate = f.samplerate
+        channels = f.channels
+
+    cmd = [
+        'ffmpeg',
+        '-loglevel', 'error',
+        '-f', 'f32le',
+        '-ar', str(sample_rate),
+        '-ac', str(channels),
+        '-i', '-',
+        *output_args,
+        '-',
+    ]
+    process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    # ffmpeg's input is written from another thread, so it never waits on
+    # whoever is reading its output.
+    def feed():
+        try:
+            for part_files in itertools.chain([first_part], parts):
+                part_shaping = shaping.for_part_start() if shaping is not None else None
+                for chunk in audio_chunks(part_files, part_shaping):
+                    process.stdin.write(chunk.astype(np.float32).tobytes())
+        except (BrokenPipeError, ValueError):
+            # ffmpeg was stopped, because the stream was closed
+            pass
+        finally:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+            if hasattr(parts, "close"):
+                parts.close()
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+
+    try:
+        while chunk := process.stdout.read1(chunk_size):
+            yield chunk
+    finally:
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+        feeder.join()
+        process.stdout.close()
+
+# libmp3lame's frames always hold at least this many samples more than it
+# was given: its delay before the audio, and the padding after it
+LAME_OVERHEAD = 1152
+
+def _trim_for_frames(chunks: Iterable[np.ndarray], frame_size: int) -> Iterator[np.ndarray]:
+    """Pass chunks through, leaving out as much of the silence at the end as
+    libmp3lame's delay and padding will take the place of, so that the MP3's
+    frames hold no more audio than the chunks did (and at most a frame less).
+    Only exact silence, like the pause after a shaped sentence, is left out."""
+    # The most we might leave out
+    held = frame_size + LAME_OVERHEAD
+    tail = None
+    total = 0
+    for chunk in chunks:
+        total += len(chunk)
+        tail = chunk if tail is None else np.concatenate([tail, chunk])
+        if len(tail) > held:
+            yield tail[:-held]
+            tail = tail[-held:]
+    if tail is None:
+        return
+    # Ends the audio LAME_OVERHEAD before the last whole frame
+    drop = total % frame_size + LAME_OVERHEAD
+    if drop < len(tail) and not tail[-drop:].any():
+        tail = tail[:-drop]
+    yield tail
+
+def combine_wav_to_mp3(wav_files: Iterable[Path], output_mp3_path: Path, shaping: Optional[AudioShaping] = None,
+                       joinable: bool = False) -> None:
+    """Combine multiple WAV files into a single MP3 file using streaming,
+    shaping them along the way if shaping is given.
+
+    A joinable MP3 is made to be joined with others by concatenate_mp3s.
+    It has no Xing header, so every frame is played, and its frames start
+    with the encoder's delay and end with its padding in place of some of
+    the silence at the end of the audio. Then nothing is added where it's
+    joined to another, and its length is mp3_duration."""
+    wav_files = iter(wav_files)
     # Get audio properties from first file
-    first_file = next(wav_files)
+    first_file = next(wav_files, None)
     if first_file is None:
         raise ValueError(f"No input files provided to generate {output_mp3_path}")
     with sf.SoundFile(first_file) as f:
@@ -37,6 +381,7 @@ def combine_wav_to_mp3(wav_files: Iterator[Path], output_mp3_path: Path) -> None
         '-i', '-',              # Read from stdin
         '-c:a', 'libmp3lame',   # MP3 encoder
         '-q:a', '2',            # Quality setting (2 is high quality, 0 is highest)
+        *(['-write_xing', '0'] if joinable else []),
         str(output_mp3_path)
     ]
 
@@ -50,7 +395,10 @@ def combine_wav_to_mp3(wav_files: Iterator[Path], output_mp3_path: Path) -> None
 
     try:
         # Stream chunks to FFmpeg
-        for chunk in stream_wav_chunks(itertools.chain([first_file],    wav_files)):
+        chunks = audio_chunks(itertools.chain([first_file], wav_files), shaping)
+        if joinable:
+            chunks = _trim_for_frames(chunks, mp3_frame_size(sample_rate))
+        for chunk in chunks:
             chunk = chunk.astype(np.float32)
             process.stdin.write(chunk.tobytes())
 
@@ -68,6 +416,65 @@ def combine_wav_to_mp3(wav_files: Iterator[Path], output_mp3_path: Path) -> None
         process.wait(timeout=5)  # Give it 5 seconds to shut down gracefully
         raise e
 
+def combine_wavs_to_mp3s(jobs: List[Tuple[Iterable[Path], Path, Optional[AudioShaping]]], max_workers: Optional[int] = None,
+                         on_progress: Optional[Callable[[int, int], None]] = None, joinable: bool = False) -> None:
+    """Run several combine_wav_to_mp3 jobs at once, one per core.
+
+    Each job is (wav_files, output_mp3_path, shaping). libmp3lame only uses one core,
+    so a long book encodes much faster as many smaller chunks, which can be
+    joined afterwards with concatenate_mp3s. The encoding happens in ffmpeg
+    processes, so threads are all we need to keep them busy.
+
+    Each output is written to a temporary file and renamed into place, so an
+    output that exists is always complete. on_progress is called with
+    (jobs done, total jobs) as each job finishes. The outputs are joinable
+    if joinable is set, see combine_wav_to_mp3."""
+    def encode(wav_files: Iterable[Path], output_mp3_path: Path, shaping: Optional[AudioShaping]):
+        output_mp3_path.parent.mkdir(parents=True, exist_ok=True)
+        partial_path = output_mp3_path.with_name(f"{output_mp3_path.stem}.{uuid.uuid4()}.partial.mp3")
+        try:
+            combine_wav_to_mp3(wav_files, partial_path, shaping, joinable=joinable)
+            os.replace(partial_path, output_mp3_path)
+        finally:
+            partial_path.unlink(missing_ok=True)
+
+    with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+        futures = [executor.submit(encode, *job) for job in jobs]
+        for done, future in enumerate(as_completed(futures), start=1):
+            future.result()
+            if on_progress is not None:
+                on_progress(done, len(futures))
+
+def concatenate_mp3s(mp3_files: List[Path], output_mp3_path: Path) -> None:
+    """Join MP3 files into one, copying their frames rather than re-encoding them.
+
+    The files should be joinable (see combine_wav_to_mp3), or there's a gap
+    of the encoder's delay and padding wherever two are joined. Then the
+    result is as long as the sum of their mp3_durations, and the sound
+    carries on from one to the next."""
+    if not mp3_files:
+        raise ValueError(f"No input files provided to generate {output_mp3_path}")
+    with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False) as file_list:
+        for mp3_file in mp3_files:
+            # Quoting for ffmpeg's concat demuxer
+            quoted = str(Path(mp3_file).resolve()).replace("'", "'\\''")
+            file_list.write(f"file '{quoted}'\n")
+    try:
+        cmd = [
+            'ffmpeg',
+            '-y',                    # Overwrite output file if it exists
+            '-f', 'concat',          # Read the list of files to join
+            '-safe', '0',            # The files are given by absolute path
+            '-i', file_list.name,
+            '-c', 'copy',            # Don't re-encode
+            str(output_mp3_path)
+        ]
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if result.returncode != 0:
+            raise RuntimeError(f"FFmpeg error: {result.stderr.decode()}")
+    finally:
+        os.unlink(file_list.name)
+
 if __name__ == "__main__":
     def gen():
         yield Path("outputs/output 42.wav")
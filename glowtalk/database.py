@@ -1,11 +1,55 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from .models import Base
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session, sessionmaker
+from .models import Base, WorkQueueCounter
 from pathlib import Path
 
 def init_db(db_path="sqlite:///audiobooks.db", run_migrations=True):
     """Initialize the database and optionally run migrations"""
     engine = create_engine(db_path)
+    if engine.dialect.name == "sqlite":
+        event.listen(engine, "connect", _configure_sqlite_connection)
+    had_queue_counters = inspect(engine).has_table(WorkQueueCounter.__tablename__)
     # Create all tables
     Base.metadata.create_all(engine)
+    if run_migrations:
+        migrate(engine, rebuild_queue_counters=not had_queue_counters)
     return sessionmaker(bind=engine)
+
+def _configure_sqlite_connection(dbapi_connection, connection_record):
+    # Many workers claim and complete queue items at once. In WAL mode their
+    # writes don't block the readers behind the UI and progress streams.
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
+def migrate(engine: Engine, rebuild_queue_counters: bool = False):
+    """Bring a database made by an older version of glowtalk up to date.
+
+    create_all only creates tables that are missing entirely, so anything
+    added to an existing table since has to be added here.
+
+    The work queue's counters are counted afresh from the queue if
+    rebuild_queue_counters is set: when their table has just been made for
+    a database from before they existed, or if anything but glowtalk has
+    changed the queue."""
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+                column_type = column.type.compile(dialect=engine.dialect)
+                ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"
+                if column.server_default is not None:
+                    ddl += f" DEFAULT {column.server_default.arg}"
+                connection.execute(text(ddl))
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+    if rebuild_queue_counters:
+        with Session(engine) as session:
+            WorkQueueCounter.rebuild(session)
+            session.commit()
@@ -0,0 +1,131 @@
+"""Exporting audiobooks as MP3s, in the background.
+
+Encoding a long book takes minutes, which is too long to keep an HTTP request
+waiting. Instead the request starts an ExportJob, and the client can follow
+its progress and fetch the file once it's done. Likewise the segments of HLS
+playlists are encoded by a SegmentEncoder, and listed once they're ready.
+"""
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+from sqlalchemy.orm import sessionmaker
+from glowtalk import convert, models
+
+logger = logging.getLogger(__name__)
+
+
+class ExportJob:
+    """Exporting one audiobook's MP3."""
+
+    def __init__(self, audiobook_id: int, force: bool):
+        self.audiobook_id = audiobook_id
+        self.force = force
+        # pending, running, done or failed
+        self.status = "pending"
+        self.segments_done = 0
+        self.segments_total: Optional[int] = None
+        self.mp3_path: Optional[Path] = None
+        self.error: Optional[str] = None
+        self.created_at = datetime.utcnow()
+        self.lock = threading.Lock()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "failed")
+
+    def update(self, **changes):
+        with self.lock:
+            for name, value in changes.items():
+                setattr(self, name, value)
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return {
+                "audiobook_id": self.audiobook_id,
+                "status": self.status,
+                "segments_done": self.segments_done,
+                "segments_total": self.segments_total,
+                "error": self.error,
+            }
+
+
+class ExportManager:
+    """Runs export jobs on a few background threads.
+
+    There's at most one unfinished job per audiobook. Asking for an export
+    while one is underway gets the existing job, rather than starting a
+    second encode of the same book.
+    """
+
+    def __init__(self, max_workers: int = 1):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="export")
+        self.jobs: dict[int, ExportJob] = {}
+        self.lock = threading.Lock()
+
+    def get(self, audiobook_id: int) -> Optional[ExportJob]:
+        """The latest job for the audiobook, finished or not."""
+        with self.lock:
+            return self.jobs.get(audiobook_id)
+
+    def start(self, audiobook_id: int, sessionmaker: sessionmaker, force: bool = False) -> ExportJob:
+        """Start exporting the audiobook, unless we're already doing so."""
+        with self.lock:
+            job = self.jobs.get(audiobook_id)
+            if job is not None and not job.finished:
+                return job
+            job = ExportJob(audiobook_id, force)
+            self.jobs[audiobook_id] = job
+        self.executor.submit(self._run, job, sessionmaker)
+        return job
+
+    def _run(self, job: ExportJob, sessionmaker: sessionmaker):
+        job.update(status="running")
+        def on_progress(done: int, total: int):
+            job.update(segments_done=done, segments_total=total)
+        try:
+            with sessionmaker() as session:
+                audiobook = session.get(models.Audiobook, job.audiobook_id)
+                mp3_path = audiobook.generate_mp3(session, force=job.force, on_progress=on_progress)
+        except Exception as e:
+            logger.exception("Failed to export audiobook %s", job.audiobook_id)
+            job.update(status="failed", error=str(e))
+            return
+        job.update(status="done", mp3_path=mp3_path)
+
+
+class SegmentEncoder:
+    """Encodes joinable MP3 segments on background threads, one per core.
+
+    A segment that's already being encoded isn't started again, however
+    many times it's asked for.
+    """
+
+    def __init__(self, max_workers: Optional[int] = None):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers or os.cpu_count(), thread_name_prefix="segments")
+        self.encoding: set[Path] = set()
+        self.lock = threading.Lock()
+
+    def encode(self, jobs: list[tuple[list[Path], Path, convert.AudioShaping]]):
+        """Start encoding each (wav_files, segment_path, shaping) job, unless
+        we're already doing so."""
+        for job in jobs:
+            _, segment_path, _ = job
+            with self.lock:
+                if segment_path in self.encoding:
+                    continue
+                self.encoding.add(segment_path)
+            self.executor.submit(self._run, job)
+
+    def _run(self, job: tuple[list[Path], Path, convert.AudioShaping]):
+        _, segment_path, _ = job
+        try:
+            convert.combine_wavs_to_mp3s([job], max_workers=1, joinable=True)
+        except Exception:
+            logger.exception("Failed to encode segment %s", segment_path.name)
+        finally:
+            with self.lock:
+                self.encoding.discard(segment_path)
@@ -1,15 +1,18 @@
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, DateTime, UniqueConstraint, Enum, Table
-from sqlalchemy.orm import declarative_base, relationship
+from sqlalchemy import Column, Integer, Float, String, Boolean, ForeignKey, DateTime, UniqueConstraint, Enum, Table, Index, Select, select, insert, update, delete, bindparam, func, and_, or_, tuple_, case
+from sqlalchemy.orm import declarative_base, relationship, aliased, joinedload
 from sqlalchemy.ext.orderinglist import ordering_list
 from sqlalchemy.orm import Session
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 
 from datetime import datetime, timedelta
 import enum
+import functools
 import hashlib
 import os
 from pathlib import Path
-from typing import Optional, Iterator
-from glowtalk import convert
+from typing import Callable, Mapping, Optional, Iterator, Tuple
+from collections import Counter
+from glowtalk import convert, progress
 import time
 import uuid
 
@@ -71,6 +74,10 @@ class Part(Base):
         collection_class=ordering_list('position')
     )
 
+    __table_args__ = (
+        Index('ix_parts_work_position', 'original_work_id', 'position'),
+    )
+
 class ContentPiece(Base):
     __tablename__ = 'content_pieces'
 
@@ -85,6 +92,10 @@ class ContentPiece(Base):
     part = relationship("Part", back_populates="content_pieces")
     performances = relationship("VoicePerformance", back_populates="content_piece")
 
+    __table_args__ = (
+        Index('ix_content_pieces_part_position', 'part_id', 'position'),
+    )
+
     @classmethod
     def get_unvoiced(cls, session):
         """Get all content pieces that should be voiced but don't have a performance yet"""
@@ -169,78 +180,490 @@ class Audiobook(Base):
         """Get all the wav files for this audiobook"""
         return (Path(performance.audio_file_path) for performance in self.get_performances(session))
 
+    def select_resolved_pieces(self) -> Select:
+        """Select every content piece in this audiobook, in reading order.
+
+        Each row is (Part, ContentPiece, speaker_id, VoicePerformance). The
+        speaker is resolved like ContentPiece.get_speaker_for_audiobook: the
+        piece's character voice, then the part's character voice, then our
+        default speaker. The performance is that speaker's latest take on the
+        piece, or None if the piece isn't voiced or hasn't been performed yet.
+
+        This is all done in SQL, so the whole work costs one query rather than
+        a few per content piece.
+        """
+        piece_voice = aliased(CharacterVoice)
+        part_voice = aliased(CharacterVoice)
+        speaker_id = func.coalesce(
+            piece_voice.speaker_id,
+            part_voice.speaker_id,
+            self.default_speaker_id,
+        )
+        # TODO: need to account for an audiobook's preferred performance
+        candidate = aliased(VoicePerformance)
+        latest_performance_id = select(candidate.id)\
+            .where(
+                candidate.content_piece_id == ContentPiece.id,
+                candidate.speaker_id == speaker_id,
+            )\
+            .order_by(candidate.generation_date.desc(), candidate.id.desc())\
+            .limit(1)\
+            .scalar_subquery()
+        return select(Part, ContentPiece, speaker_id.label("speaker_id"), VoicePerformance)\
+            .join(ContentPiece, ContentPiece.part_id == Part.id)\
+            .outerjoin(piece_voice, and_(
+                piece_voice.audiobook_id == self.id,
+                piece_voice.character_name == ContentPiece.character,
+            ))\
+            .outerjoin(part_voice, and_(
+                part_voice.audiobook_id == self.id,
+                part_voice.character_name == Part.character,
+            ))\
+            .outerjoin(VoicePerformance, and_(
+                ContentPiece.should_voice == True,
+                VoicePerformance.id == latest_performance_id,
+            ))\
+            .where(Part.original_work_id == self.original_work_id)\
+            .order_by(Part.position, Part.id, ContentPiece.position, ContentPiece.id)
+
+    def resolve_content_pieces(self, session: Session, yield_per: int = 1000) -> Iterator[Tuple['Part', 'ContentPiece', Optional[int], Optional['VoicePerformance']]]:
+        """Stream (part, content_piece, speaker_id, performance) for every
+        content piece in this audiobook, in reading order.
+
+        See select_resolved_pieces for how speakers and performances are
+        chosen."""
+        yield from session.execute(
+            self.select_resolved_pieces().execution_options(yield_per=yield_per)
+        )
+
+    def resolve_parts(self, session: Session, after: Optional[Tuple[int, int]] = None, skip: int = 0,
+                      limit: Optional[int] = None, first_window: int = 10,
+                      max_window: int = 200) -> Iterator[Tuple['Part', list[Tuple['ContentPiece', Optional['VoicePerformance']]]]]:
+        """Stream each of our parts with its content pieces and their
+        performances, in reading order, like resolve_content_pieces.
+
+        Parts are fetched in windows, each starting after the last part of
+        the one before by (position, id), so each window is a quick range
+        scan of the parts index however far into the work it is, followed
+        by one query for the window's content pieces. The first window is
+        small so the first parts arrive quickly, and they grow from there.
+
+        Starts after the part with the (position, id) after, if given, then
+        skips skip parts, and stops after limit parts."""
+        window = first_window
+        while limit is None or limit > 0:
+            if limit is not None:
+                window = min(window, limit)
+            parts_query = select(Part)\
+                .where(Part.original_work_id == self.original_work_id)\
+                .order_by(Part.position, Part.id)\
+                .offset(skip)\
+                .limit(window)
+            skip = 0
+            if after is not None:
+                parts_query = parts_query.where(tuple_(Part.position, Part.id) > tuple_(*after))
+            parts = session.scalars(parts_query).all()
+            if not parts:
+                return
+            pieces: dict[int, list[Tuple[ContentPiece, Optional[VoicePerformance]]]] = {part.id: [] for part in parts}
+            resolved = self.select_resolved_pieces().where(Part.id.in_(pieces.keys()))
+            for part, content_piece, _, performance in session.execute(resolved):
+                pieces[part.id].append((content_piece, performance))
+            for part in parts:
+                yield part, pieces[part.id]
+            if len(parts) < window:
+                return
+            if limit is not None:
+                limit -= len(parts)
+            after = (parts[-1].position, parts[-1].id)
+            window = min(window * 2, max_window)
+
+    def get_table_of_contents(self, session: Session) -> list:
+        """Each of our parts, in reading order, with how many of its content
+        pieces are voiced and how many of those have been performed.
+
+        Rows have the part's id, position, character, screenname and author,
+        then the voiced and rendered counts. Counted in one grouped query."""
+        resolved = self.select_resolved_pieces()
+        return session.execute(
+            resolved
+            .with_only_columns(
+                Part.id,
+                Part.position,
+                Part.character,
+                Part.screenname,
+                Part.author,
+                func.count(case((ContentPiece.should_voice == True, 1))).label("voiced"),
+                func.count(VoicePerformance.id).label("rendered"),
+            )
+            .group_by(Part.id)
+            .order_by(None)
+            .order_by(Part.position, Part.id)
+        ).all()
+
+    def get_newest_performance_id(self, session: Session) -> int:
+        """The id of the newest performance for us, or 0 if there aren't any.
+        Pieces rendered after it are get_rendered_since it."""
+        return session.scalar(
+            select(func.max(VoicePerformance.id)).where(VoicePerformance.audiobook_id == self.id)
+        ) or 0
+
+    def get_rendered_since(self, session: Session, voice_performance_id: int) -> list[progress.RenderedPiece]:
+        """The pieces performed for us after the given performance, oldest
+        first. For catching a progress stream up after a reconnect."""
+        rows = session.execute(
+            select(VoicePerformance.id, VoicePerformance.content_piece_id, VoicePerformance.audio_file_hash)
+            .where(VoicePerformance.audiobook_id == self.id, VoicePerformance.id > voice_performance_id)
+            .order_by(VoicePerformance.id)
+        )
+        return [progress.RenderedPiece(*row) for row in rows]
+
     def get_performances(self, session: Session) -> Iterator['VoicePerformance']:
-        # Inefficient, but it's a start. Go through each content piece in each
-        # part, determine our preferred speaker, and get the audio file path
-        # for it
-        original_work = self.original_work
-        for part in original_work.parts:
-            for content_piece in part.content_pieces:
+        for _, content_piece, _, performance in self.resolve_content_pieces(session):
+            if not content_piece.should_voice:
+                continue
+            if not performance:
+                raise ValueError(f"No performance found for content piece {content_piece.text} (id {content_piece.id})")
+            yield performance
+
+    def get_performances_from(self, session: Session, part_index: int = 0, offset: int = 0) -> Iterator[Tuple['Part', 'VoicePerformance']]:
+        """Our performances in reading order, each with its part, starting
+        with the part at part_index (counting from 0), skipping its first
+        offset voiced content pieces.
+
+        Stops at the first voiced content piece that hasn't been performed
+        yet, so that what's yielded can be played without gaps. Parts are
+        fetched as they're needed, see resolve_parts."""
+        skipped = 0
+        for index, (part, pieces) in enumerate(self.resolve_parts(session, skip=part_index)):
+            for content_piece, performance in pieces:
                 if not content_piece.should_voice:
                     continue
-                performance = content_piece.get_performance_for_audiobook(session, self)
+                if index == 0 and skipped < offset:
+                    skipped += 1
+                    continue
                 if not performance:
-                    raise ValueError(f"No performance found for content piece {content_piece.text} (id {content_piece.id})")
-                yield performance
-
-    def add_work_queue_items(self, session: Session):
-        # Get all content pieces that need voicing.
-        # We want to search for content pieces that are part of the original
-        # work for this audiobook, and that should be voiced.
-        should_voice = session.query(ContentPiece)\
-            .join(Part)\
-            .join(OriginalWork)\
-            .filter(
-                ContentPiece.should_voice == True,
-                ContentPiece.part_id == Part.id,
-                OriginalWork.id == self.original_work_id,
+                    return
+                yield part, performance
+
+    def add_work_queue_items(self, session: Session) -> int:
+        """Queue every voiced content piece that hasn't been performed by its
+        speaker and isn't already queued for that speaker.
+
+        Finds the missing (content piece, speaker) pairs with one anti-join
+        and adds them with one bulk insert, so this costs the same handful
+        of queries however large the work is. Pieces that have no speaker
+        (no character voice and no default speaker) are skipped.
+
+        Returns the number of work queue items added.
+        """
+        resolved = self.select_resolved_pieces()
+        speaker_id = resolved.selected_columns.speaker_id
+        already_queued = select(WorkQueue.id)\
+            .where(
+                WorkQueue.content_piece_id == ContentPiece.id,
+                WorkQueue.speaker_id == speaker_id,
             )\
-            .all()
-
-        # Add them to the work queue
-        added_count = 0
-        for piece in should_voice:
-            speaker = piece.get_speaker_for_audiobook(session, self)
-            # Does this speaker already have a performance for this content piece?
-            existing_performance = session.query(VoicePerformance)\
-                .filter(VoicePerformance.speaker_id == speaker.id, VoicePerformance.content_piece_id == piece.id)\
-                .first()
-            if existing_performance:
-                continue
-            # Do we already have a work queue item for this content piece and speaker?
-            existing_queue_item = session.query(WorkQueue)\
-                .filter(WorkQueue.content_piece_id == piece.id, WorkQueue.speaker_id == speaker.id)\
-                .first()
-            if existing_queue_item:
-                continue
-            # Add the work queue item
-            queue_item = WorkQueue(
-                content_piece_id=piece.id,
+            .exists()
+        missing = resolved\
+            .with_only_columns(ContentPiece.id, speaker_id)\
+            .where(
+                ContentPiece.should_voice == True,
+                speaker_id != None,
+                VoicePerformance.id == None,
+                ~already_queued,
+            )
+        rows = [
+            dict(
+                content_piece_id=content_piece_id,
                 audiobook_id=self.id,
-                speaker_id=speaker.id,
-                priority=10
+                speaker_id=speaker_id,
+                priority=10,
             )
-            session.add(queue_item)
-            added_count += 1
+            for content_piece_id, speaker_id in session.execute(missing)
+        ]
+        if rows:
+            session.execute(insert(WorkQueue), rows)
+            WorkQueueCounter.add(session, self.id, {'pending': len(rows)})
         session.commit()
-        return added_count
-
-    def generate_mp3(self, session: Session):
-        """Generate an MP3 file for this audiobook"""
-        filename = str(uuid.uuid4()) + ".mp3"
-        output_path = Path(os.getcwd()) / "outputs" / filename
-        output_path = output_path.resolve()
-        wav_files = self.get_wav_files(session)
-        convert.combine_wav_to_mp3(wav_files, output_path)
+        if rows:
+            progress.hub.publish(self.id, {'pending': len(rows)})
+        return len(rows)
+
+    # The most sentences we'll encode into a single MP3 segment
+    MAX_SEGMENT_SENTENCES = 20
+
+    def get_mp3_segments(self, session: Session) -> list[list['VoicePerformance']]:
+        """Split our performances into the segments that generate_mp3 encodes
+        separately: each part's performances, in runs of at most
+        MAX_SEGMENT_SENTENCES.
+
+        Raises ValueError if any voiced content piece hasn't been performed."""
+        segments, _ = self._split_into_segments(session, stop_at_missing=False)
+        return [performances for _, performances in segments]
+
+    def get_performed_mp3_segments(self, session: Session, after_content_piece_id: Optional[int] = None) -> Tuple[list[Tuple[bool, list['VoicePerformance']]], bool]:
+        """The segments we can make so far, like get_mp3_segments, each with
+        whether it starts a part, and whether they're the whole book.
+
+        Stops at the first voiced content piece that hasn't been performed,
+        leaving out the segment it would be in, so every segment returned
+        is final. The segments only ever grow as the book is rendered.
+
+        With after_content_piece_id, only the content pieces after that one
+        are split up, starting with the rest of its part. Raises LookupError
+        if it isn't one of ours."""
+        return self._split_into_segments(session, stop_at_missing=True, after_content_piece_id=after_content_piece_id)
+
+    def _split_into_segments(self, session: Session, stop_at_missing: bool,
+                             after_content_piece_id: Optional[int] = None) -> Tuple[list[Tuple[bool, list['VoicePerformance']]], bool]:
+        segments: list[Tuple[bool, list[VoicePerformance]]] = []
+        current_part_id = None
+        content_pieces = self.resolve_content_pieces(session)
+        if after_content_piece_id is not None:
+            for part, content_piece, _, _ in content_pieces:
+                if content_piece.id == after_content_piece_id:
+                    current_part_id = part.id
+                    break
+            else:
+                raise LookupError(f"Content piece {after_content_piece_id} isn't part of audiobook {self.id}")
+        for part, content_piece, _, performance in content_pieces:
+            if not content_piece.should_voice:
+                continue
+            if not performance:
+                if not stop_at_missing:
+                    raise ValueError(f"No performance found for content piece {content_piece.text} (id {content_piece.id})")
+                if segments and part.id == current_part_id and len(segments[-1][1]) < self.MAX_SEGMENT_SENTENCES:
+                    # This segment isn't finished yet
+                    segments.pop()
+                return segments, False
+            if part.id != current_part_id:
+                segments.append((True, []))
+                current_part_id = part.id
+            elif not segments or len(segments[-1][1]) >= self.MAX_SEGMENT_SENTENCES:
+                segments.append((False, []))
+            segments[-1][1].append(performance)
+        return segments, True
+
+    @staticmethod
+    def _hash_of(hashes: list[str]) -> str:
+        return hashlib.sha256("\n".join(hashes).encode()).hexdigest()
+
+    @staticmethod
+    def mp3_segment_shaping(starts_part: bool) -> convert.AudioShaping:
+        """How the sentences in a segment are evened out and spaced. Segments
+        that start a part begin with the pause between parts."""
+        if starts_part:
+            return convert.DEFAULT_SHAPING.for_part_start()
+        return convert.DEFAULT_SHAPING
+
+    @classmethod
+    def mp3_segment_path(cls, performances: list['VoicePerformance'], starts_part: bool) -> Path:
+        """Where the MP3 of a segment of performances is kept.
+
+        It's named by a hash of the performances in it and how they're
+        shaped, so it can be reused by any audiobook that has the same
+        performances."""
+        segment_hash = cls._hash_of([
+            # Segments from before they were joinable have gaps at their ends
+            "joinable",
+            cls.mp3_segment_shaping(starts_part).key(),
+            *(performance.audio_file_hash for performance in performances),
+        ])
+        return Path(os.getcwd()).resolve() / "outputs" / "segments" / f"{segment_hash}.mp3"
+
+    def _mp3_plan(self, session: Session) -> Tuple[Path, list[Tuple[Path, bool, list['VoicePerformance']]]]:
+        """Where our MP3 should be, and each of its segments with whether it
+        starts a part and the performances that go into it.
+
+        Everything is named by a hash of what's in it, so a stale MP3 is
+        noticed because it has the wrong name."""
+        segments, _ = self._split_into_segments(session, stop_at_missing=False)
+        planned = [
+            (self.mp3_segment_path(performances, starts_part), starts_part, performances)
+            for starts_part, performances in segments
+        ]
+        book_hash = self._hash_of([path.stem for path, _, _ in planned])
+        return Path(os.getcwd()).resolve() / "outputs" / "books" / f"{book_hash}.mp3", planned
+
+    def generate_mp3(self, session: Session, force: bool = False,
+                     on_progress: Optional[Callable[[int, int], None]] = None):
+        """Generate an MP3 file for this audiobook.
+
+        Only segments that we don't already have an MP3 of are encoded, and
+        the book is made by joining the segments' frames, without encoding
+        them again. So after re-rendering a sentence, this only has to encode
+        the segment it's in. With force, every segment is encoded again.
+
+        Segments are encoded in parallel, across all of our cores.
+        on_progress is called with (segments encoded, segments to encode) as
+        they finish."""
+        output_path, segments = self._mp3_plan(session)
+        convert.combine_wavs_to_mp3s([
+            (
+                [Path(performance.audio_file_path) for performance in performances],
+                segment_path,
+                self.mp3_segment_shaping(starts_part),
+            )
+            for segment_path, starts_part, performances in segments
+            if force or not segment_path.exists()
+        ], on_progress=on_progress, joinable=True)
+
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        partial_path = output_path.with_name(f"{output_path.stem}.{uuid.uuid4()}.partial.mp3")
+        convert.concatenate_mp3s([segment_path for segment_path, _, _ in segments], partial_path)
+        os.replace(partial_path, output_path)
+
+        previous_path = self.mp3_path
         self.mp3_path = str(output_path)
         session.add(self)
         session.commit()
+        if previous_path and previous_path != self.mp3_path:
+            still_used = session.query(Audiobook.id).filter(Audiobook.mp3_path == previous_path).first()
+            if not still_used:
+                Path(previous_path).unlink(missing_ok=True)
         return output_path
 
+    def get_current_mp3(self, session: Session) -> Optional[Path]:
+        """Our MP3, unless we don't have one or performances have changed since
+        it was made.
+
+        Raises ValueError if any voiced content piece hasn't been performed."""
+        output_path, _ = self._mp3_plan(session)
+        if self.mp3_path == str(output_path) and output_path.exists():
+            return output_path
+        return None
+
     def get_or_generate_mp3(self, session: Session):
-        if self.mp3_path:
-            return Path(self.mp3_path)
-        return self.generate_mp3(session)
+        """Our MP3, regenerated if any performances have changed since it was made."""
+        return self.get_current_mp3(session) or self.generate_mp3(session)
+
+    # How many segments past the end of an HLS playlist are encoded ahead
+    HLS_ENCODE_AHEAD = 4
+
+    def latest_hls_playlist(self, session: Session) -> int:
+        """The number of the newest of our HLS playlists, 0 if we haven't
+        listed anything yet."""
+        return session.scalar(
+            select(func.max(HlsSegment.playlist)).where(HlsSegment.audiobook_id == self.id)
+        ) or 0
+
+    def current_hls_playlist(self, session: Session) -> Tuple[int, list[Tuple[list[Path], Path, convert.AudioShaping]]]:
+        """The number of the HLS playlist to start listening to us with, and
+        the (wav_files, segment_path, shaping) of the segments to encode so
+        that it can grow. Commits.
+
+        Our playlists only ever grow, so once one doesn't match the book,
+        because sentences in it were rendered again or the work changed, a
+        new one is started when the book is done, to be the book as it is.
+        Players that are already listening carry on with the old one."""
+        playlist = self.latest_hls_playlist(session)
+        listed, to_encode, finished = self.extend_hls_playlist(session, playlist)
+        segments, complete = self.get_performed_mp3_segments(session)
+        listed_names = [segment.segment_name for segment in listed]
+        book_names = [self.mp3_segment_path(performances, starts_part).name for starts_part, performances in segments]
+        if finished:
+            stale = listed_names != book_names
+        else:
+            stale = complete and listed_names != book_names[:len(listed_names)]
+        if stale:
+            playlist += 1
+            _, more_to_encode, _ = self.extend_hls_playlist(session, playlist)
+            to_encode += more_to_encode
+        return playlist, to_encode
+
+    def extend_hls_playlist(self, session: Session, playlist: int) -> Tuple[list['HlsSegment'], list[Tuple[list[Path], Path, convert.AudioShaping]], bool]:
+        """The segments in one of our HLS playlists, the (wav_files,
+        segment_path, shaping) of the segments to encode so that it can
+        grow, and whether it's finished. Commits.
+
+        Performed segments are added to the end of the playlist once they've
+        been encoded, so it has how long each of them really is. A player may
+        have fetched any segment in the playlist, so each stays where it is
+        even if its sentences are rendered again, and the playlist carries
+        on from the content piece its last segment ends with. It's finished
+        once it reaches the end of the book, or if that content piece is no
+        longer in the work, and then it doesn't change again."""
+        listed = self._hls_segments(session, playlist)
+        if listed and listed[-1].ends_playlist:
+            return listed, [], True
+        try:
+            segments, complete = self.get_performed_mp3_segments(
+                session, after_content_piece_id=listed[-1].last_content_piece_id if listed else None)
+        except LookupError:
+            segments, complete = [], True
+        position = len(listed)
+        to_encode = []
+        for starts_part, performances in segments:
+            segment_path = self.mp3_segment_path(performances, starts_part)
+            if not to_encode and segment_path.exists():
+                added = session.execute(
+                    sqlite_insert(HlsSegment)
+                    .values(
+                        audiobook_id=self.id,
+                        playlist=playlist,
+                        position=position,
+                        segment_name=segment_path.name,
+                        duration=convert.mp3_duration(segment_path),
+                        last_content_piece_id=performances[-1].content_piece_id,
+                    )
+                    .on_conflict_do_nothing()
+                ).rowcount
+                if not added:
+                    # Another request listed it first, so go by what that listed
+                    complete = False
+                    break
+                position += 1
+            elif len(to_encode) >= self.HLS_ENCODE_AHEAD:
+                break
+            elif not segment_path.exists():
+                to_encode.append((
+                    [Path(performance.audio_file_path) for performance in performances],
+                    segment_path,
+                    self.mp3_segment_shaping(starts_part),
+                ))
+        finished = complete and position == len(listed) + len(segments) and position > 0
+        if finished:
+            session.execute(
+                update(HlsSegment)
+                .where(HlsSegment.audiobook_id == self.id, HlsSegment.playlist == playlist,
+                       HlsSegment.position == position - 1)
+                .values(ends_playlist=True)
+            )
+        session.commit()
+        return self._hls_segments(session, playlist), to_encode, finished
+
+    def find_hls_segment(self, session: Session, segment_name: str) -> Optional[Tuple[list[Path], Path, convert.AudioShaping]]:
+        """The (wav_files, segment_path, shaping) to encode the segment with
+        the given name in our HLS playlists again, if it's still what's
+        performed for its place in one of them."""
+        for segment in session.scalars(
+            select(HlsSegment).where(HlsSegment.audiobook_id == self.id, HlsSegment.segment_name == segment_name)
+        ).all():
+            previous = session.get(HlsSegment, (self.id, segment.playlist, segment.position - 1))
+            try:
+                segments, _ = self.get_performed_mp3_segments(
+                    session, after_content_piece_id=previous.last_content_piece_id if previous else None)
+            except LookupError:
+                continue
+            if not segments:
+                continue
+            starts_part, performances = segments[0]
+            segment_path = self.mp3_segment_path(performances, starts_part)
+            if segment_path.name == segment_name:
+                return (
+                    [Path(performance.audio_file_path) for performance in performances],
+                    segment_path,
+                    self.mp3_segment_shaping(starts_part),
+                )
+        return None
+
+    def _hls_segments(self, session: Session, playlist: int) -> list['HlsSegment']:
+        return session.scalars(
+            select(HlsSegment)
+            .where(HlsSegment.audiobook_id == self.id, HlsSegment.playlist == playlist)
+            .order_by(HlsSegment.position)
+        ).all()
 
 class VoicePerformance(Base):
     __tablename__ = 'voice_performances'
@@ -259,6 +682,11 @@ class VoicePerformance(Base):
     content_piece = relationship("ContentPiece", back_populates="performances")
     speaker = relationship("Speaker")
 
+    __table_args__ = (
+        # Backs the latest-performance lookup in Audiobook.select_resolved_pieces
+        Index('ix_voice_performances_piece_speaker_date', 'content_piece_id', 'speaker_id', 'generation_date'),
+    )
+
 
 class SpeakerModel(enum.Enum):
     XTTS_v2 = "tts_models/multilingual/multi-dataset/xtts_v2"
@@ -425,7 +853,10 @@ class WorkQueue(Base):
     started_at = Column(DateTime, nullable=True)
     completed_at = Column(DateTime, nullable=True)
     worker_id = Column(String, nullable=True)  # ID of the worker processing this item
+    lease_expires_at = Column(DateTime, nullable=True)  # When an in progress item may be given to another worker
     error_message = Column(String, nullable=True)
+    # How many times a worker finished this item after it was already completed
+    duplicate_completions = Column(Integer, nullable=False, default=0, server_default='0')
 
     # Relationships
     content_piece = relationship("ContentPiece")
@@ -433,56 +864,312 @@ class WorkQueue(Base):
     speaker = relationship("Speaker")
     created_voice_performance = relationship("VoicePerformance", foreign_keys=[created_voice_performance_id])
 
+    __table_args__ = (
+        # Backs the already-queued check in Audiobook.add_work_queue_items
+        Index('ix_work_queue_piece_speaker', 'content_piece_id', 'speaker_id'),
+        # Covers count_by_status for one audiobook, and rebuilding its counters
+        Index('ix_work_queue_audiobook_status', 'audiobook_id', 'status'),
+    )
+
+    # How long a worker may hold an item without a heartbeat before it's
+    # handed to someone else, unless the worker asks for something different.
+    DEFAULT_LEASE = timedelta(minutes=2)
+
     @classmethod
-    def assign_work_item(cls, session: Session, worker_id: str) -> Optional['WorkQueue']:
-        # Find the highest priority work item that is either:
-        # 1. pending, or
-        # 2. in progress but stale (started more than 2 minutes ago)
-        work_item = session.query(cls)\
-            .filter(
-                (cls.status == 'pending') |
-                (
-                    (cls.status == 'in_progress') &
-                    (cls.started_at < datetime.utcnow() - timedelta(minutes=2))
-                )
+    @functools.cache
+    def _reclaim_statement(cls):
+        """An UPDATE that puts in progress items whose lease has run out back
+        in the queue. Takes the now and unleased_stale_cutoff parameters."""
+        expired = or_(
+            cls.lease_expires_at < bindparam('now'),
+            # Items claimed before leases existed
+            and_(cls.lease_expires_at == None, cls.started_at < bindparam('unleased_stale_cutoff')),
+        )
+        return update(cls)\
+            .where(cls.status == 'in_progress', expired)\
+            .values(status='pending', worker_id=None, lease_expires_at=None)\
+            .returning(cls.audiobook_id)\
+            .execution_options(synchronize_session=False)
+
+    @classmethod
+    @functools.cache
+    def _claim_statement(cls):
+        """An UPDATE ... RETURNING that leases the next pending items and
+        returns their ids and audiobook ids.
+
+        It's a single statement, and SQLite only runs one writer at a time, so
+        by the time a second worker's UPDATE runs, its subquery no longer sees
+        the first worker's items as pending. Two workers can never be handed
+        the same item. Picking the items is a seek on ix_work_queue_claim, so
+        this stays cheap no matter how many items the queue has seen.
+
+        Takes the worker_id, now, lease_expires_at and limit parameters. Built
+        once, since constructing it costs more than running it.
+        """
+        next_items = select(cls.id)\
+            .where(cls.status == 'pending')\
+            .order_by(cls.priority.desc(), cls.created_at.asc())\
+            .limit(bindparam('limit'))
+        return update(cls)\
+            .where(cls.id.in_(next_items))\
+            .values(
+                worker_id=bindparam('worker_id'),
+                status='in_progress',
+                started_at=bindparam('now'),
+                lease_expires_at=bindparam('lease_expires_at'),
             )\
-            .order_by(cls.priority.desc(), cls.created_at.asc()).first()
-        if work_item is None:
-            # Try to take the highest priority in progress item then
-            work_item = session.query(cls)\
-                .filter(cls.status == 'in_progress')\
-                .order_by(cls.priority.desc(), cls.created_at.asc()).first()
-        if work_item is None:
-            return None
-        work_item.worker_id = worker_id
-        work_item.status = 'in_progress'
-        work_item.started_at = datetime.utcnow()
-        session.add(work_item)
+            .returning(cls.id, cls.audiobook_id)\
+            .execution_options(synchronize_session=False)
+
+    @classmethod
+    def reclaim_expired_leases(cls, session: Session) -> Counter:
+        """Put in progress items whose worker has stopped renewing its lease
+        back in the queue. Returns how many items were reclaimed from each
+        audiobook. The caller commits, and then publishes the change."""
+        now = datetime.utcnow()
+        audiobook_ids = session.execute(
+            cls._reclaim_statement(),
+            dict(now=now, unleased_stale_cutoff=now - cls.DEFAULT_LEASE),
+        ).scalars().all()
+        return Counter(audiobook_ids)
+
+    @classmethod
+    def assign_work_items(cls, session: Session, worker_id: str, max_items: int, lease: timedelta = DEFAULT_LEASE) -> list['WorkQueue']:
+        """Lease up to max_items work items to worker_id, highest priority and
+        then oldest first.
+
+        Items that are in progress are only handed out again once their lease
+        has expired, so a slow worker that keeps sending heartbeats (see
+        renew_leases) keeps its items.
+        """
+        # Net number of items moved from pending to in progress, by audiobook
+        moved = Counter()
+        moved.subtract(cls.reclaim_expired_leases(session))
+        now = datetime.utcnow()
+        claimed = session.execute(
+            cls._claim_statement(),
+            dict(worker_id=worker_id, now=now, lease_expires_at=now + lease, limit=max_items),
+        ).all()
+        moved.update(audiobook_id for _, audiobook_id in claimed)
+        changes = {
+            audiobook_id: {'pending': -count, 'in_progress': count}
+            for audiobook_id, count in moved.items() if count
+        }
+        for audiobook_id, change in changes.items():
+            WorkQueueCounter.add(session, audiobook_id, change)
         session.commit()
-        return work_item
+        for audiobook_id, change in changes.items():
+            progress.hub.publish(audiobook_id, change)
+        if not claimed:
+            return []
+        item_ids = [item_id for item_id, _ in claimed]
+        return session.query(cls)\
+            .filter(cls.id.in_(item_ids))\
+            .options(joinedload(cls.content_piece), joinedload(cls.speaker).joinedload(Speaker.reference_voice))\
+            .order_by(cls.priority.desc(), cls.created_at.asc())\
+            .all()
 
-    def complete_work_item(self, session: Session, worker_id: str, created_voice_performance: VoicePerformance):
-        if self.status == 'completed':
-            return
-        if self.status == 'failed':
-            self.error_message = None
-        self.worker_id = worker_id
-        self.status = 'completed'
-        self.completed_at = datetime.utcnow()
-        self.created_voice_performance = created_voice_performance
-        session.add(self)
+    @classmethod
+    def assign_work_item(cls, session: Session, worker_id: str, lease: timedelta = DEFAULT_LEASE) -> Optional['WorkQueue']:
+        items = cls.assign_work_items(session, worker_id, 1, lease)
+        if not items:
+            return None
+        return items[0]
+
+    @classmethod
+    def count_by_status(cls, session: Session, audiobook_id: Optional[int] = None) -> dict[str, int]:
+        """How many items are pending, in progress, completed and failed,
+        either in the whole queue or for one audiobook.
+
+        This counts the items themselves, in one grouped query. It's an index
+        scan, but one that grows with every item the queue has ever had, so
+        prefer WorkQueueCounter.totals where it'll do."""
+        query = select(cls.status, func.count()).group_by(cls.status)
+        if audiobook_id is not None:
+            query = query.where(cls.audiobook_id == audiobook_id)
+        counts = dict.fromkeys(progress.STATUSES, 0)
+        counts.update(session.execute(query).all())
+        return counts
+
+    @classmethod
+    def renew_leases(cls, session: Session, worker_id: str, item_ids: list[int], lease: timedelta = DEFAULT_LEASE) -> list[int]:
+        """Extend worker_id's leases on the given items.
+
+        Returns the ids of the items that worker_id still holds. The rest have
+        been completed or failed, or were reclaimed and handed to someone else.
+        """
+        if not item_ids:
+            return []
+        renewed = session.execute(
+            update(cls)
+            .where(
+                cls.id.in_(item_ids),
+                cls.worker_id == worker_id,
+                cls.status == 'in_progress',
+            )
+            .values(lease_expires_at=datetime.utcnow() + lease)
+            .returning(cls.id)
+            .execution_options(synchronize_session=False)
+        ).scalars().all()
+        session.commit()
+        return renewed
+
+    def _transition(self, session: Session, to_status: str, unless: tuple[str, ...], **values) -> Optional[str]:
+        """Move this item to to_status, setting values, unless it's already
+        in one of the unless statuses. Returns the status it moved from, or
+        None if it didn't move. The caller commits.
+
+        This compares and sets rather than trusting self.status, which was
+        likely read before a worker's upload. Since then, the item may have
+        been completed by someone else, or reclaimed."""
+        expected = self.status
+        while expected not in unless:
+            moved = session.execute(
+                update(WorkQueue)
+                .where(WorkQueue.id == self.id, WorkQueue.status == expected)
+                .values(status=to_status, **values)
+                .execution_options(synchronize_session=False)
+            ).rowcount
+            if moved:
+                return expected
+            expected = session.execute(select(WorkQueue.status).where(WorkQueue.id == self.id)).scalar_one()
+        return None
+
+    def complete_work_item(self, session: Session, worker_id: str, created_voice_performance: VoicePerformance) -> bool:
+        """Complete the item with created_voice_performance, which shouldn't
+        have been added to the session yet.
+
+        Returns False if someone else completed it first. Their performance
+        is the one that was accepted, so ours is dropped rather than saved,
+        where it would become the latest take."""
+        audiobook_id, content_piece_id = self.audiobook_id, self.content_piece_id
+        # Don't let the performance be flushed before we know it's wanted
+        with session.no_autoflush:
+            previous_status = self._transition(
+                session, 'completed', unless=('completed',),
+                worker_id=worker_id,
+                completed_at=datetime.utcnow(),
+                error_message=None,
+            )
+        if previous_status is None:
+            # Most likely the lease of whichever of us was slower ran out.
+            # Keep count, since each of these is a sentence that was
+            # synthesized for nothing.
+            if created_voice_performance in session:
+                session.expunge(created_voice_performance)
+            session.execute(
+                update(WorkQueue)
+                .where(WorkQueue.id == self.id)
+                .values(duplicate_completions=WorkQueue.duplicate_completions + 1)
+                .execution_options(synchronize_session=False)
+            )
+            session.commit()
+            return False
+        # The item is ours now, and since the UPDATE above, so is the write
+        # lock, so nobody can complete it between here and the commit.
         session.add(created_voice_performance)
-        session.add(self.audiobook)
+        session.flush()
+        session.execute(
+            update(WorkQueue)
+            .where(WorkQueue.id == self.id)
+            .values(created_voice_performance_id=created_voice_performance.id)
+            .execution_options(synchronize_session=False)
+        )
+        changes = {previous_status: -1, 'completed': 1}
+        WorkQueueCounter.add(session, audiobook_id, changes)
+        rendered = progress.RenderedPiece(created_voice_performance.id, content_piece_id, created_voice_performance.audio_file_hash)
         session.commit()
+        progress.hub.publish(audiobook_id, changes, rendered=[rendered])
+        return True
 
     def fail_work_item(self, session: Session, worker_id: str, error_message: str):
-        if self.status == 'failed':
-            return
-        if self.status == 'completed':
-            self.error_message = None
+        audiobook_id = self.audiobook_id
+        previous_status = self._transition(
+            session, 'failed', unless=('completed', 'failed'),
+            worker_id=worker_id,
+            error_message=error_message,
+        )
+        if previous_status is None:
+            # The compare and set may have started a transaction
+            session.commit()
             return
-        self.worker_id = worker_id
-        self.status = 'failed'
-        self.error_message = error_message
-        session.add(self)
+        changes = {previous_status: -1, 'failed': 1}
+        WorkQueueCounter.add(session, audiobook_id, changes)
         session.commit()
+        progress.hub.publish(audiobook_id, changes)
+
+# Backs WorkQueue.assign_work_items, which takes items by status, then highest
+# priority, then oldest.
+Index('ix_work_queue_claim', WorkQueue.status, WorkQueue.priority.desc(), WorkQueue.created_at)
+
+class WorkQueueCounter(Base):
+    """How many work queue items each audiobook has with each status.
+
+    Every WorkQueue transition updates these in the same transaction as the
+    items, so the queue's status can be read without counting every item
+    it's ever had. database.migrate rebuilds them from the items, in case
+    anything else changed the queue.
+    """
+    __tablename__ = 'work_queue_counters'
+
+    audiobook_id = Column(Integer, ForeignKey('audiobooks.id'), primary_key=True)
+    status = Column(String, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+    @classmethod
+    def add(cls, session: Session, audiobook_id: int, changes: Mapping[str, int]):
+        """Add changes, e.g. {'pending': -1, 'in_progress': 1}, to the
+        audiobook's counters. The caller commits."""
+        for status, change in changes.items():
+            if not change:
+                continue
+            updated = session.execute(
+                update(cls)
+                .where(cls.audiobook_id == audiobook_id, cls.status == status)
+                .values(count=cls.count + change)
+                .execution_options(synchronize_session=False)
+            ).rowcount
+            if not updated:
+                session.execute(insert(cls).values(audiobook_id=audiobook_id, status=status, count=change))
+
+    @classmethod
+    def totals(cls, session: Session, audiobook_id: Optional[int] = None) -> dict[str, int]:
+        """Like WorkQueue.count_by_status, but read from the counters."""
+        query = select(cls.status, func.sum(cls.count)).group_by(cls.status)
+        if audiobook_id is not None:
+            query = query.where(cls.audiobook_id == audiobook_id)
+        counts = dict.fromkeys(progress.STATUSES, 0)
+        counts.update(session.execute(query).all())
+        return counts
+
+    @classmethod
+    def rebuild(cls, session: Session):
+        """Recount every audiobook's items. The caller commits."""
+        session.execute(delete(cls))
+        session.execute(
+            insert(cls).from_select(
+                ['audiobook_id', 'status', 'count'],
+                select(WorkQueue.audiobook_id, WorkQueue.status, func.count())
+                .group_by(WorkQueue.audiobook_id, WorkQueue.status),
+            )
+        )
+
+
+class HlsSegment(Base):
+    """A segment listed in one of an audiobook's HLS playlists, at its
+    position there. See Audiobook.extend_hls_playlist."""
+    __tablename__ = 'hls_segments'
+
+    audiobook_id = Column(Integer, ForeignKey('audiobooks.id'), primary_key=True)
+    # Which of the audiobook's playlists it's in, see Audiobook.current_hls_playlist
+    playlist = Column(Integer, primary_key=True)
+    position = Column(Integer, primary_key=True)
+    # The name of its MP3, see Audiobook.mp3_segment_path
+    segment_name = Column(String, nullable=False)
+    # In seconds, of the encoded MP3
+    duration = Column(Float, nullable=False)
+    # The content piece of the last sentence in it, which the playlist
+    # carries on from
+    last_content_piece_id = Column(Integer, ForeignKey('content_pieces.id'), nullable=False)
+    # Whether it's the last segment in a finished playlist
+    ends_playlist = Column(Boolean, nullable=False, default=False)
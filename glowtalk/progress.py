@@ -0,0 +1,178 @@
+"""Live generation progress, pushed to everyone watching an audiobook.
+
+Each audiobook that someone is watching has one set of work queue counts
+(pending, in progress, completed, failed) in memory. The WorkQueue
+transitions publish how they changed those counts once they've committed,
+and every watcher is woken from that one shared state. Watching costs the
+database one query per audiobook to seed the counts, and one more every
+RESYNC_INTERVAL to pick up anything that we didn't see happen (another
+server process, or someone editing the database by hand), however many
+people are watching.
+
+Completions also publish which content piece was rendered, so that watchers
+can fetch and play new sentences as they arrive. The last RENDERED_BACKLOG
+of those are kept per audiobook, for watchers that fall behind.
+"""
+import asyncio
+import threading
+import time
+from collections import Counter, deque
+from typing import AsyncIterator, Callable, Iterable, Mapping, NamedTuple, Optional
+
+STATUSES = ("pending", "in_progress", "completed", "failed")
+
+# How many rendered pieces we remember per audiobook
+RENDERED_BACKLOG = 1000
+
+
+class RenderedPiece(NamedTuple):
+    """A content piece that has just been performed."""
+    voice_performance_id: int
+    content_piece_id: int
+    audio_file_hash: str
+
+
+class ProgressUpdate(NamedTuple):
+    counts: dict[str, int]
+    # Pieces rendered since the previous update, oldest first
+    rendered: list[RenderedPiece]
+    # Whether some pieces were rendered that aren't in rendered, because we
+    # fell more than RENDERED_BACKLOG behind
+    missed_rendered: bool
+
+
+class AudiobookProgress:
+    """The work queue counts of one audiobook, and who's waiting on them."""
+
+    def __init__(self, audiobook_id: int):
+        self.audiobook_id = audiobook_id
+        # None until they've been loaded from the database
+        self.counts: Optional[Counter] = None
+        self.loading = False
+        self.loaded_at = 0.0
+        # Changes published while loading, which the load may not have seen
+        self.changes_while_loading: Counter = Counter()
+        # (sequence number, piece) of recently rendered pieces
+        self.rendered: deque[tuple[int, RenderedPiece]] = deque(maxlen=RENDERED_BACKLOG)
+        self.rendered_count = 0
+        self.watchers = 0
+        self.waiters: set[tuple[asyncio.AbstractEventLoop, asyncio.Event]] = set()
+
+
+class ProgressHub:
+    """Fans work queue changes out to the clients watching each audiobook.
+
+    publish may be called from any thread. watch is used from the event loop.
+    Changes to audiobooks nobody is watching are dropped, since their counts
+    are loaded fresh when someone starts watching.
+    """
+
+    RESYNC_INTERVAL = 60.0
+
+    def __init__(self, resync_interval: float = RESYNC_INTERVAL):
+        self.resync_interval = resync_interval
+        self.audiobooks: dict[int, AudiobookProgress] = {}
+        self.lock = threading.Lock()
+
+    def publish(self, audiobook_id: int, changes: Mapping[str, int], rendered: Iterable[RenderedPiece] = ()):
+        """Apply changes, e.g. {"pending": -1, "in_progress": 1}, to the
+        audiobook's counts, and announce any pieces that were rendered. Call
+        it after the change has been committed."""
+        with self.lock:
+            progress = self.audiobooks.get(audiobook_id)
+            if progress is None:
+                return
+            if progress.loading:
+                progress.changes_while_loading.update(changes)
+            if progress.counts is not None:
+                progress.counts.update(changes)
+            for piece in rendered:
+                progress.rendered.append((progress.rendered_count, piece))
+                progress.rendered_count += 1
+            waiters = list(progress.waiters)
+        self._wake(waiters)
+
+    async def watch(self, audiobook_id: int,
+                    load_counts: Callable[[], Mapping[str, int]]) -> AsyncIterator[ProgressUpdate]:
+        """Yield the audiobook's counts, and then again each time they change
+        or a piece is rendered. Pieces rendered before we started watching
+        aren't included.
+
+        load_counts is called on a worker thread to read the counts from the
+        database, when there aren't any in memory or they're due a resync.
+        """
+        event = asyncio.Event()
+        waiter = (asyncio.get_running_loop(), event)
+        with self.lock:
+            progress = self.audiobooks.get(audiobook_id)
+            if progress is None:
+                progress = self.audiobooks[audiobook_id] = AudiobookProgress(audiobook_id)
+            progress.watchers += 1
+            progress.waiters.add(waiter)
+            # The sequence number of the next rendered piece we'll yield
+            next_rendered = progress.rendered_count
+        try:
+            previous = None
+            while True:
+                event.clear()
+                await self._load_if_due(progress, load_counts)
+                with self.lock:
+                    counts = None if progress.counts is None else {status: progress.counts[status] for status in STATUSES}
+                    if counts is None:
+                        rendered, missed_rendered = [], False
+                    else:
+                        rendered = [piece for number, piece in progress.rendered if number >= next_rendered]
+                        missed_rendered = progress.rendered_count - next_rendered > len(rendered)
+                        next_rendered = progress.rendered_count
+                if counts is not None and (counts != previous or rendered or missed_rendered):
+                    yield ProgressUpdate(counts, rendered, missed_rendered)
+                    previous = counts
+                try:
+                    await asyncio.wait_for(event.wait(), timeout=self.resync_interval)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            with self.lock:
+                progress.waiters.discard(waiter)
+                progress.watchers -= 1
+                if progress.watchers == 0 and self.audiobooks.get(audiobook_id) is progress:
+                    del self.audiobooks[audiobook_id]
+
+    async def _load_if_due(self, progress: AudiobookProgress, load_counts: Callable[[], Mapping[str, int]]):
+        # Only one watcher loads at a time. The others keep the counts they
+        # have, or if there aren't any yet, are woken once they've loaded.
+        with self.lock:
+            due = progress.counts is None or time.monotonic() - progress.loaded_at >= self.resync_interval
+            if progress.loading or not due:
+                return
+            progress.loading = True
+            progress.changes_while_loading.clear()
+        counts = None
+        try:
+            counts = await asyncio.to_thread(load_counts)
+        finally:
+            with self.lock:
+                progress.loading = False
+                if counts is not None:
+                    # A change that committed after the load read the table
+                    # would otherwise be lost. One that committed before it
+                    # but was published after is counted twice until the
+                    # next resync, which is rare and harmless.
+                    progress.counts = Counter(counts)
+                    progress.counts.update(progress.changes_while_loading)
+                    progress.loaded_at = time.monotonic()
+                progress.changes_while_loading.clear()
+                waiters = list(progress.waiters)
+            self._wake(waiters)
+
+    def _wake(self, waiters: list[tuple[asyncio.AbstractEventLoop, asyncio.Event]]):
+        for loop, event in waiters:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                # Its event loop has closed
+                pass
+
+
+# The hub that WorkQueue transitions publish to and the API watches
+hub = ProgressHub()
@@ -1,7 +1,14 @@
+import io
 import re
 import os
+import threading
+import zipfile
+from collections import OrderedDict
 from pathlib import Path
+from typing import Callable, List, Optional, Tuple
+import numpy as np
 from glowtalk import models
+from glowtalk.cache import ContentCache
 
 
 def get_unique_filename() -> Path:
@@ -30,19 +37,86 @@ def get_unique_filename() -> Path:
         except FileExistsError:
             counter += 1
 
+class ConditioningCache:
+  """Remembers the conditioning a model computed for a reference voice.
+
+  Entries are keyed by (model, reference audio hash), and kept in memory for
+  the most recently used voices. If given a ContentCache, they're also saved
+  there, so that a restarted worker doesn't have to compute them again.
+  """
+  def __init__(self, store: Optional[ContentCache] = None, max_entries: int = 8):
+    self.store = store
+    self.max_entries = max_entries
+    self.entries: OrderedDict[Tuple[models.SpeakerModel, str], Tuple[np.ndarray, ...]] = OrderedDict()
+    self.lock = threading.Lock()
+
+  def get_or_compute(self, model: models.SpeakerModel, audio_hash: str,
+                     compute: Callable[[], Tuple[np.ndarray, ...]]) -> Tuple[np.ndarray, ...]:
+    key = (model, audio_hash)
+    with self.lock:
+      if key in self.entries:
+        self.entries.move_to_end(key)
+        return self.entries[key]
+    conditioning = self._load(model, audio_hash)
+    if conditioning is None:
+      conditioning = tuple(compute())
+      self._save(model, audio_hash, conditioning)
+    with self.lock:
+      self.entries[key] = conditioning
+      self.entries.move_to_end(key)
+      while len(self.entries) > self.max_entries:
+        self.entries.popitem(last=False)
+    return conditioning
+
+  def _load(self, model: models.SpeakerModel, audio_hash: str) -> Optional[Tuple[np.ndarray, ...]]:
+    if self.store is None:
+      return None
+    data = self.store.read("conditioning", f"{model.name}-{audio_hash}")
+    if data is None:
+      return None
+    try:
+      with np.load(io.BytesIO(data)) as arrays:
+        return tuple(arrays[f"arr_{i}"] for i in range(len(arrays.files)))
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+      # Written by an incompatible version, we'll compute it again and overwrite it.
+      return None
+
+  def _save(self, model: models.SpeakerModel, audio_hash: str, conditioning: Tuple[np.ndarray, ...]):
+    if self.store is None:
+      return
+    data = io.BytesIO()
+    np.savez(data, *conditioning)
+    try:
+      self.store.put("conditioning", f"{model.name}-{audio_hash}", data.getvalue())
+    except (OSError, ValueError):
+      # The cache is an optimization, we can work without it.
+      pass
+
 class Speaker:
-  def __init__(self, model: models.SpeakerModel):
+  def __init__(self, model: models.SpeakerModel, conditioning_cache: Optional[ConditioningCache] = None,
+               threads: Optional[int] = None):
     import torch
     from TTS.api import TTS
+    if threads is not None:
+      torch.set_num_threads(threads)
     device = "cuda" if torch.cuda.is_available() else "cpu"
     if device == "cpu":
       print("pytorch isn't happy with your cuda so this will be slower")
 
     if model != models.SpeakerModel.XTTS_v2:
         raise ValueError(f"Unsupported model: {model}")
+    self.model = model
+    self.device = device
     self.tts = TTS(model.value).to(device)
+    self.conditioning_cache = conditioning_cache or ConditioningCache()
 
-  def speak(self, text: str, speaker_wav: Path, language="en", output_path = get_unique_filename(), **kwargs) -> Path:
+  @property
+  def sample_rate(self) -> int:
+    return self.tts.synthesizer.output_sample_rate
+
+  def speak(self, text: str, speaker_wav: Path, language="en", output_path: Optional[Path] = None, **kwargs) -> Path:
+    if output_path is None:
+      output_path = get_unique_filename()
     # Technically we should split the text into chunks of 250 characters or less,
     # because the model allegedly isn't able to handle longer text.
     # But I haven't noticed any issues with that yet.
@@ -55,3 +129,76 @@ class Speaker:
     )
 
     return output_path
+
+  # Silence between the sentences of one text, in samples, as tts_to_file
+  # puts between them
+  SENTENCE_GAP = 10000
+
+  def _conditioning_settings(self) -> dict:
+    """The model config's settings for computing conditioning, which
+    tts_to_file would have used."""
+    config = self.tts.synthesizer.tts_model.config
+    return dict(
+      gpt_cond_len=config.gpt_cond_len,
+      gpt_cond_chunk_len=config.gpt_cond_chunk_len,
+      max_ref_length=config.max_ref_len,
+      sound_norm_refs=config.sound_norm_refs,
+    )
+
+  def _inference_settings(self) -> dict:
+    """The model config's sampling settings, which tts_to_file would have
+    used."""
+    config = self.tts.synthesizer.tts_model.config
+    return dict(
+      temperature=config.temperature,
+      length_penalty=config.length_penalty,
+      repetition_penalty=config.repetition_penalty,
+      top_k=config.top_k,
+      top_p=config.top_p,
+    )
+
+  def get_conditioning_latents(self, speaker_wav: Path, speaker_wav_hash: Optional[str] = None):
+    """Compute the (gpt_cond_latent, speaker_embedding) pair that XTTS
+    conditions on to sound like the speaker in speaker_wav.
+
+    If given the hash of speaker_wav, the result comes from (and is saved
+    to) self.conditioning_cache."""
+    model = self.tts.synthesizer.tts_model
+    settings = self._conditioning_settings()
+    if speaker_wav_hash is None:
+      return model.get_conditioning_latents(audio_path=[str(speaker_wav)], **settings)
+
+    import torch
+    def compute():
+      latents = model.get_conditioning_latents(audio_path=[str(speaker_wav)], **settings)
+      return tuple(latent.cpu().numpy() for latent in latents)
+    conditioning = self.conditioning_cache.get_or_compute(self.model, speaker_wav_hash, compute)
+    return tuple(torch.from_numpy(latent).to(self.device) for latent in conditioning)
+
+  def speak_batch(self, texts: List[str], speaker_wav: Path, language="en",
+                  speaker_wav_hash: Optional[str] = None, **kwargs) -> List[np.ndarray]:
+    """Perform several texts in the same voice.
+
+    speak() recomputes the speaker conditioning from speaker_wav and writes a
+    file for every sentence. This computes the conditioning once for the
+    whole batch, or not at all if it's cached under speaker_wav_hash, and
+    returns each performance as a float32 array at self.sample_rate.
+
+    Otherwise it sounds the same as speak(): it uses the model config's
+    settings, which kwargs can override, and splits each text into
+    sentences.
+    """
+    model = self.tts.synthesizer.tts_model
+    gpt_cond_latent, speaker_embedding = self.get_conditioning_latents(speaker_wav, speaker_wav_hash)
+    settings = {**self._inference_settings(), **kwargs}
+    gap = np.zeros(self.SENTENCE_GAP, dtype=np.float32)
+    performances = []
+    for text in texts:
+      pieces = []
+      for sentence in self.tts.synthesizer.split_into_sentences(text):
+        output = model.inference(sentence, language, gpt_cond_latent, speaker_embedding, **settings)
+        if pieces:
+          pieces.append(gap)
+        pieces.append(np.asarray(output["wav"], dtype=np.float32))
+      performances.append(np.concatenate(pieces) if pieces else np.zeros(0, dtype=np.float32))
+    return performances
@@ -0,0 +1,108 @@
+import React, { useEffect, useRef, useState } from 'react';
+import type { ExportJob } from '../types';
+
+interface Mp3DownloadProps {
+    audiobookId: number;
+    filename: string;
+}
+
+// Exporting a book's MP3 can take minutes, so the server does it in the
+// background. GET /mp3 starts the export and responds with 202 until the
+// file is ready. We follow /mp3/progress, then download it.
+export function Mp3Download({ audiobookId, filename }: Mp3DownloadProps) {
+    const [job, setJob] = useState<ExportJob | null>(null);
+    const [ready, setReady] = useState(false);
+    const [error, setError] = useState<string | null>(null);
+    const eventSource = useRef<EventSource | null>(null);
+    const url = `/api/audiobooks/${audiobookId}/mp3`;
+
+    useEffect(() => () => eventSource.current?.close(), [audiobookId]);
+
+    const download = () => {
+        const link = document.createElement('a');
+        link.href = url;
+        link.download = filename;
+        document.body.appendChild(link);
+        link.click();
+        link.remove();
+    };
+
+    const finished = () => {
+        setJob(null);
+        setReady(true);
+        download();
+    };
+
+    const followProgress = () => {
+        eventSource.current?.close();
+        const source = new EventSource(`${url}/progress`);
+        eventSource.current = source;
+
+        source.onmessage = (event) => {
+            const data: ExportJob = JSON.parse(event.data);
+            setJob(data);
+            if (data.status === 'done') {
+                source.close();
+                finished();
+            } else if (data.status === 'failed') {
+                source.close();
+                setJob(null);
+                setError(data.error || 'Failed to export MP3');
+            }
+        };
+        source.onerror = () => {
+            source.close();
+            setJob(null);
+            setError('Lost track of the MP3 export');
+        };
+    };
+
+    const startExport = async () => {
+        setError(null);
+        setReady(false);
+        const controller = new AbortController();
+        try {
+            const response = await fetch(url, { signal: controller.signal });
+            if (response.status === 200) {
+                // It's already up to date. The download fetches it again, so
+                // don't read the whole file here.
+                controller.abort();
+                finished();
+                return;
+            }
+            const data = await response.json();
+            if (response.status !== 202) throw new Error(data.detail || 'Failed to export MP3');
+            setJob(data);
+            followProgress();
+        } catch (error) {
+            console.error('Error:', error);
+            setError(error instanceof Error ? error.message : 'Failed to export MP3');
+        }
+    };
+
+    if (job) {
+        const progress = job.segments_total
+            ? ` (${job.segments_done}/${job.segments_total})`
+            : '';
+        return (
+            <button className="button-like-link" disabled>
+                Exporting MP3{progress}...
+            </button>
+        );
+    }
+
+    return (
+        <div>
+            {ready ? (
+                <a href={url} download={filename} className="button-like-link">
+                    Download MP3
+                </a>
+            ) : (
+                <button className="button-like-link" onClick={startExport}>
+                    Download MP3
+                </button>
+            )}
+            {error && <p className="error">{error}</p>}
+        </div>
+    );
+}
@@ -1,6 +1,7 @@
 import React, { useEffect, useState } from 'react';
 import { useParams, useNavigate, Link } from 'react-router-dom';
 import type { Work, Audiobook } from '../types';
+import { Mp3Download } from '../components/Mp3Download';
 
 export function WorkDetails() {
     const { workId } = useParams();
@@ -88,13 +89,10 @@ export function WorkDetails() {
                                     <p>{audiobook.description}</p>
                                 )}
                                 <p>Created: {new Date(audiobook.created_at).toLocaleString()}</p>
-                                <a
-                                    href={`/api/audiobooks/${audiobook.id}/mp3`}
-                                    download={`${work.title || `Glowfic ${work.id}`}.mp3`}
-                                    className="button-like-link"
-                                >
-                                    Download MP3
-                                </a>
+                                <Mp3Download
+                                    audiobookId={audiobook.id}
+                                    filename={`${work.title || `Glowfic ${work.id}`}.mp3`}
+                                />
                             </div>
                         ))}
                     </div>
@@ -50,6 +50,7 @@ export interface SpeakerModel {
 //     icon_title: Optional[str]
 //     author_name: Optional[str]
 //     content_pieces: ContentPieceContentResponse[];
+//     cursor: str
 
 export interface ContentPiece {
   id: number;
@@ -66,4 +67,24 @@ export interface Part {
   icon_title: string | null;
   author_name: string | null;
   content_pieces: ContentPiece[];
+  // Pass as ?cursor= to the content endpoint to continue after this part
+  cursor: string;
+}
+
+export interface TableOfContentsPart {
+  id: number;
+  character_name: string | null;
+  screenname: string | null;
+  author_name: string | null;
+  voiced: number;
+  rendered: number;
+}
+
+// An MP3 export, as reported by /api/audiobooks/{id}/mp3 and /mp3/progress
+export interface ExportJob {
+  audiobook_id: number;
+  status: 'pending' | 'running' | 'done' | 'failed';
+  segments_done: number;
+  segments_total: number | null;
+  error: string | null;
 }
@@ -1,18 +1,220 @@
+import hashlib
 import json
+from collections import defaultdict
 import time
 import uuid
 from pathlib import Path
 import tempfile
+import os
+import threading
+import queue
+import multiprocessing
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable
 import requests
-from glowtalk import models, speak, idle
+from glowtalk import models, speak, idle, convert
+from glowtalk.cache import ContentCache
 import httpx
 
+class LeaseKeeper:
+    """Sends heartbeats for the work items a worker holds, so the server
+    doesn't hand them to another worker while we're still rendering them."""
+
+    def __init__(self, client: httpx.Client, worker_id: str, lease_seconds: int, verbose: bool = False):
+        self.client = client
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        self.verbose = verbose
+        self.held: set[int] = set()
+        self.lock = threading.Lock()
+        self.thread: threading.Thread | None = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def hold(self, item_ids: list[int]):
+        with self.lock:
+            self.held.update(item_ids)
+
+    def release(self, item_ids: list[int]):
+        with self.lock:
+            self.held.difference_update(item_ids)
+
+    def run(self):
+        # Renew well before the lease runs out, so one slow or dropped
+        # heartbeat doesn't lose our items.
+        while True:
+            time.sleep(self.lease_seconds / 4)
+            try:
+                self.heartbeat()
+            except Exception as e:
+                if self.verbose:
+                    print(f"Error sending heartbeat: {e}")
+
+    def heartbeat(self):
+        with self.lock:
+            item_ids = sorted(self.held)
+        if not item_ids:
+            return
+        response = self.client.post(
+            f"/api/queue/heartbeat/{self.worker_id}",
+            json={"item_ids": item_ids, "lease_seconds": self.lease_seconds}
+        )
+        response.raise_for_status()
+        lost = response.json()["lost"]
+        if lost and self.verbose:
+            print(f"Lost the lease on work items {lost}, another worker may also render them")
+
+def synthesize(work_items: list[dict], get_speaker: Callable[[models.SpeakerModel], speak.Speaker],
+               get_reference_audio: Callable[[str], Path], verbose: bool = False,
+               audio_format: str = "wav") -> list[tuple[dict, bytes | Exception]]:
+    """Synthesize several work items, returning each item with either its
+    generated audio, encoded in audio_format, or the error that stopped it.
+
+    Items in the same voice are performed together, so the voice's
+    conditioning is only computed once."""
+    by_voice: dict[tuple[str, str], list[dict]] = defaultdict(list)
+    for work_item in work_items:
+        by_voice[(work_item['speaker_model'], work_item['reference_audio_hash'])].append(work_item)
+
+    results: list[tuple[dict, bytes | Exception]] = []
+    for (speaker_model, reference_audio_hash), voice_items in by_voice.items():
+        if verbose:
+            for work_item in voice_items:
+                print(f"Performing the line {json.dumps(work_item['text'])}")
+        try:
+            speaker = get_speaker(models.SpeakerModel(speaker_model))
+            reference_audio_path = get_reference_audio(reference_audio_hash)
+            performances = speaker.speak_batch(
+                texts=[work_item['text'] for work_item in voice_items],
+                speaker_wav=reference_audio_path,
+                speaker_wav_hash=reference_audio_hash,
+            )
+        except Exception as e:
+            results.extend((work_item, e) for work_item in voice_items)
+            continue
+        for work_item, performance in zip(voice_items, performances):
+            results.append((work_item, convert.encode_audio(performance, speaker.sample_rate, audio_format)))
+    return results
+
+# The state of a synthesis process, set up by _start_synthesis_process
+_synthesis_process: dict = {}
+
+def _start_synthesis_process(threads: int, cpus: list[list[int]] | None, next_process, cache_dir: Path,
+                             cache_max_bytes: int, verbose: bool, audio_format: str):
+    # Set before torch is imported, so its thread pools are the right size.
+    for variable in ["OMP_NUM_THREADS", "MKL_NUM_THREADS"]:
+        os.environ[variable] = str(threads)
+    with next_process.get_lock():
+        index = next_process.value
+        next_process.value += 1
+    if cpus and hasattr(os, "sched_setaffinity"):
+        # Keep each process on its own cores, so they don't evict each
+        # other's caches.
+        os.sched_setaffinity(0, cpus[index % len(cpus)])
+    _synthesis_process.update(
+        threads=threads,
+        verbose=verbose,
+        audio_format=audio_format,
+        speakers={},
+        conditioning_cache=speak.ConditioningCache(ContentCache(cache_dir, max_bytes=cache_max_bytes)),
+    )
+
+def _synthesize_in_process(work_items: list[dict], reference_audio_paths: dict[str, Path | str]) -> list[tuple[dict, bytes | Exception]]:
+    speakers = _synthesis_process["speakers"]
+    def get_speaker(model: models.SpeakerModel) -> speak.Speaker:
+        if model not in speakers:
+            speakers[model] = speak.Speaker(
+                model,
+                conditioning_cache=_synthesis_process["conditioning_cache"],
+                threads=_synthesis_process["threads"],
+            )
+        return speakers[model]
+    def get_reference_audio(reference_audio_hash: str) -> Path:
+        path = reference_audio_paths[reference_audio_hash]
+        if isinstance(path, str):
+            # The error we got trying to download it
+            raise ValueError(path)
+        return path
+
+    results = synthesize(work_items, get_speaker, get_reference_audio, _synthesis_process["verbose"],
+                         _synthesis_process["audio_format"])
+    # Not every exception can be pickled to send back to the worker.
+    return [
+        (work_item, RuntimeError(f"{type(audio).__name__}: {audio}") if isinstance(audio, Exception) else audio)
+        for work_item, audio in results
+    ]
+
+class SynthesisPool:
+    """Several processes, each with their own models, synthesizing at once.
+
+    torch doesn't make a single inference use many CPU cores efficiently, so
+    on CPU-only machines with lots of cores we get more done by running
+    several smaller inferences side by side. Each process gets an equal share
+    of the cores, pinned to it where the OS allows.
+    """
+
+    def __init__(self, processes: int, cache_dir: Path, cache_max_bytes: int, threads_per_process: int | None = None,
+                 verbose: bool = False, audio_format: str = "wav", mp_context=None):
+        if hasattr(os, "sched_getaffinity"):
+            available_cpus = sorted(os.sched_getaffinity(0))
+        else:
+            available_cpus = list(range(os.cpu_count() or 1))
+        if threads_per_process is None:
+            threads_per_process = max(1, len(available_cpus) // processes)
+        cpus = None
+        if threads_per_process * processes <= len(available_cpus):
+            cpus = [
+                available_cpus[i * threads_per_process:(i + 1) * threads_per_process]
+                for i in range(processes)
+            ]
+
+        # Forking a process that's already using torch isn't safe.
+        mp_context = mp_context or multiprocessing.get_context("spawn")
+        self.processes = processes
+        self.executor = ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=mp_context,
+            initializer=_start_synthesis_process,
+            initargs=(threads_per_process, cpus, mp_context.Value("i", 0), cache_dir, cache_max_bytes, verbose,
+                      audio_format),
+        )
+
+    def submit(self, work_items: list[dict], reference_audio_paths: dict[str, Path | str]) -> Future:
+        """Start synthesizing work_items in one of the processes.
+
+        reference_audio_paths maps each of the items' reference audio hashes
+        to the path of the audio, or to the error we got trying to download it."""
+        return self.executor.submit(_synthesize_in_process, work_items, reference_audio_paths)
+
+    def shutdown(self, wait: bool = True):
+        self.executor.shutdown(wait=wait)
+
 class Worker:
     def __init__(self, client: httpx.Client, verbose: bool = False, idle_threshold_seconds: int = 30,
-                 worker_id: str | None = None, worker_id_dir: Path | None = None):
+                 worker_id: str | None = None, worker_id_dir: Path | None = None, batch_size: int = 8,
+                 lease_seconds: int = 120, cache_dir: Path | None = None, cache_max_bytes: int = 2 * 1024 ** 3,
+                 pipeline_depth: int = 1, processes: int = 1, threads_per_process: int | None = None,
+                 upload_format: str = "flac"):
         self.client = client
         self.verbose = verbose
         self.idle_threshold_seconds = idle_threshold_seconds
+        # How many items to lease per round trip, if the server supports it
+        self.batch_size = batch_size
+        self.supports_batches = True
+        # How many batches may wait between each stage of the pipeline
+        self.pipeline_depth = pipeline_depth
+        # How many processes synthesize at once, see SynthesisPool
+        self.processes = processes
+        self.threads_per_process = threads_per_process
+        # How performances are encoded for upload, one of convert.AUDIO_FORMATS
+        if upload_format not in convert.AUDIO_FORMATS:
+            raise ValueError(f"Unknown upload format {upload_format!r}")
+        self.upload_format = upload_format
+        self.synthesis_pool: SynthesisPool | None = None
         # one speaker per model
         self.speakers: dict[models.SpeakerModel, speak.Speaker] = dict()
 
@@ -39,9 +241,23 @@ class Worker:
         self.tempdir = Path(tempfile.TemporaryDirectory().name)
         self.tempdir.mkdir(exist_ok=True)
 
+        # Things worth keeping between runs, like reference voices and the
+        # conditioning computed for each of them.
+        if cache_dir is None:
+            cache_dir = Path.home() / ".cache" / "glowtalk"
+        self.cache_dir = cache_dir
+        self.cache_max_bytes = cache_max_bytes
+        self.cache = ContentCache(cache_dir, max_bytes=cache_max_bytes)
+        self.conditioning_cache = speak.ConditioningCache(self.cache)
+
+        # How long the server should wait for a heartbeat before giving our
+        # items to someone else
+        self.lease_seconds = lease_seconds
+        self.lease_keeper = LeaseKeeper(client, self.worker_id, lease_seconds, verbose)
+
     def get_speaker(self, model: models.SpeakerModel) -> speak.Speaker:
         if model not in self.speakers:
-            self.speakers[model] = speak.Speaker(model)
+            self.speakers[model] = speak.Speaker(model, conditioning_cache=self.conditioning_cache)
         return self.speakers[model]
 
     def api_is_up(self) -> bool:
@@ -60,94 +276,313 @@ class Worker:
             if self.verbose:
                 print("API is back up, continuing...")
 
+    def take_work(self) -> list[dict]:
+        """Lease the next few work items from the server.
+
+        Uses the batch protocol (version 2) when the server supports it, and
+        falls back to taking one item at a time (version 1) when it doesn't.
+        Raises if the server can't be reached or errors."""
+        if self.supports_batches:
+            response = self.client.post(
+                "/api/queue/take_batch",
+                json={
+                    "worker_id": self.worker_id,
+                    "version": 2,
+                    "max_items": self.batch_size,
+                    "lease_seconds": self.lease_seconds,
+                }
+            )
+            if response.status_code == 404 or (response.status_code == 200 and response.json() is None):
+                # An older server, which only knows version 1.
+                self.supports_batches = False
+            else:
+                response.raise_for_status()
+                work_items = response.json()["items"]
+                self.lease_keeper.hold([work_item['id'] for work_item in work_items])
+                return work_items
+
+        response = self.client.post(
+            "/api/queue/take",
+            json={"worker_id": self.worker_id, "version": 1, "lease_seconds": self.lease_seconds}
+        )
+        response.raise_for_status()
+        work_item = response.json()
+        if work_item is None:
+            return []
+        self.lease_keeper.hold([work_item['id']])
+        return [work_item]
+
     def work(self):
         idle_checker = idle.create_idle_checker()
-        while True:
-            self.wait_for_api_to_come_back_up()
+        self.lease_keeper.start()
+        self.wait_for_api_to_come_back_up()
+        self.run_pipeline(idle_checker=idle_checker)
+
+    def run_pipeline(self, idle_checker=None, stop_when_empty: bool = False) -> int:
+        """Take, perform and upload work items, each on its own thread.
+
+        While one batch is being synthesized, the next is being taken from the
+        server (along with any reference voices it needs) and the last one is
+        being uploaded, so synthesis only waits when there's no work. The
+        queues between the stages are bounded, so we don't lease more work
+        than we'll get to soon.
 
-            while idle_checker.get_idle_time() >= self.idle_threshold_seconds:
-                start_time = time.time()
+        Runs forever, unless stop_when_empty is set, in which case it returns
+        the number of items completed once the server runs out of work. The
+        synthesis pool, if we started one, is shut down when we're done."""
+        to_synthesize: queue.Queue[list[dict] | None] = queue.Queue(maxsize=self.pipeline_depth)
+        to_upload: queue.Queue[list[tuple[dict, bytes | Exception]] | None] = queue.Queue(maxsize=self.pipeline_depth)
+        completed = [0]
+
+        def upload_stage():
+            while (results := to_upload.get()) is not None:
                 try:
-                    response = self.client.post(
-                        "/api/queue/take",
-                        json={"worker_id": self.worker_id, "version": 1}
-                    )
+                    completed[0] += self.upload(results)
                 except Exception as e:
-                    if self.verbose:
-                        print(f"Error taking work item: {e}")
-                    time.sleep(60)
-                    self.wait_for_api_to_come_back_up()
-                    continue
+                    # Keep draining the queue, or synthesis would stall
+                    print(f"Error uploading work items: {e}")
 
-                if response.status_code != 200:
-                    if self.verbose:
-                        print(f"Error getting work item: {response.status_code} {response.text}")
-                    time.sleep(60)
-                    continue
+        fetcher = threading.Thread(target=self.fetch_stage, args=(to_synthesize, idle_checker, stop_when_empty), daemon=True)
+        uploader = threading.Thread(target=upload_stage, daemon=True)
+        fetcher.start()
+        uploader.start()
 
-                work_item = response.json()
-                if work_item is None:
+        try:
+            if self.processes > 1:
+                self.dispatch_to_processes(to_synthesize, to_upload)
+            else:
+                # Synthesis happens on this thread
+                while True:
+                    wait_start = time.time()
+                    work_items = to_synthesize.get()
+                    if work_items is None:
+                        break
+                    start_time = time.time()
+                    results = self.perform_batch(work_items)
+                    to_upload.put(results)
                     if self.verbose:
-                        print("No work item assigned, waiting for one...")
-                    time.sleep(60)
-                    continue
+                        print(f"Performed {len(work_items)} lines in {time.time() - start_time:.1f} seconds, "
+                              f"after waiting {start_time - wait_start:.1f} seconds for them")
+            to_upload.put(None)
+            fetcher.join()
+            uploader.join()
+        finally:
+            if self.synthesis_pool is not None:
+                self.synthesis_pool.shutdown()
+                self.synthesis_pool = None
+        return completed[0]
+
+    # How many times a batch is retried after the process synthesizing it
+    # died, before we let go of its items
+    SYNTHESIS_RETRIES = 1
+
+    def replace_synthesis_pool(self, broken: SynthesisPool | None = None):
+        """Start a new synthesis pool, unless the current one isn't the broken
+        one (we already replaced it)."""
+        if self.synthesis_pool is not None and self.synthesis_pool is not broken:
+            return
+        if broken is not None:
+            broken.shutdown(wait=False)
+        self.synthesis_pool = SynthesisPool(
+            self.processes, self.cache_dir, self.cache_max_bytes, self.threads_per_process, self.verbose,
+            self.upload_format)
 
-                success = False
+    def dispatch_to_processes(self, to_synthesize: queue.Queue, to_upload: queue.Queue):
+        """Hand batches to the synthesis pool as soon as one of its processes is free.
+
+        If one of the processes dies, say it runs out of memory, the whole
+        pool is broken. We start another, and try its batches again there.
+        A batch that breaks that one too has its items let go, without
+        reporting them as failed, so the server hands them out again once
+        their leases run out."""
+        if self.synthesis_pool is None:
+            self.replace_synthesis_pool()
+        # The batch each process is working on: its items, their reference
+        # audio, the pool it's in, and how many times it's been retried
+        in_flight: dict[Future, tuple[list[dict], dict[str, Path | str], SynthesisPool, int]] = {}
+
+        def submit(work_items: list[dict], reference_audio_paths: dict[str, Path | str], retries: int = 0):
+            pool = self.synthesis_pool
+            try:
+                future = pool.submit(work_items, reference_audio_paths)
+            except BrokenProcessPool:
+                # It broke since we last heard from it
+                self.replace_synthesis_pool(pool)
+                pool = self.synthesis_pool
+                future = pool.submit(work_items, reference_audio_paths)
+            in_flight[future] = (work_items, reference_audio_paths, pool, retries)
+
+        def finish(futures: set[Future]):
+            for future in futures:
+                work_items, reference_audio_paths, pool, retries = in_flight.pop(future)
                 try:
-                    self.work_one_item(work_item)
-                    success = True
+                    to_upload.put(future.result())
+                except BrokenProcessPool as e:
+                    self.replace_synthesis_pool(pool)
+                    if retries < self.SYNTHESIS_RETRIES:
+                        print(f"A synthesis process died, trying its work items again: {e}")
+                        submit(work_items, reference_audio_paths, retries + 1)
+                    else:
+                        print(f"A synthesis process died again, letting go of its work items: {e}")
+                        self.lease_keeper.release([work_item['id'] for work_item in work_items])
                 except Exception as e:
-                    if self.verbose:
-                        print(f"Error processing work item: {e}")
-                    time.sleep(60)
-                if success and self.verbose:
-                    print(f"Generated a voice performance in {time.time() - start_time} seconds")
+                    # We don't know what happened to any of the items in the
+                    # batch.
+                    print(f"Error synthesizing work items: {e}")
+                    to_upload.put([(work_item, e) for work_item in work_items])
+
+        while (work_items := to_synthesize.get()) is not None:
+            while len(in_flight) >= self.processes:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                finish(done)
+            reference_audio_paths: dict[str, Path | str] = {}
+            for reference_audio_hash in {work_item['reference_audio_hash'] for work_item in work_items}:
+                try:
+                    reference_audio_paths[reference_audio_hash] = self.get_reference_audio(reference_audio_hash)
+                except Exception as e:
+                    reference_audio_paths[reference_audio_hash] = str(e)
+            submit(work_items, reference_audio_paths)
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            finish(done)
+
+    def fetch_stage(self, to_synthesize: queue.Queue, idle_checker=None, stop_when_empty: bool = False):
+        """Take work from the server whenever the synthesis stage has room for it."""
+        while True:
+            if idle_checker is not None and idle_checker.get_idle_time() < self.idle_threshold_seconds:
+                if self.verbose:
+                    print("System is being used by a person, waiting for it to become idle...")
+                while idle_checker.get_idle_time() < self.idle_threshold_seconds:
+                    time.sleep(self.idle_threshold_seconds)
+
+            try:
+                work_items = self.take_work()
+            except Exception as e:
+                if self.verbose:
+                    print(f"Error taking work items: {e}")
+                time.sleep(60)
+                self.wait_for_api_to_come_back_up()
+                continue
+
+            if not work_items:
+                if stop_when_empty:
+                    to_synthesize.put(None)
+                    return
+                if self.verbose:
+                    print("No work item assigned, waiting for one...")
+                time.sleep(60)
+                continue
+
+            # Download any new voices now, rather than when it's their turn
+            # to be synthesized.
+            for reference_audio_hash in {work_item['reference_audio_hash'] for work_item in work_items}:
+                try:
+                    self.get_reference_audio(reference_audio_hash)
+                except Exception:
+                    # perform_batch will try again, and report the error
+                    pass
+            to_synthesize.put(work_items)
+
+    def upload(self, results: list[tuple[dict, bytes | Exception]]) -> int:
+        """Report the results of perform_batch to the server, and let go of
+        the items' leases.
 
+        Returns the number of items successfully completed."""
+        try:
+            return self._upload(results)
+        finally:
+            self.lease_keeper.release([work_item['id'] for work_item, _ in results])
+
+    def _upload(self, results: list[tuple[dict, bytes | Exception]]) -> int:
+        performed: list[tuple[dict, bytes]] = []
+        for work_item, audio in results:
+            if isinstance(audio, Exception):
+                self.report_failure(work_item, audio)
+            else:
+                performed.append((work_item, audio))
+        if not performed:
+            return 0
+
+        if not self.supports_batches:
+            return sum(1 for work_item, audio in performed if self.complete_one_item(work_item, audio))
+
+        try:
+            completion_response = self.client.post(
+                f"/api/queue/complete_batch/{self.worker_id}",
+                data={"item_ids": [str(work_item['id']) for work_item, _ in performed]},
+                files=[
+                    ('generated_audio', self.upload_file(f"{work_item['id']}", audio))
+                    for work_item, audio in performed
+                ],
+            )
+        except Exception as e:
+            if self.verbose:
+                print(f"Error completing work items: {e}")
+            return 0
+        if completion_response.status_code != 200:
             if self.verbose:
-                print("System is being used by a person, waiting for it to become idle...")
-            # Check if system becomes active
-            while idle_checker.get_idle_time() < self.idle_threshold_seconds:
-                time.sleep(self.idle_threshold_seconds)
+                print(f"Error completing work items: {completion_response.status_code} {completion_response.text}")
+            return 0
+        completion = completion_response.json()
+        if self.verbose and completion.get("duplicates"):
+            print(f"Someone else completed work items {completion['duplicates']} first")
+        return len(completion["completed"])
 
-    def work_one_item(self, work_item: dict):
-        if self.verbose:
-            print(f"Performing the line {json.dumps(work_item['text'])}")
+    def get_reference_audio(self, reference_audio_hash: str) -> Path:
+        reference_audio_path = self.cache.get("reference_voices", reference_audio_hash)
+        if reference_audio_path is not None:
+            return reference_audio_path
 
+        response = self.client.get(f"/api/reference_voices/{reference_audio_hash}")
+        if response.status_code != 200:
+            raise ValueError(f"Error getting reference voice: {response.status_code} {response.text}")
+        if hashlib.sha256(response.content).hexdigest() != reference_audio_hash:
+            raise ValueError(f"Reference voice {reference_audio_hash} doesn't match its hash")
         try:
-            speaker_model = models.SpeakerModel(work_item['speaker_model'])
-            speaker = self.get_speaker(speaker_model)
-            output_path = self.tempdir/ f"{work_item['id']}.wav"
-            reference_audio_path = self.tempdir / f"{work_item['reference_audio_hash']}.wav"
-            if not reference_audio_path.exists():
-                response = self.client.get(f"/api/reference_voices/{work_item['reference_audio_hash']}")
-                if response.status_code != 200:
-                    raise ValueError(f"Error getting reference voice: {response.status_code} {response.text}")
-                reference_audio_path.write_bytes(response.content)
-            speaker.speak(
-                text=work_item['text'],
-                speaker_wav=reference_audio_path,
-                output_path=output_path,
+            return self.cache.put("reference_voices", reference_audio_hash, response.content)
+        except OSError:
+            # We can't write to the cache, so this run gets its own copy.
+            reference_audio_path = self.tempdir / f"{reference_audio_hash}.wav"
+            reference_audio_path.write_bytes(response.content)
+            return reference_audio_path
+
+    def perform_batch(self, work_items: list[dict]) -> list[tuple[dict, bytes | Exception]]:
+        """Synthesize several work items, returning each item with either its
+        generated audio, encoded for upload, or the error that stopped it."""
+        return synthesize(work_items, self.get_speaker, self.get_reference_audio, self.verbose, self.upload_format)
+
+    def upload_file(self, name: str, audio: bytes) -> tuple[str, bytes, str]:
+        """The multipart file for uploading a performance, named and typed
+        for the encoding it's in."""
+        suffix = convert.audio_suffix(audio[:16])
+        return (f"{name}{suffix}", audio, convert.MEDIA_TYPES[suffix])
+
+    def report_failure(self, work_item: dict, error: Exception):
+        print(f"Failed to process work item: {str(error)}")
+        try:
+            failure_response = self.client.post(
+                f"/api/queue/{work_item['id']}/fail/{self.worker_id}",
+                json={"error": str(error)}
             )
-            files = {'generated_audio': ('audio.wav', output_path.read_bytes(), 'audio/wav')}
+            if failure_response.status_code != 200:
+                print(f"Error marking work item as failed: {failure_response.status_code} {failure_response.text}")
+        except:
+            # Don't worry about it, we tried. Probably the API is down.
+            pass
 
+    def complete_one_item(self, work_item: dict, audio: bytes) -> bool:
+        try:
+            completion_response = self.client.post(
+                f"/api/queue/{work_item['id']}/complete/{self.worker_id}",
+                files={'generated_audio': self.upload_file("audio", audio)}
+            )
         except Exception as e:
-            print(f"Failed to process work item: {str(e)}")
-            try:
-                failure_response = self.client.post(
-                    f"/api/queue/{work_item['id']}/fail/{self.worker_id}",
-                    json={"error": str(e)}
-                )
-                if failure_response.status_code != 200:
-                    print(f"Error marking work item as failed: {failure_response.status_code} {failure_response.text}")
-            except:
-                # Don't worry about it, we tried. Probably the API is down.
-                pass
-
-        completion_response = self.client.post(
-            f"/api/queue/{work_item['id']}/complete/{self.worker_id}",
-            files=files
-        )
+            if self.verbose:
+                print(f"Error completing work item: {e}")
+            return False
 
         if completion_response.status_code != 200:
             if self.verbose:
                 print(f"Error completing work item: {completion_response.status_code} {completion_response.text}")
+            return False
+        return True
@@ -7,12 +7,14 @@ from unittest.mock import MagicMock
 from glowtalk import models, glowfic_scraper
 import os
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine
-from sqlalchemy.pool import StaticPool
-from glowtalk.api import app, get_sessionmaker
+from glowtalk.api import app, get_sessionmaker, export_manager
 from glowtalk.models import Base
+from glowtalk.database import init_db
 from fastapi.testclient import TestClient
 import signal
+import io
+import numpy as np
+import soundfile as sf
 
 # Mock data for our fake glowfic scraper
 MOCK_GLOWFIC_HTML = """
@@ -59,15 +61,36 @@ SECOND_MOCK_GLOWFIC_HTML = """
 def mock_speaker_model(monkeypatch):
     """Mock the speaker model to avoid actual TTS generation"""
     class MockSpeakerModel:
-        def __init__(self, model: models.SpeakerModel):
+        def __init__(self, model: models.SpeakerModel, conditioning_cache=None, threads=None):
             self.model = model
 
+        sample_rate = 24000
+
         def speak(self, text, speaker_wav, output_path):
             output_path.write_bytes( b"generated audio data for " + bytes(text, "utf8"))
             return output_path
 
+        def speak_batch(self, texts, speaker_wav, speaker_wav_hash=None):
+            return [mock_performance(text) for text in texts]
+
     monkeypatch.setattr("glowtalk.speak.Speaker", MockSpeakerModel)
 
+def mock_performance(text: str) -> np.ndarray:
+    """The audio the mock speaker performs text as: one sample per byte of
+    it, see decode_mock_performance."""
+    return np.frombuffer(bytes(text, "utf8"), dtype=np.uint8).astype(np.float32) / 256
+
+def encode_mock_performance(text: str) -> bytes:
+    """A WAV file of text as the mock speaker performs it."""
+    buffer = io.BytesIO()
+    sf.write(buffer, mock_performance(text), 24000, format="WAV", subtype="FLOAT")
+    return buffer.getvalue()
+
+def decode_mock_performance(wav_file_contents: bytes) -> str:
+    """Recover the text that the mock speaker performed, see mock_performance."""
+    samples, _ = sf.read(io.BytesIO(wav_file_contents), dtype="float32")
+    return (samples * 256).round().astype(np.uint8).tobytes().decode("utf8")
+
 @pytest.fixture
 def mock_glowfic_scraper(monkeypatch):
     """Mock the glowfic scraper to return our test data"""
@@ -96,15 +119,11 @@ def test_cwd(tmp_path):
 @pytest.fixture
 def db_sessionmaker(test_cwd):
     """Create a fresh database for each test"""
-    engine = create_engine(
-        "sqlite:///:memory:",
-        connect_args={"check_same_thread": False},
-        poolclass=StaticPool,
-    )
-    TestingSessionLocal = sessionmaker(bind=engine)
-
-    # Create all tables before yielding the sessionmaker
-    Base.metadata.create_all(bind=engine)
+    # A database file rather than an in-memory database, so that requests
+    # made from several threads at once each get their own connection, like
+    # they would in production.
+    TestingSessionLocal = init_db(f"sqlite:///{test_cwd / 'test.db'}", run_migrations=False)
+    engine = TestingSessionLocal.kw["bind"]
 
     def override_get_sessionmaker():
         return TestingSessionLocal
@@ -117,6 +136,8 @@ def db_sessionmaker(test_cwd):
     finally:
         Base.metadata.drop_all(bind=engine)
         app.dependency_overrides.clear()
+        # Forget this database's exports
+        export_manager.jobs.clear()
 
 @pytest.fixture
 def db_session(db_sessionmaker):
@@ -134,10 +155,11 @@ def client(db_sessionmaker):
 
 @pytest.fixture
 def mock_combine_wav_to_mp3(monkeypatch):
-    """Mock the combine_wav_to_mp3 function to verify WAV file contents"""
+    """Mock the combine_wav_to_mp3 function to verify WAV file contents, and
+    concatenate_mp3s to match"""
     call_count = 0
 
-    def mock_combine(wav_files, output_mp3_path):
+    def mock_combine(wav_files, output_mp3_path, shaping=None, joinable=False):
         nonlocal call_count
         call_count += 1
         # Read all WAV files and concatenate their contents
@@ -150,7 +172,14 @@ def mock_combine_wav_to_mp3(monkeypatch):
         with open(output_mp3_path, "wb") as f:
             f.write(combined_contents)
 
+    def mock_concatenate(mp3_files, output_mp3_path):
+        with open(output_mp3_path, "wb") as f:
+            for mp3_file in mp3_files:
+                with open(mp3_file, "rb") as mp3:
+                    f.write(mp3.read())
+
     monkeypatch.setattr("glowtalk.convert.combine_wav_to_mp3", mock_combine)
+    monkeypatch.setattr("glowtalk.convert.concatenate_mp3s", mock_concatenate)
     return lambda: call_count
 
 def find_free_port():
@@ -8,9 +8,14 @@ import os
 import json
 import time
 import asyncio
-
-from glowtalk import models
-from glowtalk.api import app, get_db
+import hashlib
+import io
+import numpy as np
+import soundfile as sf
+from pathlib import Path
+
+from glowtalk import models, convert
+from glowtalk.api import app, get_db, store_content_addressed, choose_audio_format
 from glowtalk.models import Base, OriginalWork, Speaker, SpeakerModel, WorkQueue
 from conftest import mock_glowfic_scraper, mock_speaker_model, test_server, test_cwd, db_session, client
 from starlette.testclient import TestClient as StarletteTestClient
@@ -396,3 +401,216 @@ async def test_ok_event(test_server):
         # Try to take another without waking, times out.
         with pytest.raises(asyncio.TimeoutError):
             await asyncio.wait_for(anext(messages), timeout=0.1)
+
+def test_store_content_addressed(tmp_path, monkeypatch):
+    monkeypatch.setattr("glowtalk.api.UPLOAD_CHUNK_SIZE", 1000)
+    data = os.urandom(10_500)
+    path, file_hash = store_content_addressed(io.BytesIO(data), tmp_path / "outputs", ".wav")
+    assert file_hash == hashlib.sha256(data).hexdigest()
+    assert path == tmp_path / "outputs" / f"{file_hash}.wav"
+    assert path.read_bytes() == data
+
+    # Storing the same thing again leaves the one copy
+    assert store_content_addressed(io.BytesIO(data), tmp_path / "outputs", ".wav") == (path, file_hash)
+    assert list((tmp_path / "outputs").iterdir()) == [path]
+
+def test_complete_work_item_streams_the_upload_to_disk(client, db_session, test_cwd, sample_work):
+    item = WorkQueue(content_piece_id=1, audiobook=models.Audiobook(original_work=sample_work), speaker_id=1)
+    db_session.add(item)
+    db_session.commit()
+    item = WorkQueue.assign_work_item(db_session, "worker")
+
+    noise = np.random.default_rng(0).uniform(-0.5, 0.5, 3 * 1024 * 1024 // 4 + 17).astype(np.float32)
+    data = convert.encode_wav(noise, 24000)
+    response = client.post(f"/api/queue/{item.id}/complete/worker", files={"generated_audio": ("audio.wav", data)})
+    assert response.status_code == 200
+    db_session.expire_all()
+    performance = db_session.get(WorkQueue, item.id).created_voice_performance
+    assert performance.audio_file_hash == hashlib.sha256(data).hexdigest()
+    assert Path(performance.audio_file_path).read_bytes() == data
+    assert [path.name for path in (test_cwd / "outputs").iterdir()] == [f"{performance.audio_file_hash}.wav"]
+
+    response = client.post("/api/queue/12345/complete/worker", files={"generated_audio": ("audio.wav", data)})
+    assert response.status_code == 404
+
+def test_uploads_that_arent_audio_we_take_are_rejected(client, db_session, test_cwd, sample_work):
+    item = WorkQueue(content_piece_id=1, audiobook=models.Audiobook(original_work=sample_work), speaker_id=1)
+    db_session.add(item)
+    db_session.commit()
+    item = WorkQueue.assign_work_item(db_session, "worker")
+
+    audio = (0.5 * np.sin(np.linspace(0, 200 * np.pi, 24000))).astype(np.float32)
+    vorbis = io.BytesIO()
+    sf.write(vorbis, audio, 24000, format="OGG", subtype="VORBIS")
+    truncated_flac = convert.encode_audio(audio, 24000, "flac")[:20]
+    for data in [b"RIFF and then not a WAV at all", truncated_flac, vorbis.getvalue()]:
+        response = client.post(f"/api/queue/{item.id}/complete/worker", files={"generated_audio": ("audio.wav", data)})
+        assert response.status_code == 400
+        response = client.post("/api/queue/complete_batch/worker", data={"item_ids": [item.id]},
+                               files=[("generated_audio", ("audio.wav", data))])
+        assert response.status_code == 400
+    db_session.expire_all()
+    assert db_session.get(WorkQueue, item.id).status == 'in_progress'
+    assert not (test_cwd / "outputs").exists() or not list((test_cwd / "outputs").iterdir())
+
+def test_complete_batch_reports_duplicates(client, db_session, test_cwd, sample_work):
+    audiobook = models.Audiobook(original_work=sample_work)
+    db_session.add_all([WorkQueue(content_piece_id=1, audiobook=audiobook, speaker_id=1) for _ in range(2)])
+    db_session.commit()
+    first, second = WorkQueue.assign_work_items(db_session, "worker", 2)
+    audio = convert.encode_wav(np.zeros(2400, dtype=np.float32), 24000)
+    def complete_batch(item_ids):
+        return client.post("/api/queue/complete_batch/worker", data={"item_ids": item_ids},
+                           files=[("generated_audio", ("audio.wav", audio)) for _ in item_ids])
+
+    response = complete_batch([first.id])
+    assert response.status_code == 200
+    assert response.json() == {"completed": [first.id], "duplicates": [], "not_found": []}
+    response = complete_batch([first.id, second.id, 12345])
+    assert response.json() == {"completed": [second.id], "duplicates": [first.id], "not_found": [12345]}
+    db_session.expire_all()
+    assert db_session.get(WorkQueue, first.id).duplicate_completions == 1
+
+def test_choose_audio_format():
+    assert choose_audio_format(None, ".flac") == ".flac"
+    assert choose_audio_format("*/*", ".opus") == ".opus"
+    assert choose_audio_format("audio/wav", ".flac") == ".wav"
+    assert choose_audio_format("audio/mpeg, audio/*;q=0.5", ".flac") == ".mp3"
+    assert choose_audio_format("audio/flac;q=0, audio/*", ".flac") == ".mp3"
+    assert choose_audio_format("audio/ogg;q=0.2, audio/wav;q=0.9", ".opus") == ".wav"
+    assert choose_audio_format("text/html", ".wav") is None
+
+def test_compressed_uploads_are_stored_as_uploaded(client, db_session, test_cwd, sample_work):
+    item = WorkQueue(content_piece_id=1, audiobook=models.Audiobook(original_work=sample_work), speaker_id=1)
+    db_session.add(item)
+    db_session.commit()
+    item = WorkQueue.assign_work_item(db_session, "worker")
+
+    audio = (0.5 * np.sin(np.linspace(0, 200 * np.pi, 24000))).astype(np.float32)
+    flac = convert.encode_audio(audio, 24000, "flac")
+    # Named and typed wrongly, the contents are what count
+    response = client.post(f"/api/queue/{item.id}/complete/worker", files={"generated_audio": ("audio.wav", flac, "audio/wav")})
+    assert response.status_code == 200
+    file_hash = hashlib.sha256(flac).hexdigest()
+    assert (test_cwd / "outputs" / f"{file_hash}.flac").read_bytes() == flac
+
+    response = client.get(f"/api/generated_audio_files/{file_hash}", headers={"Accept": "audio/flac, audio/*;q=0.1"})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "audio/flac"
+    assert response.content == flac
+
+    # Clients that only take WAV get it decoded, both here and from the
+    # WAV endpoint
+    for response in [
+        client.get(f"/api/generated_audio_files/{file_hash}", headers={"Accept": "audio/wav"}),
+        client.get(f"/api/generated_wav_files/{file_hash}"),
+    ]:
+        assert response.status_code == 200
+        assert response.headers["content-type"] in ("audio/wav", "audio/x-wav")
+        decoded, sample_rate = sf.read(io.BytesIO(response.content), dtype="float32")
+        assert sample_rate == 24000
+        np.testing.assert_allclose(decoded, audio, atol=1e-6)
+
+    response = client.get(f"/api/generated_audio_files/{file_hash}", headers={"Accept": "text/html"})
+    assert response.status_code == 406
+    response = client.get("/api/generated_audio_files/0123abcd")
+    assert response.status_code == 404
+    response = client.get("/api/generated_audio_files/..%2Ftest.db")
+    assert response.status_code == 404
+
+def test_generated_audio_is_cached_by_hash(client, test_cwd):
+    (test_cwd / "outputs").mkdir()
+    data = os.urandom(10_000)
+    file_hash = hashlib.sha256(data).hexdigest()
+    (test_cwd / "outputs" / f"{file_hash}.wav").write_bytes(data)
+
+    response = client.get(f"/api/generated_wav_files/{file_hash}")
+    assert response.status_code == 200
+    assert response.headers["etag"] == f'"{file_hash}.wav"'
+    assert response.headers["cache-control"] == "public, max-age=31536000, immutable"
+    assert response.content == data
+
+    # Revalidating doesn't need the database
+    def no_database():
+        raise AssertionError("The database shouldn't be needed")
+    app.dependency_overrides[get_db] = no_database
+    response = client.get(f"/api/generated_wav_files/{file_hash}", headers={"If-None-Match": f'"other", W/"{file_hash}.wav"'})
+    assert response.status_code == 304
+    assert response.headers["etag"] == f'"{file_hash}.wav"'
+    assert response.content == b""
+
+    # Each format is its own representation
+    response = client.get(f"/api/generated_audio_files/{file_hash}", headers={"If-None-Match": f'"{file_hash}.wav"'})
+    assert response.status_code == 304
+    assert response.headers["vary"] == "Accept"
+
+    # Seeking fetches just the part that's needed, as long as it's the same file
+    response = client.get(f"/api/generated_wav_files/{file_hash}", headers={"Range": "bytes=1000-1999"})
+    assert response.status_code == 206
+    assert response.headers["content-range"] == "bytes 1000-1999/10000"
+    assert response.content == data[1000:2000]
+    response = client.get(f"/api/generated_wav_files/{file_hash}", headers={"Range": "bytes=1000-1999", "If-Range": f'"{file_hash}.wav"'})
+    assert response.status_code == 206
+    response = client.get(f"/api/generated_wav_files/{file_hash}", headers={"Range": "bytes=1000-1999", "If-Range": '"stale"'})
+    assert response.status_code == 200
+    assert response.content == data
+    response = client.get(f"/api/generated_wav_files/{file_hash}", headers={"Range": "bytes=20000-"})
+    assert response.status_code == 416
+
+@pytest.fixture
+def long_audiobook(db_session, sample_speaker):
+    """An audiobook of five parts with two sentences each, the first of
+    which is performed in the first three parts."""
+    work = OriginalWork(url="https://glowfic.com/posts/5")
+    for i in range(5):
+        part = models.Part(character=f"Character {i}", author="author")
+        work.parts.append(part)
+        part.content_pieces.append(models.ContentPiece(text=f"Part {i}.", should_voice=True))
+        part.content_pieces.append(models.ContentPiece(text="\n", should_voice=False))
+        part.content_pieces.append(models.ContentPiece(text=f"Still part {i}.", should_voice=True))
+    audiobook = models.Audiobook(original_work=work, default_speaker=sample_speaker)
+    db_session.add(audiobook)
+    db_session.flush()
+    for part in work.parts[:3]:
+        db_session.add(models.VoicePerformance(audiobook=audiobook, content_piece=part.content_pieces[0], speaker=sample_speaker,
+                                               audio_file_path="a.wav", audio_file_hash=f"hash {part.id}"))
+    db_session.commit()
+    return audiobook
+
+def get_content(client, audiobook, **params):
+    response = client.get(f"/api/audiobooks/{audiobook.id}/content", params=params)
+    assert response.status_code == 200
+    return [json.loads(line) for line in response.text.splitlines()]
+
+def test_content_ranges_and_cursors(client, long_audiobook):
+    parts = get_content(client, long_audiobook)
+    assert [part["character_name"] for part in parts] == [f"Character {i}" for i in range(5)]
+    assert [piece["audio_file_hash"] for piece in parts[0]["content_pieces"]] == [f"hash {parts[0]['id']}", None, None]
+
+    assert get_content(client, long_audiobook, from_part=1, limit=2) == parts[1:3]
+    assert get_content(client, long_audiobook, cursor=parts[2]["cursor"]) == parts[3:]
+    assert get_content(client, long_audiobook, cursor=parts[0]["cursor"], limit=1) == parts[1:2]
+    assert get_content(client, long_audiobook, cursor=parts[4]["cursor"]) == []
+    assert get_content(client, long_audiobook, limit=0) == []
+
+    url = f"/api/audiobooks/{long_audiobook.id}/content"
+    assert client.get(url, params={"cursor": "not a cursor"}).status_code == 400
+    assert client.get(url, params={"cursor": parts[0]["cursor"], "from_part": 1}).status_code == 400
+    assert client.get(url, params={"limit": -1}).status_code == 400
+
+def test_table_of_contents(client, long_audiobook):
+    response = client.get(f"/api/audiobooks/{long_audiobook.id}/toc")
+    assert response.status_code == 200
+    parts = get_content(client, long_audiobook)
+    assert response.json() == [
+        {
+            "id": part["id"],
+            "character_name": f"Character {i}",
+            "screenname": None,
+            "author_name": "author",
+            "voiced": 2,
+            "rendered": 1 if i < 3 else 0,
+        }
+        for i, part in enumerate(parts)
+    ]
+    assert client.get("/api/audiobooks/12345/toc").status_code == 404
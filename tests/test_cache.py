@@ -0,0 +1,50 @@
+import hashlib
+import os
+import pytest
+
+from glowtalk.cache import ContentCache
+
+
+def test_content_addressed_entries(tmp_path):
+    cache = ContentCache(tmp_path)
+    data = b"a reference voice"
+    digest = hashlib.sha256(data).hexdigest()
+    assert cache.get("reference_voices", digest) is None
+
+    path = cache.put("reference_voices", digest, data)
+    assert path == tmp_path / "reference_voices" / digest
+    assert cache.get("reference_voices", digest) == path
+    assert ContentCache(tmp_path).read("reference_voices", digest) == data
+
+def test_keyed_entries_are_verified_on_read(tmp_path):
+    cache = ContentCache(tmp_path)
+    path = cache.put("conditioning", "XTTS_v2-alice", b"latents")
+    assert cache.read("conditioning", "XTTS_v2-alice") == b"latents"
+
+    # Replacing an entry removes the old version
+    new_path = cache.put("conditioning", "XTTS_v2-alice", b"better latents")
+    assert not path.exists()
+    assert cache.read("conditioning", "XTTS_v2-alice") == b"better latents"
+
+    new_path.write_bytes(b"better lat")
+    assert cache.read("conditioning", "XTTS_v2-alice") is None
+    assert not new_path.exists()
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = ContentCache(tmp_path, max_bytes=25)
+    for i, key in enumerate(["a", "b"]):
+        path = cache.put("things", key, b"0123456789")
+        os.utime(path, (1000 + i, 1000 + i))
+    # Reading a makes b the least recently used
+    assert cache.get("things", "a") is not None
+
+    cache.put("things", "c", b"0123456789")
+    assert cache.get("things", "b") is None
+    assert cache.read("things", "a") == b"0123456789"
+    assert cache.read("things", "c") == b"0123456789"
+
+def test_rejects_keys_that_could_escape_the_cache(tmp_path):
+    cache = ContentCache(tmp_path / "cache")
+    assert cache.get("things", "../../etc/passwd") is None
+    with pytest.raises(ValueError):
+        cache.put("things", "../escape", b"data")
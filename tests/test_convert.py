@@ -0,0 +1,199 @@
+import shutil
+import subprocess
+import threading
+import time
+import numpy as np
+import pytest
+import soundfile as sf
+
+from glowtalk import convert
+
+
+def test_combine_wavs_to_mp3s_encodes_in_parallel(tmp_path, monkeypatch):
+    running = 0
+    most_running = 0
+    lock = threading.Lock()
+    def combine_wav_to_mp3(wav_files, output_mp3_path, shaping=None, joinable=False):
+        nonlocal running, most_running
+        with lock:
+            running += 1
+            most_running = max(most_running, running)
+        time.sleep(0.05)
+        output_mp3_path.write_bytes(b"".join(wav_file.read_bytes() for wav_file in wav_files))
+        with lock:
+            running -= 1
+    monkeypatch.setattr(convert, "combine_wav_to_mp3", combine_wav_to_mp3)
+
+    jobs = []
+    for i in range(4):
+        wav_file = tmp_path / f"{i}.wav"
+        wav_file.write_bytes(bytes(f"sentence {i}", "utf8"))
+        jobs.append(([wav_file], tmp_path / "segments" / f"{i}.mp3", None))
+    convert.combine_wavs_to_mp3s(jobs, max_workers=4)
+
+    assert most_running == 4
+    assert [output.read_bytes() for _, output, _ in jobs] == [bytes(f"sentence {i}", "utf8") for i in range(4)]
+    assert sorted(path.name for path in (tmp_path / "segments").iterdir()) == ["0.mp3", "1.mp3", "2.mp3", "3.mp3"]
+
+def test_failed_encodes_leave_no_output(tmp_path, monkeypatch):
+    def combine_wav_to_mp3(wav_files, output_mp3_path, shaping=None, joinable=False):
+        output_mp3_path.write_bytes(b"half an mp3")
+        raise RuntimeError("FFmpeg error")
+    monkeypatch.setattr(convert, "combine_wav_to_mp3", combine_wav_to_mp3)
+
+    with pytest.raises(RuntimeError):
+        convert.combine_wavs_to_mp3s([([tmp_path / "missing.wav"], tmp_path / "out.mp3", None)])
+    assert list(tmp_path.iterdir()) == []
+
+def test_joinable_audio_ends_on_a_frame(tmp_path):
+    frame_size = convert.mp3_frame_size(24000)
+    assert frame_size == 576
+    chunks = [np.ones(1000, dtype=np.float32), np.zeros(5000, dtype=np.float32)]
+    trimmed = np.concatenate(list(convert._trim_for_frames(chunks, frame_size)))
+    # The encoder's delay and padding make it up to the last whole frame
+    assert len(trimmed) + convert.LAME_OVERHEAD == 6000 // frame_size * frame_size
+    assert trimmed[:1000].all() and not trimmed[1000:].any()
+
+    # Sound is never trimmed, only silence
+    chunks = [np.ones(6000, dtype=np.float32)]
+    assert len(np.concatenate(list(convert._trim_for_frames(chunks, frame_size)))) == 6000
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="needs ffmpeg")
+@pytest.mark.parametrize("sample_rate", [24000, 44100])
+def test_concatenated_segments_have_the_full_duration(tmp_path, sample_rate):
+    jobs = []
+    shaped_lengths = []
+    for i in range(3):
+        wav_file = tmp_path / f"{i}.wav"
+        sf.write(wav_file, 0.3 * np.sin(np.arange(sample_rate * 2 + i * 777) * (i + 1) / 20).astype(np.float32), sample_rate)
+        shaping = convert.DEFAULT_SHAPING.for_part_start() if i == 0 else convert.DEFAULT_SHAPING
+        shaped_lengths.append(sum(len(chunk) for chunk in convert.audio_chunks([wav_file], shaping)))
+        jobs.append(([wav_file], tmp_path / f"{i}.mp3", shaping))
+    convert.combine_wavs_to_mp3s(jobs, joinable=True)
+    convert.concatenate_mp3s([output for _, output, _ in jobs], tmp_path / "book.mp3")
+
+    # Each segment is as long as its audio, give or take a frame, so nothing
+    # is added between them
+    segment_lengths = [round(convert.mp3_duration(output) * sample_rate) for _, output, _ in jobs]
+    frame_size = convert.mp3_frame_size(sample_rate)
+    for segment_length, shaped_length in zip(segment_lengths, shaped_lengths):
+        assert shaped_length - frame_size < segment_length <= shaped_length
+    # and the book is as long as all of them
+    assert convert.mp3_duration(tmp_path / "book.mp3") * sample_rate == sum(segment_lengths)
+    # Decoders only leave out their own delay, at the start
+    decoded, _ = sf.read(tmp_path / "book.mp3")
+    assert sum(segment_lengths) - frame_size < len(decoded) <= sum(segment_lengths)
+
+@pytest.mark.parametrize("audio_format", ["wav", "flac", "opus"])
+def test_encode_audio_round_trips(tmp_path, audio_format):
+    audio = (0.5 * np.sin(np.linspace(0, 200 * np.pi, 24000))).astype(np.float32)
+    encoded = convert.encode_audio(audio, 24000, audio_format)
+    suffix = convert.audio_suffix(encoded[:16])
+    assert suffix == convert.AUDIO_FORMATS[audio_format][2]
+
+    stored_path = tmp_path / f"performance{suffix}"
+    stored_path.write_bytes(encoded)
+    convert.decode_to_wav(stored_path, tmp_path / "decoded" / "performance.wav")
+    decoded, sample_rate = sf.read(tmp_path / "decoded" / "performance.wav", dtype="float32")
+    assert sample_rate == 24000
+    assert len(decoded) == len(audio)
+    if audio_format == "opus":
+        # Lossy, but close
+        assert np.sqrt(np.mean((decoded - audio) ** 2)) < 0.05
+    else:
+        np.testing.assert_allclose(decoded, audio, atol=1e-6)
+
+    # FLAC is lossless, and much smaller than WAV
+    if audio_format == "flac":
+        assert len(encoded) < len(convert.encode_wav(audio, 24000)) / 2
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="needs ffmpeg")
+@pytest.mark.parametrize("stream_format", ["mp3", "opus"])
+def test_stream_audio_is_one_continuous_stream(tmp_path, stream_format):
+    sample_rate = 24000
+    wav_files = []
+    for i in range(3):
+        wav_file = tmp_path / f"{i}.wav"
+        sf.write(wav_file, np.sin(np.arange(sample_rate * 2) * (i + 1) / 20).astype(np.float32), sample_rate)
+        wav_files.append(wav_file)
+    stream = tmp_path / f"book.{stream_format}"
+    with stream.open("wb") as f:
+        for chunk in convert.stream_audio([wav_files], stream_format, chunk_size=4096):
+            assert len(chunk) <= 4096
+            f.write(chunk)
+    if stream_format == "mp3":
+        # A streamed MP3 has no Xing header to say how long it is, so its
+        # header only gives an estimate
+        duration = convert.mp3_duration(stream)
+    else:
+        duration = sf.info(stream).duration
+    assert duration == pytest.approx(6, abs=0.2)
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="needs ffmpeg")
+def test_closing_a_stream_stops_encoding(tmp_path, monkeypatch):
+    processes = []
+    popen = subprocess.Popen
+    def recording_popen(*args, **kwargs):
+        processes.append(popen(*args, **kwargs))
+        return processes[-1]
+    monkeypatch.setattr(subprocess, "Popen", recording_popen)
+    wav_file = tmp_path / "long.wav"
+    sf.write(wav_file, np.zeros(24000 * 60, dtype=np.float32), 24000)
+    # Parts are only taken as they're needed, so there can be no end to them
+    parts_closed = threading.Event()
+    def parts():
+        try:
+            while True:
+                yield [wav_file]
+        finally:
+            parts_closed.set()
+
+    stream = convert.stream_audio(parts(), chunk_size=1024)
+    assert next(stream)
+    stream.close()
+    [process] = processes
+    assert process.poll() is not None
+    assert parts_closed.is_set()
+
+def write_sentence(path, loudness, leading_silence=0.5, speech=1.0, trailing_silence=0.25, sample_rate=24000):
+    silence = lambda seconds: np.zeros(int(seconds * sample_rate), dtype=np.float32)
+    tone = loudness * np.sin(np.arange(int(speech * sample_rate)) / 5).astype(np.float32)
+    sf.write(path, np.concatenate([silence(leading_silence), tone, silence(trailing_silence)]), sample_rate, subtype="FLOAT")
+    return path
+
+def test_shaping_evens_out_loudness_and_silence(tmp_path):
+    quiet = write_sentence(tmp_path / "quiet.wav", 0.02)
+    loud = write_sentence(tmp_path / "loud.wav", 0.9, leading_silence=0.1, speech=0.5, trailing_silence=1.0)
+    shaping = convert.AudioShaping(target_dbfs=-20, sentence_pause=0.2, leading_pause=0.5)
+
+    shaped = np.concatenate(list(convert.shape_chunks([quiet, loud], shaping, chunk_size=1000)))
+    # Give or take the samples where the tones cross zero
+    assert shaped.shape[1] == 1
+    assert len(shaped) == pytest.approx((0.5 + 1.0 + 0.2 + 0.5 + 0.2) * 24000, abs=4)
+    shaped = shaped[:, 0]
+
+    first = shaped[int(0.5 * 24000) + 4:int(1.5 * 24000) - 4]
+    second = shaped[int(1.7 * 24000) + 4:int(2.2 * 24000) - 4]
+    target = 10 ** (-20 / 20)
+    for sentence in [first, second]:
+        assert np.sqrt(np.mean(sentence ** 2)) == pytest.approx(target, rel=0.01)
+    # Everything else is silence
+    assert not shaped[:int(0.5 * 24000)].any()
+    assert not shaped[int(1.5 * 24000) + 4:int(1.7 * 24000) - 4].any()
+    assert not shaped[int(2.2 * 24000) + 4:].any()
+
+def test_shaping_doesnt_clip_or_amplify_noise(tmp_path):
+    # Loud peaks with a quiet average would need more gain than they can take
+    spiky = np.zeros(24000, dtype=np.float32)
+    spiky[::1000] = 0.5
+    sf.write(tmp_path / "spiky.wav", spiky, 24000, subtype="FLOAT")
+    noise = write_sentence(tmp_path / "noise.wav", 0.004)
+    silent = tmp_path / "silent.wav"
+    sf.write(silent, np.zeros(24000, dtype=np.float32), 24000, subtype="FLOAT")
+    shaping = convert.AudioShaping(sentence_pause=0)
+
+    [*spiky_chunks] = convert.shape_chunks([tmp_path / "spiky.wav"], shaping)
+    assert np.abs(np.concatenate(spiky_chunks)).max() < 1
+    noise_chunks = np.concatenate(list(convert.shape_chunks([noise], shaping)))
+    assert np.abs(noise_chunks).max() == pytest.approx(0.004 * 10, rel=0.01)
+    assert list(convert.shape_chunks([silent], shaping)) == []
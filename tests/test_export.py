@@ -0,0 +1,294 @@
+import json
+import threading
+import time
+import pytest
+from pathlib import Path
+from typing import Optional
+
+from glowtalk import convert
+from glowtalk.export import ExportManager
+from glowtalk.models import OriginalWork, Part, ContentPiece, Audiobook, Speaker, SpeakerModel, ReferenceVoice, VoicePerformance
+from glowtalk.api import app, get_sessionmaker
+from conftest import test_cwd, db_sessionmaker, db_session, client, mock_combine_wav_to_mp3
+
+
+@pytest.fixture
+def performed_audiobook(db_session):
+    work = OriginalWork(url="https://glowfic.com/posts/1")
+    for character, texts in [("Alice", ["Hi.", "I'm Alice."]), ("Bob", ["Hello."])]:
+        part = Part(character=character)
+        work.parts.append(part)
+        for text in texts:
+            part.content_pieces.append(ContentPiece(text=text))
+    speaker = Speaker(model=SpeakerModel.XTTS_v2, reference_voice=ReferenceVoice(name="narrator", audio_path="narrator.wav", audio_hash="narrator"))
+    audiobook = Audiobook(original_work=work, default_speaker=speaker)
+    db_session.add(audiobook)
+    db_session.flush()
+    for part in work.parts:
+        for piece in part.content_pieces:
+            Path(f"{piece.id}.wav").write_bytes(bytes(piece.text, "utf8"))
+            db_session.add(VoicePerformance(audiobook=audiobook, content_piece=piece, speaker=speaker,
+                                            audio_file_path=f"{piece.id}.wav", audio_file_hash=f"hash {piece.id}"))
+    db_session.commit()
+    return audiobook
+
+@pytest.fixture
+def blocked_encoder(monkeypatch, mock_combine_wav_to_mp3):
+    """Holds up MP3 encoding until it's set."""
+    go = threading.Event()
+    combine = convert.combine_wav_to_mp3
+    def blocked_combine(wav_files, output_mp3_path, shaping=None, joinable=False):
+        assert go.wait(timeout=5)
+        combine(wav_files, output_mp3_path, shaping, joinable)
+    monkeypatch.setattr(convert, "combine_wav_to_mp3", blocked_combine)
+    return go
+
+def test_concurrent_exports_of_an_audiobook_share_a_job(db_sessionmaker, performed_audiobook, blocked_encoder, mock_combine_wav_to_mp3):
+    manager = ExportManager(max_workers=2)
+    job = manager.start(performed_audiobook.id, db_sessionmaker)
+    assert manager.start(performed_audiobook.id, db_sessionmaker) is job
+    assert manager.start(performed_audiobook.id, db_sessionmaker, force=True) is job
+    assert not job.finished
+
+    blocked_encoder.set()
+    manager.executor.shutdown(wait=True)
+    assert job.status == "done"
+    assert job.to_dict() == {
+        "audiobook_id": performed_audiobook.id,
+        "status": "done",
+        "segments_done": 2,
+        "segments_total": 2,
+        "error": None,
+    }
+    assert job.mp3_path.read_bytes() == b"Hi.I'm Alice.Hello."
+    assert mock_combine_wav_to_mp3() == 2
+
+def test_finished_exports_make_way_for_new_ones(db_sessionmaker, performed_audiobook, mock_combine_wav_to_mp3):
+    manager = ExportManager()
+    first = manager.start(performed_audiobook.id, db_sessionmaker)
+    manager.executor.submit(lambda: None).result()
+    assert first.finished
+    second = manager.start(performed_audiobook.id, db_sessionmaker, force=True)
+    assert second is not first
+    manager.executor.shutdown(wait=True)
+    assert manager.get(performed_audiobook.id) is second
+    assert mock_combine_wav_to_mp3() == 4
+
+def test_failed_exports_report_their_error(db_sessionmaker, performed_audiobook, monkeypatch):
+    def broken_combine(wav_files, output_mp3_path, shaping=None, joinable=False):
+        raise RuntimeError("FFmpeg error: out of cheese")
+    monkeypatch.setattr(convert, "combine_wav_to_mp3", broken_combine)
+    manager = ExportManager()
+    job = manager.start(performed_audiobook.id, db_sessionmaker)
+    manager.executor.shutdown(wait=True)
+    assert job.status == "failed"
+    assert "out of cheese" in job.error
+
+def test_export_progress_stream(client, performed_audiobook, blocked_encoder):
+    response = client.get(f"/api/audiobooks/{performed_audiobook.id}/mp3/progress")
+    assert response.status_code == 404
+
+    response = client.get(f"/api/audiobooks/{performed_audiobook.id}/mp3")
+    assert response.status_code == 202
+    assert response.headers["location"] == f"/api/audiobooks/{performed_audiobook.id}/mp3/progress"
+    blocked_encoder.set()
+
+    with client.stream("GET", response.headers["location"]) as response:
+        assert response.headers["content-type"].startswith("text/event-stream")
+        events = [json.loads(line[len("data: "):]) for line in response.iter_lines() if line.startswith("data: ")]
+    assert events[-1]["status"] == "done"
+    assert events[-1]["segments_done"] == events[-1]["segments_total"] == 2
+    response = client.get(f"/api/audiobooks/{performed_audiobook.id}/mp3")
+    assert response.content == b"Hi.I'm Alice.Hello."
+
+    # The book's MP3 changes when it's re-rendered, so clients revalidate it
+    assert response.headers["cache-control"] == "no-cache"
+    etag = response.headers["etag"]
+    response = client.get(f"/api/audiobooks/{performed_audiobook.id}/mp3", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["etag"] == etag
+    response = client.get(f"/api/audiobooks/{performed_audiobook.id}/mp3", headers={"Range": "bytes=3-", "If-Range": etag})
+    assert response.status_code == 206
+    assert response.content == b"I'm Alice.Hello."
+
+def test_mp3_of_an_unperformed_audiobook(client, db_session, performed_audiobook):
+    performed_audiobook.original_work.parts[0].content_pieces.append(ContentPiece(text="Not performed yet."))
+    db_session.commit()
+    assert client.get(f"/api/audiobooks/{performed_audiobook.id}/mp3").status_code == 409
+    assert client.post(f"/api/audiobooks/{performed_audiobook.id}/mp3").status_code == 409
+
+def test_stream_an_audiobook(client, db_session, performed_audiobook, monkeypatch):
+    streamed = []
+    def stream_audio(parts, stream_format, shaping=None):
+        streamed.append(stream_format)
+        for part_files in parts:
+            for audio_file in part_files:
+                yield Path(audio_file).read_bytes()
+            yield b"|"
+
+    monkeypatch.setattr(convert, "stream_audio", stream_audio)
+    url = f"/api/audiobooks/{performed_audiobook.id}/stream"
+
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "audio/mpeg"
+    assert response.content == b"Hi.I'm Alice.|Hello.|"
+
+    response = client.get(url, params={"format": "opus", "from_part": 0, "offset": 1})
+    assert response.headers["content-type"] == "audio/ogg"
+    assert response.content == b"I'm Alice.|Hello.|"
+    assert client.get(url, params={"from_part": 1}).content == b"Hello.|"
+    assert streamed == ["mp3", "opus", "mp3"]
+
+    # The stream stops where performances run out
+    performed_audiobook.original_work.parts[0].content_pieces.insert(1, ContentPiece(text="Not performed yet."))
+    db_session.commit()
+    assert client.get(url).content == b"Hi.|"
+    assert client.get(url, params={"offset": 1}).status_code == 409
+
+    assert client.get(url, params={"format": "aiff"}).status_code == 400
+    assert client.get(url, params={"offset": -1}).status_code == 400
+    assert client.get("/api/audiobooks/12345/stream").status_code == 404
+
+def get_playlist(client, audiobook_id: int) -> str:
+    """The URL of the media playlist that an audiobook's HLS multivariant
+    playlist points at."""
+    response = client.get(f"/api/audiobooks/{audiobook_id}/hls.m3u8")
+    assert response.status_code == 200
+    return f"/api/audiobooks/{audiobook_id}/{response.text.splitlines()[-1]}"
+
+def wait_for_playlist(client, url: str, listed: Optional[int] = None) -> list[str]:
+    """The lines of an HLS playlist, once it's finished, or lists the given
+    number of segments."""
+    deadline = time.time() + 10
+    while True:
+        lines = client.get(url).text.splitlines()
+        if listed is None and "#EXT-X-ENDLIST" in lines:
+            return lines
+        if listed is not None and sum(line.startswith("#EXTINF") for line in lines) >= listed:
+            return lines
+        assert time.time() < deadline, "Timed out waiting for the playlist"
+        time.sleep(0.01)
+
+def test_hls_playlist_grows_as_the_book_is_rendered(client, db_session, performed_audiobook, mock_combine_wav_to_mp3, monkeypatch):
+    # A second of audio per byte of our fake MP3s
+    monkeypatch.setattr(convert, "mp3_duration", lambda path: float(len(Path(path).read_bytes())))
+    alice, bob = performed_audiobook.original_work.parts
+    hello = bob.content_pieces[0]
+    db_session.delete(hello.performances[0])
+    db_session.commit()
+
+    response = client.get(f"/api/audiobooks/{performed_audiobook.id}/hls.m3u8")
+    assert response.headers["content-type"] == "application/vnd.apple.mpegurl"
+    assert response.headers["cache-control"] == "no-cache"
+    assert response.text.splitlines() == [
+        "#EXTM3U",
+        '#EXT-X-STREAM-INF:BANDWIDTH=320000,CODECS="mp4a.40.34"',
+        "hls/0.m3u8",
+    ]
+    url = f"/api/audiobooks/{performed_audiobook.id}/hls/0.m3u8"
+
+    response = client.get(url)
+    assert response.headers["content-type"] == "application/vnd.apple.mpegurl"
+    assert response.headers["cache-control"] == "no-cache"
+    lines = wait_for_playlist(client, url, listed=1)
+    assert lines == [
+        "#EXTM3U",
+        "#EXT-X-VERSION:3",
+        "#EXT-X-TARGETDURATION:13",
+        "#EXT-X-MEDIA-SEQUENCE:0",
+        "#EXT-X-PLAYLIST-TYPE:EVENT",
+        # How long the encoded segment is
+        "#EXTINF:13.000,",
+        lines[6],
+    ]
+    first_segment = lines[6]
+
+    # Segments already in the playlist stay as they are, even when their
+    # sentences are rendered again, and it carries on after the last
+    greeting = alice.content_pieces[0]
+    Path("again.wav").write_bytes(b"Hi again.")
+    db_session.add(VoicePerformance(audiobook=performed_audiobook, content_piece=greeting, speaker=performed_audiobook.default_speaker,
+                                    audio_file_path="again.wav", audio_file_hash="hash again"))
+    goodbye = ContentPiece(text="Goodbye.")
+    bob.content_pieces.append(goodbye)
+    db_session.flush()
+    for piece, text in [(hello, "Hello."), (goodbye, "Goodbye.")]:
+        Path(f"{piece.id}.wav").write_bytes(bytes(text, "utf8"))
+        db_session.add(VoicePerformance(audiobook=performed_audiobook, content_piece=piece, speaker=performed_audiobook.default_speaker,
+                                        audio_file_path=f"{piece.id}.wav", audio_file_hash=f"hash {piece.id}"))
+    db_session.commit()
+    lines = wait_for_playlist(client, url)
+    assert [line for line in lines if line.startswith("#EXTINF")] == ["#EXTINF:13.000,", "#EXTINF:14.000,"]
+    assert lines[6] == first_segment
+    assert lines[-1] == "#EXT-X-ENDLIST"
+    segment_names = [lines[6], lines[8]]
+    assert mock_combine_wav_to_mp3() == 2
+
+    # A finished playlist doesn't change, so a new one is made to be the
+    # book as it is, while players already listening carry on with the old
+    response = client.get(f"/api/audiobooks/{performed_audiobook.id}/hls.m3u8")
+    assert response.text.splitlines()[-1] == "hls/1.m3u8"
+    assert client.get(url).text.splitlines() == lines
+    lines = wait_for_playlist(client, f"/api/audiobooks/{performed_audiobook.id}/hls/1.m3u8")
+    assert [line for line in lines if line.startswith("#EXTINF")] == ["#EXTINF:19.000,", "#EXTINF:14.000,"]
+    assert lines[6] != first_segment
+    assert lines[8] == segment_names[1]
+    assert get_playlist(client, performed_audiobook.id).endswith("/hls/1.m3u8")
+    assert mock_combine_wav_to_mp3() == 3
+
+    segment_url = f"/api/audiobooks/{performed_audiobook.id}/hls/{segment_names[0]}"
+    response = client.get(segment_url)
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "audio/mpeg"
+    assert response.headers["cache-control"] == "public, max-age=31536000, immutable"
+    assert response.content == b"Hi.I'm Alice."
+
+    # Segments are served from disk
+    def no_database():
+        raise AssertionError("The database shouldn't be needed")
+    test_sessionmaker = app.dependency_overrides[get_sessionmaker]
+    app.dependency_overrides[get_sessionmaker] = lambda: no_database
+    assert client.get(segment_url).content == b"Hi.I'm Alice."
+    response = client.get(segment_url, headers={"If-None-Match": response.headers["etag"]})
+    assert response.status_code == 304
+    app.dependency_overrides[get_sessionmaker] = test_sessionmaker
+    assert mock_combine_wav_to_mp3() == 3
+
+    # and encoded again if they've gone missing
+    segment_url = f"/api/audiobooks/{performed_audiobook.id}/hls/{segment_names[1]}"
+    (Path("outputs") / "segments" / segment_names[1]).unlink()
+    assert client.get(segment_url).content == b"Hello.Goodbye."
+    assert mock_combine_wav_to_mp3() == 4
+    # unless they're no longer what's performed
+    (Path("outputs") / "segments" / segment_names[0]).unlink()
+    assert client.get(f"/api/audiobooks/{performed_audiobook.id}/hls/{segment_names[0]}").status_code == 404
+
+    assert client.get(f"/api/audiobooks/{performed_audiobook.id}/hls/..%2Ftest.db").status_code == 404
+    assert client.get(f"/api/audiobooks/{performed_audiobook.id}/hls/5.m3u8").status_code == 404
+    assert client.get("/api/audiobooks/12345/hls.m3u8").status_code == 404
+    assert client.get("/api/audiobooks/12345/hls/0.m3u8").status_code == 404
+
+def test_hls_playlist_carries_on_from_its_last_segment(client, db_session, performed_audiobook, mock_combine_wav_to_mp3, monkeypatch):
+    monkeypatch.setattr(convert, "mp3_duration", lambda path: float(len(Path(path).read_bytes())))
+    monkeypatch.setattr(Audiobook, "MAX_SEGMENT_SENTENCES", 1)
+    alice, _ = performed_audiobook.original_work.parts
+    introduction = alice.content_pieces[1]
+    db_session.delete(introduction.performances[0])
+    db_session.commit()
+    url = get_playlist(client, performed_audiobook.id)
+    lines = wait_for_playlist(client, url, listed=1)
+    assert [line for line in lines if line.startswith("#EXTINF")] == ["#EXTINF:3.000,"]
+
+    # Sentences added before where it's up to don't move it back
+    well = ContentPiece(text="Well.")
+    alice.content_pieces.insert(0, well)
+    db_session.flush()
+    for piece, text in [(well, "Well."), (introduction, "I'm Alice.")]:
+        Path(f"{piece.id}.wav").write_bytes(bytes(text, "utf8"))
+        db_session.add(VoicePerformance(audiobook=performed_audiobook, content_piece=piece, speaker=performed_audiobook.default_speaker,
+                                        audio_file_path=f"{piece.id}.wav", audio_file_hash=f"hash {piece.id}"))
+    db_session.commit()
+    lines = wait_for_playlist(client, url)
+    assert [line for line in lines if line.startswith("#EXTINF")] == ["#EXTINF:3.000,", "#EXTINF:10.000,", "#EXTINF:6.000,"]
+    assert len(set(line for line in lines if not line.startswith("#"))) == 3
@@ -6,16 +6,41 @@ from sqlalchemy.pool import StaticPool
 import os
 from pathlib import Path
 import json
-
-from glowtalk import models, worker
-from glowtalk.worker import Worker
+import threading
+import time
+import httpx
+import multiprocessing
+from datetime import datetime, timedelta
+
+from glowtalk import convert, models, worker
+from glowtalk.worker import Worker, SynthesisPool
 from glowtalk.api import app, get_db
 from glowtalk.models import Base, Speaker, SpeakerModel, WorkQueue, VoicePerformance
-from conftest import mock_glowfic_scraper, mock_speaker_model, test_cwd, db_session, client, mock_combine_wav_to_mp3
+from conftest import mock_glowfic_scraper, mock_speaker_model, test_cwd, db_session, client, mock_combine_wav_to_mp3, decode_mock_performance, encode_mock_performance
+
+
+def wait_for_mp3(client, audiobook_id: int) -> bytes:
+    """Get an audiobook's MP3, waiting for it to be exported if need be."""
+    deadline = time.time() + 10
+    while True:
+        response = client.get(f"/api/audiobooks/{audiobook_id}/mp3")
+        if response.status_code != 202:
+            break
+        assert time.time() < deadline, "Timed out waiting for the MP3 export"
+        time.sleep(0.01)
+    assert response.status_code == 200
+    return response.content
 
 
+def finish(worker: Worker, work_items: list[dict]) -> int:
+    """Run the worker's pipeline over items it has already taken, and only
+    those. Returns the number it completed."""
+    batches = iter([work_items])
+    worker.take_work = lambda: next(batches, [])
+    return worker.run_pipeline(stop_when_empty=True)
+
 def test_full_workflow(client, db_session, mock_glowfic_scraper, mock_speaker_model,
-                      mock_combine_wav_to_mp3, test_cwd):
+                      mock_combine_wav_to_mp3, test_cwd, monkeypatch):
     # Test getting recent works (should be empty initially)
     response = client.get("/api/works/recent")
     assert response.status_code == 200
@@ -143,7 +168,9 @@ def test_full_workflow(client, db_session, mock_glowfic_scraper, mock_speaker_mo
     assert mock_combine_wav_to_mp3() == expected_mp3_count
 
     worker_id = "test_worker"
-    worker = Worker(client, verbose=False, idle_threshold_seconds=5, worker_id=worker_id)
+    # Uploaded as wav, so the mock encoder passes the same bytes through
+    worker = Worker(client, verbose=False, idle_threshold_seconds=5, worker_id=worker_id, cache_dir=Path("worker_cache"),
+                    upload_format="wav")
 
     while True:
         response = client.post("/api/queue/take", json={"worker_id": worker_id, "version": 1})
@@ -157,11 +184,11 @@ def test_full_workflow(client, db_session, mock_glowfic_scraper, mock_speaker_mo
         expected_queue_status["pending"] -= 1
         assert expected_queue_status == client.get("/api/queue/status").json()
 
-        worker.work_one_item(item)
+        assert finish(worker, [item]) == 1
         expected_queue_status["completed"] += 1
         expected_queue_status["in_progress"] -= 1
         assert expected_queue_status == client.get("/api/queue/status").json()
-        expected_mp3_count += 1
+        # Completing work doesn't encode anything
         assert mock_combine_wav_to_mp3() == expected_mp3_count
 
 
@@ -208,21 +235,33 @@ def test_full_workflow(client, db_session, mock_glowfic_scraper, mock_speaker_mo
         client.get(f"/api/generated_wav_files/{wav_file_hash}").read()
         for wav_file_hash in wav_files
     ]
-    assert wav_file_contents == [
-        b"generated audio data for Alice (AliceScreen) (by AuthorOne):",
-        b"generated audio data for Hello there!",
-        b"generated audio data for This is Alice speaking.",
-        b"generated audio data for Bob (BobScreen) (by AuthorTwo):",
-        b"generated audio data for Hi Alice!",
-        b"generated audio data for This is Bob."
+    assert [decode_mock_performance(contents) for contents in wav_file_contents] == [
+        "Alice (AliceScreen) (by AuthorOne):",
+        "Hello there!",
+        "This is Alice speaking.",
+        "Bob (BobScreen) (by AuthorTwo):",
+        "Hi Alice!",
+        "This is Bob."
     ]
 
+    # A sentence's MP3 is made the first time it's asked for
     assert mock_combine_wav_to_mp3() == expected_mp3_count
+    for _ in range(2):
+        response = client.get(f"/api/generated_mp3_files/{wav_files[1]}")
+        assert response.status_code == 200
+        assert response.content == wav_file_contents[1]
+        assert mock_combine_wav_to_mp3() == expected_mp3_count + 1
+    expected_mp3_count += 1
+    assert client.get("/api/generated_mp3_files/0123abcd").status_code == 404
+    assert client.get("/api/generated_mp3_files/..%2F..%2Fsecrets").status_code == 404
+
     response = client.get(f"/api/audiobooks/{audiobook_id}/mp3")
-    assert response.status_code == 200
-    mp3_file = response.content
+    assert response.status_code == 202
+    assert response.json()["audiobook_id"] == audiobook_id
+    mp3_file = wait_for_mp3(client, audiobook_id)
     assert mp3_file == b"".join(wav_file_contents)
-    expected_mp3_count += 1
+    # One segment for each part
+    expected_mp3_count += 2
     assert mock_combine_wav_to_mp3() == expected_mp3_count
 
     # get it again, but it shouldn't call convert again
@@ -232,12 +271,23 @@ def test_full_workflow(client, db_session, mock_glowfic_scraper, mock_speaker_mo
     assert mp3_file == b"".join(wav_file_contents)
     assert mock_combine_wav_to_mp3() == expected_mp3_count # was cached
 
-    # but a POST request forces a new generation
+    # but a POST request forces a new generation, and until it's done, GET
+    # reports on it rather than serving the MP3 it's replacing
+    encoding = threading.Event()
+    combine = convert.combine_wav_to_mp3
+    def held_combine(wav_files, output_mp3_path, shaping=None, joinable=False):
+        assert encoding.wait(timeout=5)
+        combine(wav_files, output_mp3_path, shaping, joinable)
+    monkeypatch.setattr(convert, "combine_wav_to_mp3", held_combine)
     response = client.post(f"/api/audiobooks/{audiobook_id}/mp3")
-    assert response.status_code == 200
-    mp3_file = response.content
+    assert response.status_code == 202
+    response = client.get(f"/api/audiobooks/{audiobook_id}/mp3")
+    assert response.status_code == 202
+    assert response.json()["status"] in ("pending", "running")
+    encoding.set()
+    mp3_file = wait_for_mp3(client, audiobook_id)
     assert mp3_file == b"".join(wav_file_contents)
-    expected_mp3_count += 1
+    expected_mp3_count += 2
     assert mock_combine_wav_to_mp3() == expected_mp3_count
 
     response = client.post(f"/api/works/scrape_glowfic", json={"post_id": 5678})
@@ -280,7 +330,7 @@ def test_full_workflow(client, db_session, mock_glowfic_scraper, mock_speaker_mo
     assert queue_status == expected_queue_status
 
     # Finish the work item
-    response = client.post(f"/api/queue/{item['id']}/complete/{worker_id}", files={"generated_audio": (f"{item['text']}.wav", b"updated generated audio for text: " + bytes(item["text"], "utf8"))})
+    response = client.post(f"/api/queue/{item['id']}/complete/{worker_id}", files={"generated_audio": (f"{item['text']}.wav", encode_mock_performance("updated generated audio for text: " + item["text"]))})
     assert response.status_code == 200
     expected_queue_status["completed"] += 1
     expected_queue_status["in_progress"] -= 1
@@ -296,15 +346,21 @@ def test_full_workflow(client, db_session, mock_glowfic_scraper, mock_speaker_mo
         client.get(f"/api/generated_wav_files/{wav_file_hash}").read()
         for wav_file_hash in wav_files
     ]
-    assert wav_file_contents == [
-        b"updated generated audio for text: Alice (AliceScreen) (by AuthorOne):",
-        b"generated audio data for Hello there!",
-        b"generated audio data for This is Alice speaking.",
-        b"generated audio data for Bob (BobScreen) (by AuthorTwo):",
-        b"generated audio data for Hi Alice!",
-        b"generated audio data for This is Bob."
+    assert [decode_mock_performance(contents) for contents in wav_file_contents] == [
+        "updated generated audio for text: Alice (AliceScreen) (by AuthorOne):",
+        "Hello there!",
+        "This is Alice speaking.",
+        "Bob (BobScreen) (by AuthorTwo):",
+        "Hi Alice!",
+        "This is Bob."
     ]
 
+    # The mp3 is out of date now, and bringing it up to date only re-encodes
+    # the part with the new take in it.
+    expected_mp3_count = mock_combine_wav_to_mp3()
+    assert wait_for_mp3(client, audiobook_id) == b"".join(wav_file_contents)
+    assert mock_combine_wav_to_mp3() == expected_mp3_count + 1
+
     # Test streaming content endpoint
     response = client.get(f"/api/audiobooks/{audiobook_id}/content")
     assert response.status_code == 200
@@ -361,3 +417,164 @@ def test_full_workflow(client, db_session, mock_glowfic_scraper, mock_speaker_mo
     ]
     # All voiced pieces should have audio file hashes
     assert all(piece["audio_file_hash"] for piece in voiced_bob_pieces)
+
+
+@pytest.fixture
+def queued_audiobook(client, mock_glowfic_scraper, test_cwd):
+    """An audiobook for the mock glowfic, voiced entirely by alice, with all
+    of its content in the work queue. Returns the audiobook's id."""
+    response = client.post(
+        "/api/speakers",
+        data={"name": "alice", "model": "XTTS_v2"},
+        files={"reference_audio": ("alice.wav", b"test audio data for alice")}
+    )
+    assert response.status_code == 200
+    speaker_id = response.json()["id"]
+    work_id = client.post("/api/works/scrape_glowfic", json={"post_id": 1234}).json()["id"]
+    audiobook_id = client.post(
+        f"/api/works/{work_id}/audiobooks",
+        json={"description": "Test audiobook", "default_speaker_id": speaker_id}
+    ).json()["id"]
+    response = client.post(f"/api/audiobooks/{audiobook_id}/generate")
+    assert response.json()["queued_items"] == 6
+    return audiobook_id
+
+
+def test_batch_worker_protocol(client, queued_audiobook, mock_speaker_model, mock_combine_wav_to_mp3):
+    worker = Worker(client, verbose=False, idle_threshold_seconds=5, worker_id="batch_worker", batch_size=4,
+                    cache_dir=Path("worker_cache"))
+
+    work_items = worker.take_work()
+    assert worker.supports_batches
+    assert len(work_items) == 4
+    assert client.get("/api/queue/status").json() == {"pending": 2, "in_progress": 4, "completed": 0, "failed": 0}
+
+    # Nobody else gets the leased items
+    other_worker = Worker(client, verbose=False, idle_threshold_seconds=5, worker_id="other_worker", batch_size=10,
+                          cache_dir=Path("worker_cache"))
+    other_items = other_worker.take_work()
+    assert len(other_items) == 2
+    assert not {item["id"] for item in other_items} & {item["id"] for item in work_items}
+
+    assert finish(worker, work_items) == 4
+    assert finish(other_worker, other_items) == 2
+    assert client.get("/api/queue/status").json() == {"pending": 0, "in_progress": 0, "completed": 6, "failed": 0}
+    response = client.post("/api/queue/take_batch", json={"worker_id": "batch_worker", "version": 2, "max_items": 10})
+    assert response.json()["items"] == []
+
+    response = client.get(f"/api/audiobooks/{queued_audiobook}/wav_files")
+    assert response.json()["complete"]
+    assert [
+        decode_mock_performance(client.get(f"/api/generated_wav_files/{wav_file_hash}").read())
+        for wav_file_hash in response.json()["files"]
+    ] == [
+        "Alice (AliceScreen) (by AuthorOne):",
+        "Hello there!",
+        "This is Alice speaking.",
+        "Bob (BobScreen) (by AuthorTwo):",
+        "Hi Alice!",
+        "This is Bob.",
+    ]
+
+
+@pytest.mark.parametrize("supports_batches", [True, False])
+def test_pipelined_worker(client, queued_audiobook, mock_speaker_model, mock_combine_wav_to_mp3, supports_batches):
+    worker = Worker(client, verbose=False, idle_threshold_seconds=5, worker_id="pipelined_worker", batch_size=2,
+                    cache_dir=Path("worker_cache"))
+    if not supports_batches:
+        worker.client = _WithoutBatches(client)
+
+    assert worker.run_pipeline(stop_when_empty=True) == 6
+    assert worker.supports_batches == supports_batches
+    assert worker.lease_keeper.held == set()
+    assert client.get("/api/queue/status").json() == {"pending": 0, "in_progress": 0, "completed": 6, "failed": 0}
+    response = client.get(f"/api/audiobooks/{queued_audiobook}/wav_files")
+    assert [
+        decode_mock_performance(client.get(f"/api/generated_wav_files/{wav_file_hash}").read())
+        for wav_file_hash in response.json()["files"]
+    ][-1] == "This is Bob."
+
+
+def test_worker_with_several_synthesis_processes(client, queued_audiobook, mock_speaker_model, mock_combine_wav_to_mp3):
+    worker = Worker(client, verbose=False, idle_threshold_seconds=5, worker_id="many_core_worker", batch_size=1,
+                    cache_dir=Path("worker_cache"), processes=2, threads_per_process=1)
+    # Forked rather than spawned, so the processes get the mock speaker
+    worker.synthesis_pool = SynthesisPool(2, worker.cache_dir, worker.cache_max_bytes, threads_per_process=1,
+                                          mp_context=multiprocessing.get_context("fork"))
+    pool = worker.synthesis_pool
+    assert worker.run_pipeline(stop_when_empty=True) == 6
+    # Its processes are gone once the pipeline is done
+    assert worker.synthesis_pool is None
+    with pytest.raises(RuntimeError):
+        pool.submit([], {})
+
+    assert client.get("/api/queue/status").json() == {"pending": 0, "in_progress": 0, "completed": 6, "failed": 0}
+    response = client.get(f"/api/audiobooks/{queued_audiobook}/wav_files")
+    assert [
+        decode_mock_performance(client.get(f"/api/generated_wav_files/{wav_file_hash}").read())
+        for wav_file_hash in response.json()["files"]
+    ] == [
+        "Alice (AliceScreen) (by AuthorOne):",
+        "Hello there!",
+        "This is Alice speaking.",
+        "Bob (BobScreen) (by AuthorTwo):",
+        "Hi Alice!",
+        "This is Bob.",
+    ]
+
+
+def test_worker_falls_back_to_version_1(client, queued_audiobook, mock_speaker_model, mock_combine_wav_to_mp3):
+    worker = Worker(client, verbose=False, idle_threshold_seconds=5, worker_id="old_server_worker",
+                    cache_dir=Path("worker_cache"))
+    # Pretend the server predates batches
+    response = client.post("/api/queue/take_batch", json={"worker_id": "new_worker", "version": 3})
+    assert response.json() is None
+    worker.client = _WithoutBatches(client)
+
+    work_items = worker.take_work()
+    assert not worker.supports_batches
+    assert len(work_items) == 1
+    assert finish(worker, work_items) == 1
+    assert client.get("/api/queue/status").json() == {"pending": 5, "in_progress": 0, "completed": 1, "failed": 0}
+
+
+class _WithoutBatches:
+    """Wraps a client, answering requests for the batch API like an older server would."""
+    def __init__(self, client):
+        self.client = client
+
+    def post(self, url, **kwargs):
+        if url == "/api/queue/take_batch" or url.startswith("/api/queue/complete_batch/"):
+            return httpx.Response(404, json={"detail": "API Not found"})
+        return self.client.post(url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.client.get(url, **kwargs)
+
+
+def test_worker_heartbeats_keep_its_leases(client, queued_audiobook, mock_speaker_model, mock_combine_wav_to_mp3, db_session):
+    worker = Worker(client, verbose=False, idle_threshold_seconds=5, worker_id="slow_worker", batch_size=2, lease_seconds=60,
+                    cache_dir=Path("worker_cache"))
+    work_items = worker.take_work()
+    item_ids = [item["id"] for item in work_items]
+    assert worker.lease_keeper.held == set(item_ids)
+
+    # Let the first item's lease lapse, and have someone else take it
+    db_session.get(WorkQueue, item_ids[0]).lease_expires_at = datetime.utcnow() - timedelta(seconds=1)
+    db_session.commit()
+    response = client.post("/api/queue/take", json={"worker_id": "fast_worker", "version": 1})
+    assert response.json()["id"] == item_ids[0]
+
+    response = client.post(f"/api/queue/heartbeat/{worker.worker_id}", json={"item_ids": item_ids, "lease_seconds": 600})
+    assert response.status_code == 200
+    assert response.json() == {"renewed": [item_ids[1]], "lost": [item_ids[0]]}
+    db_session.expire_all()
+    assert db_session.get(WorkQueue, item_ids[1]).lease_expires_at > datetime.utcnow() + timedelta(minutes=9)
+
+    # Both workers finish the first item
+    assert finish(worker, work_items) == 2
+    assert worker.lease_keeper.held == set()
+    response = client.post(f"/api/queue/{item_ids[0]}/complete/fast_worker", files={"generated_audio": ("audio.wav", encode_mock_performance("Fast audio."))})
+    assert response.status_code == 200
+    db_session.expire_all()
+    assert db_session.get(WorkQueue, item_ids[0]).duplicate_completions == 1
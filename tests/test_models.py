@@ -0,0 +1,436 @@
+import pytest
+import threading
+from pathlib import Path
+from datetime import datetime, timedelta
+from sqlalchemy import event, insert
+
+from glowtalk.database import init_db, migrate
+
+from glowtalk.models import (
+    OriginalWork, Part, ContentPiece, Audiobook, Speaker, SpeakerModel,
+    ReferenceVoice, CharacterVoice, VoicePerformance, WorkQueue, WorkQueueCounter,
+)
+from conftest import test_cwd, db_sessionmaker, db_session, mock_combine_wav_to_mp3
+
+
+def make_speaker(db_session, name):
+    reference_voice = ReferenceVoice(name=name, audio_path=f"/references/{name}.wav", audio_hash=f"{name}-hash")
+    speaker = Speaker(model=SpeakerModel.XTTS_v2, reference_voice=reference_voice)
+    db_session.add(speaker)
+    return speaker
+
+def perform(db_session, audiobook, piece, speaker, take, generation_date=None):
+    performance = VoicePerformance(
+        audiobook=audiobook,
+        content_piece=piece,
+        speaker=speaker,
+        audio_file_path=f"/outputs/{piece.id}-{speaker.id}-{take}.wav",
+        audio_file_hash=f"{piece.id}-{speaker.id}-{take}",
+        generation_date=generation_date or datetime.utcnow(),
+    )
+    db_session.add(performance)
+    return performance
+
+def take_for(item, take):
+    """A performance for a work item, made like a worker's upload is."""
+    return VoicePerformance(
+        audiobook_id=item.audiobook_id,
+        content_piece_id=item.content_piece_id,
+        speaker_id=item.speaker_id,
+        audio_file_path=f"/outputs/{item.content_piece_id}-{item.speaker_id}-{take}.wav",
+        audio_file_hash=f"{item.content_piece_id}-{item.speaker_id}-{take}",
+    )
+
+@pytest.fixture
+def cast_audiobook(db_session):
+    """An audiobook with a default speaker, a character voice for each part's
+    character, and a piece-level character override."""
+    work = OriginalWork(url="https://glowfic.com/posts/1")
+    for character, texts in [("Alice", ["Hi.", "\n", "I'm Alice."]), ("Bob", ["Hello.", "Carol says hi."]), (None, ["The end."])]:
+        part = Part(character=character)
+        work.parts.append(part)
+        for text in texts:
+            part.content_pieces.append(ContentPiece(text=text, should_voice=text.strip() != ""))
+    work.parts[1].content_pieces[1].character = "Carol"
+    db_session.add(work)
+
+    narrator, alice, carol = (make_speaker(db_session, name) for name in ["narrator", "alice", "carol"])
+    audiobook = Audiobook(original_work=work, default_speaker=narrator)
+    db_session.add(audiobook)
+    db_session.add(CharacterVoice(audiobook=audiobook, character_name="Alice", speaker=alice))
+    db_session.add(CharacterVoice(audiobook=audiobook, character_name="Carol", speaker=carol))
+    db_session.commit()
+    return audiobook
+
+@pytest.fixture
+def count_queries(db_session):
+    statements = []
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    engine = db_session.get_bind()
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    yield lambda: len(statements)
+    event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+def test_resolve_content_pieces_matches_per_piece_lookup(db_session, cast_audiobook):
+    audiobook = cast_audiobook
+    pieces = [piece for part in audiobook.original_work.parts for piece in part.content_pieces]
+    # Perform everything but the last piece, and give the first piece a
+    # second take, plus a take from the wrong speaker.
+    now = datetime.utcnow()
+    for piece in pieces[:-1]:
+        if piece.should_voice:
+            perform(db_session, audiobook, piece, piece.get_speaker_for_audiobook(db_session, audiobook), 1, now)
+    perform(db_session, audiobook, pieces[0], pieces[0].get_speaker_for_audiobook(db_session, audiobook), 2, now + timedelta(seconds=1))
+    perform(db_session, audiobook, pieces[0], audiobook.default_speaker, 3, now + timedelta(seconds=2))
+    db_session.commit()
+
+    resolved = list(audiobook.resolve_content_pieces(db_session))
+    assert [piece for _, piece, _, _ in resolved] == pieces
+    for part, piece, speaker_id, performance in resolved:
+        assert part is piece.part
+        assert speaker_id == piece.get_speaker_for_audiobook(db_session, audiobook).id
+        assert performance == piece.get_performance_for_audiobook(db_session, audiobook)
+    assert resolved[0][3].audio_file_hash.endswith("-2")
+    assert [speaker_id for _, _, speaker_id, _ in resolved] == [
+        audiobook.character_voices[0].speaker_id] * 3 + [
+        audiobook.default_speaker_id, audiobook.character_voices[1].speaker_id,
+        audiobook.default_speaker_id,
+    ]
+    assert resolved[-1][3] is None
+
+    with pytest.raises(ValueError):
+        list(audiobook.get_performances(db_session))
+
+def test_get_performances_uses_constant_queries(db_session, cast_audiobook, count_queries):
+    audiobook = cast_audiobook
+    for part in audiobook.original_work.parts:
+        for piece in part.content_pieces:
+            if piece.should_voice:
+                perform(db_session, audiobook, piece, piece.get_speaker_for_audiobook(db_session, audiobook), 1)
+    db_session.commit()
+    audiobook_id = audiobook.id
+    db_session.expunge_all()
+
+    audiobook = db_session.get(Audiobook, audiobook_id)
+    before = count_queries()
+    performances = list(audiobook.get_performances(db_session))
+    assert len(performances) == 5
+    assert count_queries() - before == 1
+
+def test_resolve_parts_in_windows(db_session, cast_audiobook, count_queries):
+    audiobook = cast_audiobook
+    for _ in range(4):
+        part = Part(character="Bob")
+        audiobook.original_work.parts.append(part)
+        part.content_pieces.append(ContentPiece(text="More.", should_voice=True))
+    for part in audiobook.original_work.parts[::2]:
+        for piece in part.content_pieces:
+            if piece.should_voice:
+                perform(db_session, audiobook, piece, piece.get_speaker_for_audiobook(db_session, audiobook), 1)
+    db_session.commit()
+    expected = [
+        (part.id, [(piece.id, getattr(piece.get_performance_for_audiobook(db_session, audiobook), "id", None)) for piece in part.content_pieces])
+        for part in audiobook.original_work.parts
+    ]
+    audiobook_id = audiobook.id
+    db_session.expunge_all()
+
+    audiobook = db_session.get(Audiobook, audiobook_id)
+    before = count_queries()
+    resolved = [
+        (part.id, [(piece.id, getattr(performance, "id", None)) for piece, performance in pieces])
+        for part, pieces in audiobook.resolve_parts(db_session, first_window=2, max_window=3)
+    ]
+    assert resolved == expected
+    # Windows of 2 and 3 parts, then a third that finds the last two, with
+    # a query for each window's parts and one for their pieces
+    assert count_queries() - before == 6
+
+    parts = db_session.query(Part).filter_by(original_work_id=audiobook.original_work_id).order_by(Part.position).all()
+    resumed = [part.id for part, _ in audiobook.resolve_parts(db_session, after=(parts[3].position, parts[3].id))]
+    assert resumed == [part_id for part_id, _ in expected[4:]]
+
+def test_add_work_queue_items_skips_performed_and_queued(db_session, cast_audiobook):
+    audiobook = cast_audiobook
+    pieces = [piece for part in audiobook.original_work.parts for piece in part.content_pieces]
+    # Already performed by the right speaker
+    perform(db_session, audiobook, pieces[0], pieces[0].get_speaker_for_audiobook(db_session, audiobook), 1)
+    # Performed, but by a speaker who isn't cast for this piece any more
+    perform(db_session, audiobook, pieces[2], audiobook.default_speaker, 1)
+    db_session.commit()
+
+    assert audiobook.add_work_queue_items(db_session) == 4
+    queued = db_session.query(WorkQueue).order_by(WorkQueue.id).all()
+    assert [(item.content_piece_id, item.speaker_id) for item in queued] == [
+        (piece.id, piece.get_speaker_for_audiobook(db_session, audiobook).id)
+        for piece in pieces[2:]
+    ]
+    assert all(item.status == 'pending' and item.priority == 10 for item in queued)
+    assert all(item.audiobook_id == audiobook.id for item in queued)
+
+    assert audiobook.add_work_queue_items(db_session) == 0
+
+def test_add_work_queue_items_uses_constant_queries(db_session, cast_audiobook, count_queries):
+    audiobook = cast_audiobook
+    before = count_queries()
+    assert audiobook.add_work_queue_items(db_session) == 5
+    small_work_queries = count_queries() - before
+
+    part = audiobook.original_work.parts[0]
+    for i in range(100):
+        part.content_pieces.append(ContentPiece(text=f"Sentence {i}."))
+    db_session.commit()
+    before = count_queries()
+    assert audiobook.add_work_queue_items(db_session) == 100
+    assert count_queries() - before <= small_work_queries + 2
+
+def test_concurrent_workers_never_share_an_item(tmp_path):
+    sessionmaker = init_db(f"sqlite:///{tmp_path / 'queue.db'}")
+    with sessionmaker() as session:
+        session.execute(insert(WorkQueue), [
+            dict(content_piece_id=i, audiobook_id=1, speaker_id=1, priority=i % 3)
+            for i in range(200)
+        ])
+        session.commit()
+
+    claimed = []
+    def work(worker_id):
+        with sessionmaker() as session:
+            for _ in range(20):
+                item = WorkQueue.assign_work_item(session, worker_id)
+                assert item.worker_id == worker_id
+                claimed.append(item.id)
+
+    threads = [threading.Thread(target=work, args=(f"worker {i}",)) for i in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(claimed) == list(range(1, 201))
+
+def test_assign_work_item_takes_highest_priority_then_oldest(db_session):
+    now = datetime.utcnow()
+    db_session.add_all([
+        WorkQueue(content_piece_id=1, audiobook_id=1, speaker_id=1, priority=10, created_at=now),
+        WorkQueue(content_piece_id=2, audiobook_id=1, speaker_id=1, priority=100, created_at=now + timedelta(seconds=1)),
+        WorkQueue(content_piece_id=3, audiobook_id=1, speaker_id=1, priority=10, created_at=now - timedelta(seconds=1)),
+        WorkQueue(content_piece_id=4, audiobook_id=1, speaker_id=1, priority=100, status='completed'),
+    ])
+    db_session.commit()
+
+    taken = [WorkQueue.assign_work_item(db_session, "worker").content_piece_id for _ in range(3)]
+    assert taken == [2, 3, 1]
+
+def test_leased_items_are_only_reclaimed_once_expired(db_session):
+    db_session.add_all([
+        WorkQueue(content_piece_id=1, audiobook_id=1, speaker_id=1),
+        WorkQueue(content_piece_id=2, audiobook_id=1, speaker_id=1),
+    ])
+    db_session.commit()
+
+    slow = WorkQueue.assign_work_item(db_session, "slow worker", lease=timedelta(minutes=10))
+    fast = WorkQueue.assign_work_item(db_session, "fast worker")
+    assert {slow.content_piece_id, fast.content_piece_id} == {1, 2}
+    # The queue is empty, but nobody's lease has run out
+    assert WorkQueue.assign_work_item(db_session, "another worker") is None
+
+    fast.lease_expires_at = datetime.utcnow() - timedelta(seconds=1)
+    db_session.commit()
+    reclaimed = WorkQueue.assign_work_item(db_session, "another worker")
+    assert reclaimed.id == fast.id
+    assert reclaimed.worker_id == "another worker"
+    assert WorkQueue.assign_work_item(db_session, "another worker") is None
+
+def test_renew_leases(db_session):
+    db_session.add_all([WorkQueue(content_piece_id=i, audiobook_id=1, speaker_id=1) for i in range(3)])
+    db_session.commit()
+    mine = WorkQueue.assign_work_items(db_session, "me", 2)
+    theirs = WorkQueue.assign_work_item(db_session, "them")
+    original_expiry = mine[0].lease_expires_at
+
+    renewed = WorkQueue.renew_leases(db_session, "me", [item.id for item in mine] + [theirs.id], timedelta(minutes=30))
+    assert sorted(renewed) == sorted(item.id for item in mine)
+    assert mine[0].lease_expires_at > original_expiry + timedelta(minutes=20)
+
+    mine[1].lease_expires_at = datetime.utcnow() - timedelta(seconds=1)
+    db_session.commit()
+    assert WorkQueue.assign_work_item(db_session, "them").id == mine[1].id
+    assert WorkQueue.renew_leases(db_session, "me", [item.id for item in mine]) == [mine[0].id]
+
+def test_duplicate_completions_are_counted(db_session, cast_audiobook):
+    audiobook = cast_audiobook
+    piece = audiobook.original_work.parts[0].content_pieces[0]
+    speaker = piece.get_speaker_for_audiobook(db_session, audiobook)
+    item = WorkQueue(content_piece=piece, audiobook=audiobook, speaker=speaker)
+    db_session.add(item)
+    db_session.commit()
+
+    item.complete_work_item(db_session, "fast worker", take_for(item, 1))
+    assert item.duplicate_completions == 0
+    item.complete_work_item(db_session, "slow worker", take_for(item, 2))
+    item.complete_work_item(db_session, "slower worker", take_for(item, 3))
+    assert item.duplicate_completions == 2
+    assert item.worker_id == "fast worker"
+    # The late takes were dropped, so the accepted one is still the latest
+    assert [performance.audio_file_hash for performance in piece.performances] == [item.created_voice_performance.audio_file_hash]
+    assert piece.get_performance_for_audiobook(db_session, audiobook) == item.created_voice_performance
+
+def test_concurrent_completions_of_one_item(db_sessionmaker, db_session, cast_audiobook):
+    """Two workers finish the same item at once, each having read it while
+    it was still in progress."""
+    audiobook = cast_audiobook
+    audiobook.add_work_queue_items(db_session)
+    item_id = WorkQueue.assign_work_item(db_session, "worker").id
+
+    ready = threading.Barrier(2)
+    first_completions = []
+    def complete(worker_id, take):
+        with db_sessionmaker() as session:
+            item = session.get(WorkQueue, item_id)
+            assert item.status == 'in_progress'
+            ready.wait()
+            first_completions.append(item.complete_work_item(session, worker_id, take_for(item, take)))
+
+    threads = [threading.Thread(target=complete, args=(f"worker {take}", take)) for take in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(first_completions) == [False, True]
+    db_session.expire_all()
+    item = db_session.get(WorkQueue, item_id)
+    assert item.duplicate_completions == 1
+    assert db_session.query(VoicePerformance).filter_by(content_piece_id=item.content_piece_id).all() == [item.created_voice_performance]
+    # The winner's take is the one that was kept
+    winning_take = item.worker_id.removeprefix("worker ")
+    assert item.created_voice_performance.audio_file_hash.endswith(f"-{winning_take}")
+
+def test_queue_counters_follow_transitions(db_session, cast_audiobook):
+    audiobook = cast_audiobook
+    def assert_counters_match():
+        assert WorkQueueCounter.totals(db_session, audiobook.id) == WorkQueue.count_by_status(db_session, audiobook.id)
+        assert WorkQueueCounter.totals(db_session) == WorkQueue.count_by_status(db_session)
+
+    assert audiobook.add_work_queue_items(db_session) == 5
+    assert_counters_match()
+    assert WorkQueueCounter.totals(db_session)["pending"] == 5
+
+    stale, done, failed = WorkQueue.assign_work_items(db_session, "worker", 3)
+    assert_counters_match()
+    done.complete_work_item(db_session, "worker", take_for(done, 1))
+    failed.fail_work_item(db_session, "worker", "oops")
+    # Completing it again doesn't count it twice
+    done.complete_work_item(db_session, "slow worker", take_for(done, 2))
+    assert_counters_match()
+
+    stale.lease_expires_at = datetime.utcnow() - timedelta(seconds=1)
+    db_session.commit()
+    assert len(WorkQueue.assign_work_items(db_session, "another worker", 10)) == 3
+    assert_counters_match()
+    assert WorkQueueCounter.totals(db_session, audiobook.id) == {"pending": 0, "in_progress": 3, "completed": 1, "failed": 1}
+
+def test_queue_counters_survive_stale_items(db_sessionmaker, db_session, cast_audiobook):
+    """Completions and failures are usually for an item that was read before
+    a slow upload, and may have changed since."""
+    audiobook = cast_audiobook
+    audiobook.add_work_queue_items(db_session)
+    first, second = WorkQueue.assign_work_items(db_session, "worker", 2)
+
+    with db_sessionmaker() as other_session, db_sessionmaker() as reclaiming_session:
+        # Two workers both think they hold the first item
+        stale_first = other_session.get(WorkQueue, first.id)
+        stale_second = other_session.get(WorkQueue, second.id)
+        assert stale_first.status == stale_second.status == 'in_progress'
+
+        first.complete_work_item(db_session, "worker", take_for(first, 1))
+        stale_first.complete_work_item(other_session, "other worker", take_for(stale_first, 2))
+        assert stale_first.duplicate_completions == 1
+
+        # The second item's lease runs out while its worker is uploading
+        reclaiming_session.get(WorkQueue, second.id).lease_expires_at = datetime.utcnow() - timedelta(seconds=1)
+        reclaiming_session.commit()
+        WorkQueue.assign_work_items(reclaiming_session, "another worker", 0)
+        stale_second.fail_work_item(other_session, "worker", "oops")
+
+    expected = {"pending": 3, "in_progress": 0, "completed": 1, "failed": 1}
+    assert WorkQueue.count_by_status(db_session, audiobook.id) == expected
+    assert WorkQueueCounter.totals(db_session, audiobook.id) == expected
+
+def test_migrate_rebuilds_queue_counters(tmp_path):
+    db_url = f"sqlite:///{tmp_path / 'queue.db'}"
+    sessionmaker = init_db(db_url)
+    with sessionmaker() as session:
+        # As an older glowtalk would have, without the counters
+        session.execute(insert(WorkQueue), [
+            dict(content_piece_id=i, audiobook_id=1 + i % 2, speaker_id=1, status='completed' if i < 3 else 'pending')
+            for i in range(10)
+        ])
+        session.commit()
+    WorkQueueCounter.__table__.drop(sessionmaker.kw["bind"])
+
+    # They're counted when their table is made
+    sessionmaker = init_db(db_url)
+    with sessionmaker() as session:
+        assert WorkQueueCounter.totals(session) == {"pending": 7, "in_progress": 0, "completed": 3, "failed": 0}
+        assert WorkQueueCounter.totals(session, 1) == WorkQueue.count_by_status(session, 1) == {"pending": 3, "in_progress": 0, "completed": 2, "failed": 0}
+        # but after that they're kept up to date as the queue changes,
+        # rather than counted on every start
+        session.execute(insert(WorkQueue), [dict(content_piece_id=10, audiobook_id=1, speaker_id=1, status='pending')])
+        session.commit()
+    sessionmaker = init_db(db_url)
+    with sessionmaker() as session:
+        assert WorkQueueCounter.totals(session)["pending"] == 7
+
+    # unless they're asked to be
+    migrate(sessionmaker.kw["bind"], rebuild_queue_counters=True)
+    with sessionmaker() as session:
+        assert WorkQueueCounter.totals(session)["pending"] == 8
+
+def perform_everything(db_session, audiobook, take):
+    """Perform every voiced piece, with wav files in the working directory."""
+    for part in audiobook.original_work.parts:
+        for piece in part.content_pieces:
+            if piece.should_voice:
+                performance = perform(db_session, audiobook, piece, piece.get_speaker_for_audiobook(db_session, audiobook), take)
+                performance.audio_file_path = f"{performance.audio_file_hash}.wav"
+                Path(performance.audio_file_path).write_bytes(bytes(f"{piece.text} take {take}. ", "utf8"))
+    db_session.commit()
+
+def test_mp3_segments_follow_parts(db_session, cast_audiobook, monkeypatch):
+    audiobook = cast_audiobook
+    perform_everything(db_session, audiobook, 1)
+    assert [[performance.content_piece.text for performance in segment] for segment in audiobook.get_mp3_segments(db_session)] == [
+        ["Hi.", "I'm Alice."], ["Hello.", "Carol says hi."], ["The end."]
+    ]
+    monkeypatch.setattr(Audiobook, "MAX_SEGMENT_SENTENCES", 1)
+    assert len(audiobook.get_mp3_segments(db_session)) == 5
+
+def test_regenerating_an_mp3_only_encodes_changed_segments(db_session, cast_audiobook, mock_combine_wav_to_mp3):
+    audiobook = cast_audiobook
+    perform_everything(db_session, audiobook, 1)
+    first_mp3 = audiobook.get_or_generate_mp3(db_session)
+    assert mock_combine_wav_to_mp3() == 3
+    assert first_mp3.read_bytes() == b"Hi. take 1. I'm Alice. take 1. Hello. take 1. Carol says hi. take 1. The end. take 1. "
+    assert audiobook.get_or_generate_mp3(db_session) == first_mp3
+    assert mock_combine_wav_to_mp3() == 3
+
+    # A new take of one sentence
+    piece = audiobook.original_work.parts[1].content_pieces[0]
+    performance = perform(db_session, audiobook, piece, piece.get_speaker_for_audiobook(db_session, audiobook), 2,
+                          datetime.utcnow() + timedelta(seconds=1))
+    performance.audio_file_path = "new take.wav"
+    Path("new take.wav").write_bytes(b"Hello again. ")
+    db_session.commit()
+
+    second_mp3 = audiobook.get_or_generate_mp3(db_session)
+    assert mock_combine_wav_to_mp3() == 4
+    assert second_mp3 != first_mp3
+    assert not first_mp3.exists()
+    assert second_mp3.read_bytes() == b"Hi. take 1. I'm Alice. take 1. Hello again. Carol says hi. take 1. The end. take 1. "
+
+    # Forcing re-encodes everything
+    assert audiobook.generate_mp3(db_session, force=True) == second_mp3
+    assert mock_combine_wav_to_mp3() == 7
@@ -0,0 +1,221 @@
+import asyncio
+import contextlib
+import json
+import threading
+import httpx
+import pytest
+
+from glowtalk import progress
+from glowtalk.progress import ProgressHub, RenderedPiece
+from glowtalk.models import OriginalWork, Part, ContentPiece, Audiobook, Speaker, SpeakerModel, ReferenceVoice, VoicePerformance, WorkQueue
+from glowtalk.api import app
+from conftest import test_cwd, db_sessionmaker, db_session, client
+
+
+async def next_update(updates, timeout=1.0):
+    return await asyncio.wait_for(anext(updates), timeout)
+
+
+async def next_counts(updates, timeout=1.0):
+    return (await next_update(updates, timeout)).counts
+
+
+async def test_watchers_share_one_load_and_get_published_changes():
+    hub = ProgressHub()
+    loads = []
+    def load_counts():
+        loads.append(1)
+        return {"pending": 3}
+
+    async with contextlib.aclosing(hub.watch(1, load_counts)) as first, \
+               contextlib.aclosing(hub.watch(1, load_counts)) as second:
+        expected = {"pending": 3, "in_progress": 0, "completed": 0, "failed": 0}
+        assert await next_counts(first) == expected
+        assert await next_counts(second) == expected
+
+        # Published from another thread, like a request handler's would be
+        publisher = threading.Thread(target=hub.publish, args=(1, {"pending": -1, "in_progress": 1}))
+        publisher.start()
+        publisher.join()
+        expected = {"pending": 2, "in_progress": 1, "completed": 0, "failed": 0}
+        assert await next_counts(first) == expected
+        assert await next_counts(second) == expected
+
+        # Other audiobooks' changes don't wake us
+        hub.publish(2, {"pending": 5})
+        with pytest.raises(asyncio.TimeoutError):
+            await next_counts(first, timeout=0.1)
+    assert loads == [1]
+    # Once nobody's watching, we stop keeping track
+    assert hub.audiobooks == {}
+
+
+async def test_changes_published_while_loading_are_kept():
+    hub = ProgressHub()
+    def load_counts():
+        # This change committed after the load read the table
+        hub.publish(1, {"pending": -1, "completed": 1})
+        return {"pending": 2}
+
+    async with contextlib.aclosing(hub.watch(1, load_counts)) as updates:
+        assert await next_counts(updates) == {"pending": 1, "in_progress": 0, "completed": 1, "failed": 0}
+
+
+async def test_resync_reloads_counts():
+    hub = ProgressHub(resync_interval=0.05)
+    counts = iter([{"pending": 2}, {"pending": 1, "completed": 1}])
+
+    async with contextlib.aclosing(hub.watch(1, lambda: next(counts))) as updates:
+        assert (await next_counts(updates))["pending"] == 2
+        assert (await next_counts(updates))["pending"] == 1
+
+
+async def test_rendered_pieces():
+    hub = ProgressHub()
+    hub.publish(1, {}, rendered=[RenderedPiece(1, 10, "before")])
+
+    async with contextlib.aclosing(hub.watch(1, lambda: {"pending": 2})) as updates:
+        first = await next_update(updates)
+        # We weren't watching when that one was rendered
+        assert first.rendered == []
+        assert not first.missed_rendered
+
+        pieces = [RenderedPiece(2, 11, "a"), RenderedPiece(3, 12, "b")]
+        hub.publish(1, {"in_progress": -2, "completed": 2}, rendered=pieces)
+        update = await next_update(updates)
+        assert update.rendered == pieces
+        assert update.counts["completed"] == 2
+
+        # A watcher that falls too far behind is told so
+        for number in range(progress.RENDERED_BACKLOG + 1):
+            hub.publish(1, {}, rendered=[RenderedPiece(100 + number, 13, "c")])
+        update = await next_update(updates)
+        assert len(update.rendered) == progress.RENDERED_BACKLOG
+        assert update.missed_rendered
+
+
+@pytest.fixture
+def queued_audiobook(db_session):
+    work = OriginalWork(url="https://glowfic.com/posts/1")
+    part = Part(character="Alice")
+    work.parts.append(part)
+    for text in ["Hi.", "I'm Alice."]:
+        part.content_pieces.append(ContentPiece(text=text))
+    speaker = Speaker(model=SpeakerModel.XTTS_v2, reference_voice=ReferenceVoice(name="narrator", audio_path="narrator.wav", audio_hash="narrator"))
+    audiobook = Audiobook(original_work=work, default_speaker=speaker)
+    db_session.add(audiobook)
+    db_session.commit()
+    assert audiobook.add_work_queue_items(db_session) == 2
+    return audiobook
+
+
+async def test_generation_progress_follows_the_queue(db_sessionmaker, queued_audiobook):
+    audiobook_id = queued_audiobook.id
+
+    def work_through_queue():
+        with db_sessionmaker() as session:
+            items = WorkQueue.assign_work_items(session, "worker", 2)
+            items[0].fail_work_item(session, "worker", "oops")
+            performance = VoicePerformance(audiobook_id=audiobook_id, content_piece=items[1].content_piece,
+                                           speaker=items[1].speaker, audio_file_path="1.wav", audio_file_hash="1")
+            items[1].complete_work_item(session, "worker", performance)
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+        async def read_events():
+            async with client.stream("GET", f"/api/audiobooks/{audiobook_id}/generation_progress") as response:
+                assert response.status_code == 200
+                return [json.loads(line[len("data: "):]) async for line in response.aiter_lines()
+                        if line.startswith("data: ")]
+        events = asyncio.create_task(read_events())
+        # Wait until the stream has its counts, then work through the queue
+        while getattr(progress.hub.audiobooks.get(audiobook_id), "counts", None) is None:
+            await asyncio.sleep(0.01)
+        await asyncio.to_thread(work_through_queue)
+        events = await asyncio.wait_for(events, 2)
+
+    assert events[0] == {"audiobook_id": audiobook_id, "pending": 2, "in_progress": 0, "completed": 0, "failed": 0}
+    assert events[-1] == {"audiobook_id": audiobook_id, "pending": 0, "in_progress": 0, "completed": 1, "failed": 1}
+    assert audiobook_id not in progress.hub.audiobooks
+
+
+async def read_progress_events(client, url, headers=None) -> list[tuple[str, str, dict]]:
+    """(event, id, data) of each event on the stream, until it ends."""
+    events = []
+    event, id = "message", None
+    async with client.stream("GET", url, headers=headers) as response:
+        assert response.status_code == 200
+        async for line in response.aiter_lines():
+            if line.startswith("event: "):
+                event = line[len("event: "):]
+            elif line.startswith("id: "):
+                id = line[len("id: "):]
+            elif line.startswith("data: "):
+                events.append((event, id, json.loads(line[len("data: "):])))
+                event, id = "message", None
+    return events
+
+
+async def test_generation_progress_pieces(db_sessionmaker, queued_audiobook):
+    audiobook_id = queued_audiobook.id
+    url = f"/api/audiobooks/{audiobook_id}/generation_progress?pieces=true"
+
+    def complete_next_item():
+        with db_sessionmaker() as session:
+            item, = WorkQueue.assign_work_items(session, "worker", 1)
+            performance = VoicePerformance(audiobook_id=audiobook_id, content_piece=item.content_piece,
+                                           speaker=item.speaker, audio_file_path=f"{item.id}.wav", audio_file_hash=f"hash {item.id}")
+            item.complete_work_item(session, "worker", performance)
+            return str(performance.id), {"audiobook_id": audiobook_id, "content_piece_id": item.content_piece_id,
+                                         "audio_file_hash": performance.audio_file_hash}
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+        first = await asyncio.to_thread(complete_next_item)
+        events = asyncio.create_task(read_progress_events(client, url))
+        while getattr(progress.hub.audiobooks.get(audiobook_id), "counts", None) is None:
+            await asyncio.sleep(0.01)
+        second = await asyncio.to_thread(complete_next_item)
+        events = await asyncio.wait_for(events, 2)
+
+        # Only the piece rendered while we were watching
+        assert [(id, data) for event, id, data in events if event == "piece"] == [second]
+        assert events[-1][2]["completed"] == 2
+
+        # Reconnecting catches up on everything after the last piece seen
+        last_seen = int(first[0]) - 1
+        events = await asyncio.wait_for(read_progress_events(client, url, headers={"Last-Event-ID": str(last_seen)}), 2)
+        assert [(id, data) for event, id, data in events if event == "piece"] == [first, second]
+
+        # An id that isn't one of ours is ignored
+        events = await asyncio.wait_for(read_progress_events(client, url, headers={"Last-Event-ID": "abc"}), 2)
+        assert [event for event, _, _ in events] == ["message"]
+
+
+async def test_generation_progress_catches_up_on_missed_pieces(db_sessionmaker, queued_audiobook, monkeypatch):
+    # Every piece falls out of the hub's backlog, so they can only come
+    # from catching up with the database
+    monkeypatch.setattr(progress, "RENDERED_BACKLOG", 0)
+    audiobook_id = queued_audiobook.id
+    url = f"/api/audiobooks/{audiobook_id}/generation_progress?pieces=true"
+
+    def complete_next_item():
+        with db_sessionmaker() as session:
+            item, = WorkQueue.assign_work_items(session, "worker", 1)
+            performance = VoicePerformance(audiobook_id=audiobook_id, content_piece=item.content_piece,
+                                           speaker=item.speaker, audio_file_path=f"{item.id}.wav", audio_file_hash=f"hash {item.id}")
+            item.complete_work_item(session, "worker", performance)
+            return str(performance.id)
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+        await asyncio.to_thread(complete_next_item)
+        events = asyncio.create_task(read_progress_events(client, url))
+        while getattr(progress.hub.audiobooks.get(audiobook_id), "counts", None) is None:
+            await asyncio.sleep(0.01)
+        second = await asyncio.to_thread(complete_next_item)
+        events = await asyncio.wait_for(events, 2)
+
+    assert [id for event, id, _ in events if event == "piece"] == [second]
+
+
+def test_generation_progress_unknown_audiobook(client):
+    response = client.get("/api/audiobooks/999/generation_progress")
+    assert response.status_code == 404
@@ -0,0 +1,109 @@
+import numpy as np
+
+from glowtalk.models import SpeakerModel
+from glowtalk.cache import ContentCache
+from glowtalk.speak import ConditioningCache, Speaker
+
+
+class Computer:
+    """Counts how often the cache asks for conditioning to be computed."""
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return (np.full((1, 4), self.calls, dtype=np.float32), np.arange(3, dtype=np.float32))
+
+
+def test_conditioning_cache_computes_each_voice_once(tmp_path):
+    cache = ConditioningCache(ContentCache(tmp_path))
+    compute = Computer()
+    first = cache.get_or_compute(SpeakerModel.XTTS_v2, "alice", compute)
+    second = cache.get_or_compute(SpeakerModel.XTTS_v2, "alice", compute)
+    assert compute.calls == 1
+    assert second is first
+    cache.get_or_compute(SpeakerModel.XTTS_v2, "bob", compute)
+    assert compute.calls == 2
+
+def test_conditioning_cache_persists_between_runs(tmp_path):
+    compute = Computer()
+    original = ConditioningCache(ContentCache(tmp_path)).get_or_compute(SpeakerModel.XTTS_v2, "alice", compute)
+
+    restarted = ConditioningCache(ContentCache(tmp_path)).get_or_compute(SpeakerModel.XTTS_v2, "alice", compute)
+    assert compute.calls == 1
+    assert len(restarted) == 2
+    for original_latent, restarted_latent in zip(original, restarted):
+        np.testing.assert_array_equal(original_latent, restarted_latent)
+    assert [path.name.split(".")[0] for path in (tmp_path / "conditioning").iterdir()] == ["XTTS_v2-alice"]
+
+def test_conditioning_cache_evicts_least_recently_used(tmp_path):
+    cache = ConditioningCache(max_entries=2)
+    compute = Computer()
+    for voice in ["alice", "bob", "alice", "carol"]:
+        cache.get_or_compute(SpeakerModel.XTTS_v2, voice, compute)
+    assert [audio_hash for _, audio_hash in cache.entries] == ["alice", "carol"]
+    cache.get_or_compute(SpeakerModel.XTTS_v2, "bob", compute)
+    assert compute.calls == 4
+
+def test_conditioning_cache_recovers_from_unreadable_entries(tmp_path):
+    ContentCache(tmp_path).put("conditioning", "XTTS_v2-alice", b"not an npz file")
+    cache = ConditioningCache(ContentCache(tmp_path))
+    compute = Computer()
+    cache.get_or_compute(SpeakerModel.XTTS_v2, "alice", compute)
+    assert compute.calls == 1
+    assert ConditioningCache(ContentCache(tmp_path)).get_or_compute(SpeakerModel.XTTS_v2, "alice", compute)[0][0, 0] == 1
+
+def test_conditioning_cache_keeps_unsafe_hashes_in_memory(tmp_path):
+    cache = ConditioningCache(ContentCache(tmp_path / "cache"))
+    cache.get_or_compute(SpeakerModel.XTTS_v2, "../escape", Computer())
+    assert list(tmp_path.iterdir()) == []
+
+
+class FakeXtts:
+    """Records how speak_batch drives XTTS."""
+    class config:
+        gpt_cond_len = 12
+        gpt_cond_chunk_len = 4
+        max_ref_len = 10
+        sound_norm_refs = True
+        temperature = 0.65
+        length_penalty = 1.5
+        repetition_penalty = 5.0
+        top_k = 40
+        top_p = 0.8
+
+    def __init__(self):
+        self.conditioning_calls = []
+        self.inference_calls = []
+
+    def get_conditioning_latents(self, **kwargs):
+        self.conditioning_calls.append(kwargs)
+        return "latent", "embedding"
+
+    def inference(self, text, language, gpt_cond_latent, speaker_embedding, **kwargs):
+        self.inference_calls.append((text, kwargs))
+        return {"wav": [1.0] * len(text)}
+
+
+def fake_speaker():
+    model = FakeXtts()
+    speaker = Speaker.__new__(Speaker)
+    speaker.tts = type("TTS", (), {})()
+    speaker.tts.synthesizer = type("Synthesizer", (), {})()
+    speaker.tts.synthesizer.tts_model = model
+    speaker.tts.synthesizer.split_into_sentences = lambda text: text.split("|")
+    return speaker, model
+
+
+def test_speak_batch_uses_the_model_config():
+    speaker, model = fake_speaker()
+    performances = speaker.speak_batch(["One.|Two!", "Three."], "voice.wav", top_k=7)
+
+    assert model.conditioning_calls == [dict(
+        audio_path=["voice.wav"], gpt_cond_len=12, gpt_cond_chunk_len=4, max_ref_length=10, sound_norm_refs=True,
+    )]
+    settings = dict(temperature=0.65, length_penalty=1.5, repetition_penalty=5.0, top_k=7, top_p=0.8)
+    assert model.inference_calls == [("One.", settings), ("Two!", settings), ("Three.", settings)]
+    # Sentences of one text are joined with a pause, like tts_to_file does
+    assert len(performances[0]) == len("One.") + Speaker.SENTENCE_GAP + len("Two!")
+    assert len(performances[1]) == len("Three.")
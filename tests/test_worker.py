@@ -0,0 +1,251 @@
+import hashlib
+import threading
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+import httpx
+import pytest
+
+from glowtalk import models
+from glowtalk.worker import Worker
+from conftest import decode_mock_performance, mock_performance
+
+VOICES = {name: bytes(f"{name}'s reference voice", "utf8") for name in ["alice", "bob"]}
+VOICE_HASHES = {name: hashlib.sha256(voice).hexdigest() for name, voice in VOICES.items()}
+
+
+class RecordingSpeaker:
+    """Performs like the mock speaker in conftest, remembering each batch."""
+    sample_rate = 24000
+
+    def __init__(self):
+        self.batches = []
+
+    def speak_batch(self, texts, speaker_wav, speaker_wav_hash=None):
+        assert hashlib.sha256(speaker_wav.read_bytes()).hexdigest() == speaker_wav_hash
+        self.batches.append((list(texts), speaker_wav_hash))
+        return [mock_performance(text) for text in texts]
+
+
+class ReferenceVoiceClient:
+    """Serves reference voices, and nothing else."""
+    def __init__(self):
+        self.requests = []
+
+    def get(self, url, **kwargs):
+        self.requests.append(url)
+        audio_hash = url.rsplit("/", 1)[1]
+        for voice in VOICES.values():
+            if hashlib.sha256(voice).hexdigest() == audio_hash:
+                return httpx.Response(200, content=voice, request=httpx.Request("GET", url))
+        return httpx.Response(200, content=b"not the voice you asked for", request=httpx.Request("GET", url))
+
+
+def work_item(id, text, voice):
+    return {
+        "id": id,
+        "text": text,
+        "speaker_model": models.SpeakerModel.XTTS_v2.value,
+        "reference_audio_hash": VOICE_HASHES.get(voice, voice),
+    }
+
+
+def make_worker(cache_dir, **kwargs):
+    worker = Worker(ReferenceVoiceClient(), worker_id="test_worker", cache_dir=cache_dir, **kwargs)
+    worker.speakers[models.SpeakerModel.XTTS_v2] = RecordingSpeaker()
+    return worker
+
+@pytest.fixture
+def worker(tmp_path):
+    return make_worker(tmp_path / "cache")
+
+
+def test_perform_batch_conditions_each_voice_once(worker):
+    items = [
+        work_item(1, "One.", "alice"),
+        work_item(2, "Two.", "bob"),
+        work_item(3, "Three.", "alice"),
+    ]
+    results = worker.perform_batch(items)
+
+    speaker = worker.speakers[models.SpeakerModel.XTTS_v2]
+    assert speaker.batches == [(["One.", "Three."], VOICE_HASHES["alice"]), (["Two."], VOICE_HASHES["bob"])]
+    assert worker.client.requests == [f"/api/reference_voices/{VOICE_HASHES[name]}" for name in ["alice", "bob"]]
+    assert sorted((item["id"], decode_mock_performance(audio)) for item, audio in results) == [
+        (1, "One."), (2, "Two."), (3, "Three."),
+    ]
+
+
+def test_perform_batch_reports_errors_per_voice(worker):
+    speaker = worker.speakers[models.SpeakerModel.XTTS_v2]
+    def speak_batch(texts, speaker_wav, speaker_wav_hash=None):
+        if speaker_wav_hash == VOICE_HASHES["bob"]:
+            raise RuntimeError("bob is hoarse")
+        return RecordingSpeaker.speak_batch(speaker, texts, speaker_wav, speaker_wav_hash)
+    speaker.speak_batch = speak_batch
+
+    results = {item["id"]: audio for item, audio in worker.perform_batch([
+        work_item(1, "One.", "alice"),
+        work_item(2, "Two.", "bob"),
+        work_item(3, "Three.", "carol"),
+    ])}
+    assert decode_mock_performance(results[1]) == "One."
+    assert isinstance(results[2], RuntimeError)
+    # The server sent something other than the voice we asked for
+    assert isinstance(results[3], ValueError)
+
+
+def test_reference_voices_are_cached_between_runs(tmp_path):
+    first_run = make_worker(tmp_path / "cache")
+    first_run.get_reference_audio(VOICE_HASHES["alice"])
+    first_run.get_reference_audio(VOICE_HASHES["alice"])
+    assert len(first_run.client.requests) == 1
+
+    second_run = make_worker(tmp_path / "cache")
+    path = second_run.get_reference_audio(VOICE_HASHES["alice"])
+    assert second_run.client.requests == []
+    assert path.read_bytes() == VOICES["alice"]
+
+    # A damaged copy is fetched again
+    path.write_bytes(b"truncat")
+    third_run = make_worker(tmp_path / "cache")
+    assert third_run.get_reference_audio(VOICE_HASHES["alice"]).read_bytes() == VOICES["alice"]
+    assert len(third_run.client.requests) == 1
+
+
+class BatchServer:
+    """Hands out batches of work items, and accepts their results."""
+    def __init__(self, batches):
+        self.voices = ReferenceVoiceClient()
+        self.batches = list(batches)
+        self.completed = []
+        self.uploaded_files = []
+
+    def get(self, url, **kwargs):
+        return self.voices.get(url, **kwargs)
+
+    def post(self, url, json=None, data=None, files=None):
+        request = httpx.Request("POST", url)
+        if url == "/api/queue/take_batch":
+            return httpx.Response(200, json={"items": self.batches.pop(0) if self.batches else []}, request=request)
+        if url.startswith("/api/queue/complete_batch/"):
+            item_ids = [int(item_id) for item_id in data["item_ids"]]
+            self.completed.extend(item_ids)
+            self.uploaded_files.extend(file for _, file in files)
+            return httpx.Response(200, json={"completed": item_ids}, request=request)
+        return httpx.Response(404, request=request)
+
+
+def test_pipeline_synthesizes_while_uploading(tmp_path):
+    batches = [[work_item(i * 2 + j, f"Line {i * 2 + j}.", "alice") for j in range(2)] for i in range(3)]
+    server = BatchServer(batches)
+    worker = make_worker(tmp_path / "cache")
+    worker.client = server
+    speaker = worker.speakers[models.SpeakerModel.XTTS_v2]
+
+    # Uploads can't finish until the next batch is being synthesized, so
+    # this only completes if the two overlap.
+    synthesizing = [threading.Event() for _ in batches]
+    def speak_batch(texts, speaker_wav, speaker_wav_hash=None):
+        synthesizing[len(speaker.batches)].set()
+        return RecordingSpeaker.speak_batch(speaker, texts, speaker_wav, speaker_wav_hash)
+    speaker.speak_batch = speak_batch
+    uploads = []
+    original_upload = worker.upload
+    def upload(results):
+        next_batch = len(uploads) + 1
+        if next_batch < len(batches):
+            assert synthesizing[next_batch].wait(timeout=5)
+        uploads.append([work_item["id"] for work_item, _ in results])
+        return original_upload(results)
+    worker.upload = upload
+
+    assert worker.run_pipeline(stop_when_empty=True) == 6
+    assert uploads == [[0, 1], [2, 3], [4, 5]]
+    assert server.completed == list(range(6))
+    assert [texts for texts, _ in speaker.batches] == [[item["text"] for item in batch] for batch in batches]
+
+
+@pytest.mark.parametrize("upload_format, name, media_type", [
+    ("flac", "1.flac", "audio/flac"),
+    ("opus", "1.opus", "audio/ogg"),
+    ("wav", "1.wav", "audio/wav"),
+])
+def test_uploads_are_encoded_in_the_upload_format(tmp_path, upload_format, name, media_type):
+    server = BatchServer([[work_item(1, "One.", "alice")]])
+    worker = make_worker(tmp_path / "cache", upload_format=upload_format)
+    worker.client = server
+    assert worker.run_pipeline(stop_when_empty=True) == 1
+    [(uploaded_name, audio, uploaded_type)] = server.uploaded_files
+    assert (uploaded_name, uploaded_type) == (name, media_type)
+    if upload_format != "opus":
+        assert decode_mock_performance(audio) == "One."
+
+
+def test_unknown_upload_formats_are_refused(tmp_path):
+    with pytest.raises(ValueError):
+        make_worker(tmp_path / "cache", upload_format="aiff")
+
+
+class BreakablePool:
+    """Stands in for a SynthesisPool. A poisoned batch kills the process
+    that synthesizes it, say by running it out of memory, which breaks
+    the whole pool."""
+    def __init__(self, worker, poison):
+        self.worker = worker
+        self.poison = poison
+        self.broken = False
+        self.submitted = []
+        self.shut_down = False
+
+    def submit(self, work_items, reference_audio_paths):
+        if self.broken:
+            raise BrokenProcessPool("A process in the pool was terminated abruptly")
+        item_ids = [work_item["id"] for work_item in work_items]
+        self.submitted.append(item_ids)
+        future = Future()
+        if item_ids == self.poison:
+            self.broken = True
+            future.set_exception(BrokenProcessPool("A process in the pool was terminated abruptly"))
+        else:
+            future.set_result(self.worker.perform_batch(work_items))
+        return future
+
+    def shutdown(self, wait=True):
+        self.shut_down = True
+
+
+@pytest.mark.parametrize("always_poisoned, completed", [
+    # It works in the second pool
+    (False, [0, 1, 2, 3]),
+    # It breaks the second pool too, so we let go of it
+    (True, [2, 3]),
+])
+def test_dead_synthesis_processes_are_replaced(tmp_path, always_poisoned, completed):
+    batches = [[work_item(i * 2 + j, f"Line {i * 2 + j}.", "alice") for j in range(2)] for i in range(2)]
+    server = BatchServer(batches)
+    worker = make_worker(tmp_path / "cache", processes=2)
+    worker.client = server
+    pools = []
+    def replace_synthesis_pool(broken=None):
+        if worker.synthesis_pool is not None and worker.synthesis_pool is not broken:
+            return
+        poison = [0, 1] if always_poisoned or not pools else None
+        worker.synthesis_pool = BreakablePool(worker, poison)
+        pools.append(worker.synthesis_pool)
+    worker.replace_synthesis_pool = replace_synthesis_pool
+    released = []
+    worker.lease_keeper.release = released.extend
+    failures = []
+    worker.report_failure = lambda work_item, error: failures.append(work_item["id"])
+
+    assert worker.run_pipeline(stop_when_empty=True) == len(completed)
+    assert sorted(server.completed) == completed
+    # The items weren't reported as failed, that's not their fault
+    assert failures == []
+    # The first batch was tried once in each of the first two pools
+    assert [[0, 1] in pool.submitted for pool in pools[:2]] == [True, True]
+    if always_poisoned:
+        assert {0, 1} <= set(released)
+    # The last one is shut down once we're done with it
+    assert pools[-1].shut_down
+    assert worker.synthesis_pool is None